@@ -0,0 +1,341 @@
+"""
+Local stand-in HTTP server for the benchmarks, serving HTTP/1.1 in plain text and HTTP/2 over TLS.
+
+The response of each request is controlled by the query parameters:
+    size: body size in bytes, 1 MiB by default
+    content: "binary" (default), "text", "html" or "json"
+    id: identity mixed into the body, so that the bodies of different ids are not byte-identical
+    latency_ms: delay before the response headers
+    bandwidth: max bytes per second of the body, 0 for unlimited
+    gzip: "1" to compress the body with gzip
+    ranges: "0" to disable the support of Range requests
+    fail_rate: probability of responding with the fail status instead of the body
+    fail_first: number of the first requests of the same path responding with the fail status
+    fail_status: status code of the injected failures, 503 by default
+
+Run as `python -m benchmarks.bench_server`, printing the ports as a JSON line when ready.
+"""
+import asyncio
+import functools
+import gzip
+import json
+import os
+import random
+import re
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Mapping
+from urllib.parse import urlsplit, parse_qs
+
+# chunk size of writing the body, also the granularity of the bandwidth throttling
+WRITE_CHUNK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    "binary": "application/octet-stream",
+    "text": "text/plain; charset=utf-8",
+    "html": "text/html; charset=utf-8",
+    "json": "application/json",
+}
+
+
+@dataclass
+class BenchResponse:
+    status: int
+    headers: list[tuple[str, str]] = field(default_factory=list)
+    body: bytes = b""
+    # delay before the response headers in seconds
+    latency: float = 0.0
+    # max bytes per second of the body, 0 for unlimited
+    bandwidth: int = 0
+
+
+@functools.lru_cache(maxsize=16)
+def _base_body(content: str, size: int) -> bytes:
+    if content == "html":
+        block = ("<div class=\"post\"><h2>Heading</h2><p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, "
+                 "sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.</p>"
+                 "<script>var tracking = 1;</script><nav><a href=\"/\">Home</a></nav></div>\n").encode()
+        body = b"<!DOCTYPE html><html><head><title>Benchmark</title></head><body>\n" + block * (size // len(block) + 1)
+    elif content == "json":
+        item = json.dumps({"id": 1, "name": "benchmark", "tags": ["a", "b"], "active": True}).encode()
+        body = b"[" + b",".join([item] * (size // (len(item) + 1) + 1)) + b"]"
+    elif content == "text":
+        line = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.\n"
+        body = line * (size // len(line) + 1)
+    else:
+        # incompressible bytes repeated in blocks, cheap to generate for large sizes
+        block = random.Random(size).randbytes(min(size, 1024 * 1024))
+        body = block * (size // max(1, len(block)) + 1)
+    return body[:size]
+
+
+@functools.lru_cache(maxsize=64)
+def _body(content: str, size: int, body_id: str, is_gzip: bool) -> bytes:
+    body = _base_body(content, size)
+    if body_id and content == "binary" and size > 0:
+        # keep the other content types well-formed
+        prefix = f"{body_id}:".encode()[:size]
+        body = prefix + body[len(prefix):]
+    return gzip.compress(body, compresslevel=6) if is_gzip else body
+
+
+class BenchServer:
+    """
+    Builds the responses of both the HTTP/1.1 and HTTP/2 servers.
+    """
+
+    def __init__(self, seed: int = 0):
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._request_counts: dict[str, int] = defaultdict(int)
+
+    def build_response(self, method: str, path: str, headers: Mapping[str, str]) -> BenchResponse:
+        split_path = urlsplit(path)
+        query = {k: v[-1] for k, v in parse_qs(split_path.query).items()}
+        with self._lock:
+            self._request_counts[split_path.path] += 1
+            request_count = self._request_counts[split_path.path]
+            is_failing = request_count <= int(query.get("fail_first", 0)) \
+                or self._random.random() < float(query.get("fail_rate", 0))
+        latency = float(query.get("latency_ms", 0)) / 1000
+        bandwidth = int(query.get("bandwidth", 0))
+        if is_failing:
+            return BenchResponse(int(query.get("fail_status", 503)), [("content-length", "0")], latency=latency)
+
+        content = query.get("content", "binary")
+        size = int(query.get("size", 1024 * 1024))
+        is_gzip = query.get("gzip") == "1"
+        body = _body(content, size, query.get("id", ""), is_gzip)
+        etag = f"\"{content}-{size}-{query.get('id', '')}-{int(is_gzip)}\""
+        response_headers = [
+            ("content-type", CONTENT_TYPES.get(content, CONTENT_TYPES["binary"])),
+            ("etag", etag),
+        ]
+        if is_gzip:
+            response_headers.append(("content-encoding", "gzip"))
+        elif query.get("ranges", "1") == "1":
+            response_headers.append(("accept-ranges", "bytes"))
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", headers.get("range", "").strip())
+            if match and headers.get("if-range", etag) == etag and int(match.group(1)) < len(body):
+                start = int(match.group(1))
+                end = min(int(match.group(2)) if match.group(2) else len(body) - 1, len(body) - 1)
+                response_headers.append(("content-range", f"bytes {start}-{end}/{len(body)}"))
+                response_headers.append(("content-length", str(end - start + 1)))
+                body = body[start:end + 1] if method != "HEAD" else b""
+                return BenchResponse(206, response_headers, body, latency, bandwidth)
+        response_headers.append(("content-length", str(len(body))))
+        return BenchResponse(200, response_headers, body if method != "HEAD" else b"", latency, bandwidth)
+
+
+class _Throttle:
+    def __init__(self, bandwidth: int):
+        self.bandwidth = bandwidth
+        self.started_at = time.monotonic()
+        self.sent = 0
+
+    def delay(self, size: int) -> float:
+        """
+        :return: seconds to wait before sending more bytes of the size
+        """
+        self.sent += size
+        if self.bandwidth <= 0:
+            return 0.0
+        return max(0.0, self.started_at + self.sent / self.bandwidth - time.monotonic())
+
+
+class _Http1Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # listen backlog, large enough for the concurrent connections without SYN retransmissions
+    request_queue_size = 1024
+
+
+class _Http1Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    bench_server: BenchServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._respond("GET")
+
+    def do_HEAD(self):
+        self._respond("HEAD")
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0) or 0)
+        if length:
+            self.rfile.read(length)
+        self._respond("POST")
+
+    def _respond(self, method: str):
+        response = self.bench_server.build_response(
+            method, self.path, {k.lower(): v for k, v in self.headers.items()})
+        if response.latency:
+            time.sleep(response.latency)
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        self.end_headers()
+        throttle = _Throttle(response.bandwidth)
+        try:
+            for start in range(0, len(response.body), WRITE_CHUNK_SIZE):
+                chunk = response.body[start:start + WRITE_CHUNK_SIZE]
+                self.wfile.write(chunk)
+                delay = throttle.delay(len(chunk))
+                if delay:
+                    time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stops reading, e.g. once the size limit is exceeded
+            self.close_connection = True
+
+
+class _Http2Protocol(asyncio.Protocol):
+    def __init__(self, bench_server: BenchServer):
+        from h2.config import H2Configuration
+        from h2.connection import H2Connection
+        self.bench_server = bench_server
+        self.conn = H2Connection(config=H2Configuration(client_side=False, header_encoding="utf-8"))
+        self.transport: Optional[asyncio.Transport] = None
+        self._window_updated = asyncio.Event()
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self._flush()
+
+    def connection_lost(self, exc):
+        for task in self._tasks.values():
+            task.cancel()
+        self._window_updated.set()
+
+    def data_received(self, data: bytes):
+        from h2.events import RequestReceived, WindowUpdated, StreamReset, ConnectionTerminated
+        from h2.exceptions import ProtocolError
+        try:
+            events = self.conn.receive_data(data)
+        except ProtocolError:
+            self._flush()
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, RequestReceived):
+                headers = dict(event.headers)
+                self._tasks[event.stream_id] = asyncio.ensure_future(self._respond(event.stream_id, headers))
+            elif isinstance(event, WindowUpdated):
+                self._window_updated.set()
+            elif isinstance(event, StreamReset):
+                task = self._tasks.pop(event.stream_id, None)
+                if task:
+                    task.cancel()
+            elif isinstance(event, ConnectionTerminated):
+                self.transport.close()
+        self._flush()
+
+    def _flush(self):
+        data = self.conn.data_to_send()
+        if data and self.transport and not self.transport.is_closing():
+            self.transport.write(data)
+
+    async def _respond(self, stream_id: int, headers: dict[str, str]):
+        try:
+            response = self.bench_server.build_response(
+                headers.get(":method", "GET"), headers.get(":path", "/"), headers)
+            if response.latency:
+                await asyncio.sleep(response.latency)
+            self.conn.send_headers(stream_id, [(":status", str(response.status)), *response.headers],
+                                   end_stream=not response.body)
+            self._flush()
+            throttle = _Throttle(response.bandwidth)
+            body = memoryview(response.body)
+            while body:
+                window = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+                if window <= 0:
+                    self._window_updated.clear()
+                    await self._window_updated.wait()
+                    if self.transport.is_closing():
+                        return
+                    continue
+                chunk, body = body[:window], body[window:]
+                self.conn.send_data(stream_id, chunk.tobytes(), end_stream=not body)
+                self._flush()
+                delay = throttle.delay(len(chunk))
+                if delay:
+                    await asyncio.sleep(delay)
+                elif self.transport.get_write_buffer_size() > 4 * WRITE_CHUNK_SIZE:
+                    # yield to the other streams and let the transport drain
+                    await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # e.g. the stream is closed by the client
+            pass
+        finally:
+            self._tasks.pop(stream_id, None)
+
+
+def create_tls_context(cert_dir: str) -> Optional[ssl.SSLContext]:
+    """
+    Create the TLS context with a self-signed certificate generated by the openssl command,
+    :return: None if the openssl command is not available
+    """
+    cert_path = os.path.join(cert_dir, "cert.pem")
+    key_path = os.path.join(cert_dir, "key.pem")
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", "/CN=localhost", "-keyout", key_path, "-out", cert_path],
+            check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+    context.set_alpn_protocols(["h2"])
+    return context
+
+
+def start_http1_server(bench_server: BenchServer, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    handler = type("Http1Handler", (_Http1Handler,), {"bench_server": bench_server})
+    server = _Http1Server((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="bench-http1", daemon=True).start()
+    return server
+
+
+async def start_http2_server(bench_server: BenchServer,
+                             tls_context: ssl.SSLContext,
+                             host: str = "127.0.0.1",
+                             port: int = 0) -> asyncio.AbstractServer:
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(lambda: _Http2Protocol(bench_server), host, port, ssl=tls_context, backlog=1024)
+
+
+def main():
+    bench_server = BenchServer()
+    http1_server = start_http1_server(bench_server)
+    with tempfile.TemporaryDirectory() as cert_dir:
+        tls_context = create_tls_context(cert_dir)
+
+        async def serve():
+            http2_server = await start_http2_server(bench_server, tls_context) if tls_context else None
+            ports = {
+                "http1": http1_server.server_address[1],
+                "http2": http2_server.sockets[0].getsockname()[1] if http2_server else None,
+            }
+            print(json.dumps(ports), flush=True)
+            # serve until the parent process closes the stdin
+            await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+
+        asyncio.run(serve())
+    http1_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Startup benchmark of the plugin, measuring in fresh interpreters the time of importing the plugin SDK,
+loading the provider and tool classes as the SDK does on startup, and the first and second tool invocations
+against the local stand-in HTTP server.
+
+Usage, from the root directory of the plugin:
+    python -m benchmarks.bench_startup [--iterations 10] [--output bench_startup.json] [--compare baseline.json]
+
+The modules of the HTTP stack loaded by the plugin classes beyond those imported by the SDK itself are reported,
+as they should only be loaded by the first invocation.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+# modules expected to be loaded on first use only
+HEAVY_MODULES = ["httpx", "httpcore", "h2", "brotli", "zstandard", "socksio", "yarl", "mimetypes"]
+
+# phases measured in each interpreter, all smaller is better
+PHASES = ["import_sdk_ms", "load_plugin_ms", "first_invocation_ms", "second_invocation_ms"]
+
+INVOCATION_SIZE = 64 * 1024
+
+
+def load_plugin_classes() -> dict[str, type]:
+    """
+    Load the provider and tool classes from the sources declared in the manifests, in the same way as the SDK.
+    :return: the tool classes by the tool names
+    """
+    import yaml
+    from dify_plugin import Tool, ToolProvider
+    from dify_plugin.core.utils.class_loader import load_single_subclass_from_source
+
+    def load(source: str, parent_type: type) -> type:
+        return load_single_subclass_from_source(
+            module_name=os.path.splitext(source)[0].replace("/", "."),
+            script_path=os.path.join(os.getcwd(), source),
+            parent_type=parent_type,
+        )
+
+    provider = yaml.safe_load(Path("provider/download.yaml").read_text(encoding="utf-8"))
+    load(provider["extra"]["python"]["source"], ToolProvider)
+    tool_classes = {}
+    for tool_manifest in provider["tools"]:
+        tool = yaml.safe_load(Path(tool_manifest).read_text(encoding="utf-8"))
+        tool_classes[tool["identity"]["name"]] = load(tool["extra"]["python"]["source"], Tool)
+    return tool_classes
+
+
+def measure_startup(base_url: str, iteration: int) -> dict:
+    """
+    Measure the startup phases in the current interpreter, which has to be a fresh one.
+    """
+    # trio is not a dependency of the plugin, and is not importable once gevent patches the select module,
+    # so it is hidden from the optional import of httpcore as in the plugin runtime
+    sys.modules.setdefault("trio", None)
+
+    started_at = time.perf_counter()
+    import dify_plugin  # noqa: F401
+    sdk_imported_at = time.perf_counter()
+    sdk_modules = set(sys.modules)
+    tool_classes = load_plugin_classes()
+    plugin_loaded_at = time.perf_counter()
+    loaded_heavy_modules = [m for m in HEAVY_MODULES if m in sys.modules and m not in sdk_modules]
+    loaded_modules = len(sys.modules)
+
+    tool_class = tool_classes["single_file_download"]
+    invocation_times = []
+    for invocation in range(2):
+        query = urlencode({"size": INVOCATION_SIZE, "id": f"{iteration}-{invocation}"})
+        tool_params = {
+            "url": f"{base_url}/startup/{iteration}/{invocation}.bin?{query}",
+            "request_timeout": 30,
+            "ssl_certificate_verify": "false",
+        }
+        invoked_at = time.perf_counter()
+        for _ in tool_class.from_credentials({})._invoke(tool_params):
+            pass
+        invocation_times.append(time.perf_counter() - invoked_at)
+
+    return {
+        "import_sdk_ms": round((sdk_imported_at - started_at) * 1000, 3),
+        "load_plugin_ms": round((plugin_loaded_at - sdk_imported_at) * 1000, 3),
+        "first_invocation_ms": round(invocation_times[0] * 1000, 3),
+        "second_invocation_ms": round(invocation_times[1] * 1000, 3),
+        "loaded_modules": loaded_modules,
+        "loaded_heavy_modules": loaded_heavy_modules,
+    }
+
+
+def run_iterations(iterations: int) -> list[dict]:
+    from benchmarks.run_benchmarks import StandInServer
+
+    server = StandInServer()
+    samples = []
+    try:
+        for iteration in range(iterations):
+            completed = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_startup",
+                 "--measure", server.base_urls["http1"], "--iteration", str(iteration)],
+                check=True, capture_output=True, text=True)
+            # the last line of the output, ignoring anything printed by the SDK
+            sample = json.loads(completed.stdout.strip().splitlines()[-1])
+            samples.append(sample)
+            print(json.dumps(sample, ensure_ascii=False), flush=True)
+    finally:
+        server.close()
+    return samples
+
+
+def summarize(samples: list[dict]) -> dict:
+    summary = {}
+    for phase in PHASES:
+        values = [s[phase] for s in samples]
+        summary[phase] = {
+            "median": round(statistics.median(values), 3),
+            "min": round(min(values), 3),
+            "max": round(max(values), 3),
+        }
+    summary["loaded_heavy_modules"] = sorted({m for s in samples for m in s["loaded_heavy_modules"]})
+    return summary
+
+
+def compare_summary(summary: dict, baseline: dict) -> list[str]:
+    """
+    :return: lines of the relative changes of the median of each phase from the baseline
+    """
+    lines = []
+    for phase in PHASES:
+        before = baseline.get("summary", {}).get(phase, {}).get("median")
+        after = summary[phase]["median"]
+        if not before:
+            continue
+        change = (after - before) / before * 100
+        lines.append(f"{phase}: {before} -> {after} ({change:+.1f}%{'' if change < 0 else ' worse'})")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup and the first invocation of the plugin")
+    parser.add_argument("--iterations", type=int, default=10, help="number of fresh interpreters measured")
+    parser.add_argument("--output", default="bench_startup.json", help="path of the JSON results")
+    parser.add_argument("--compare", help="path of the JSON results of a baseline to compare with")
+    parser.add_argument("--measure", metavar="BASE_URL", help=argparse.SUPPRESS)
+    parser.add_argument("--iteration", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # child process measuring a single startup
+        print(json.dumps(measure_startup(args.measure, args.iteration)), flush=True)
+        return
+
+    samples = run_iterations(args.iterations)
+    summary = summarize(samples)
+    print(json.dumps(summary, ensure_ascii=False))
+    output = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "engine": os.environ.get("DOWNLOAD_ENGINE", "thread"),
+        "summary": summary,
+        "samples": samples,
+    }
+    Path(args.output).write_text(json.dumps(output, indent=2, ensure_ascii=False))
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        for line in compare_summary(summary, baseline):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+"""
+Benchmark suite of the download tools against the local stand-in HTTP server.
+
+Usage, from the root directory of the plugin:
+    python -m benchmarks.run_benchmarks [--quick] [--engine thread|asyncio] [--scenario NAME ...]
+                                        [--output bench_output.json] [--compare baseline.json]
+
+Each scenario reports the throughput of the output in MB/s, the p50/p99 latency of the operations, the peak RSS,
+the peak number of threads and the peak temporary disk usage, saved as JSON for comparing across changes.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Any, Callable, Optional
+from urllib.parse import urlencode
+
+MB = 1024 * 1024
+
+# interval in seconds of sampling the resource usage
+SAMPLE_INTERVAL = 0.02
+
+# metrics compared with the baseline, and whether larger is better
+COMPARED_METRICS = {
+    "throughput_mb_s": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "peak_rss_mb": False,
+    "peak_threads": False,
+    "peak_temp_disk_mb": False,
+}
+
+
+@dataclass
+class Scenario:
+    name: str
+    # "download_to_temp", "single_file_download", "multiple_file_download" or "download_to_text"
+    target: str
+    # "http1" or "http2"
+    protocol: str = "http1"
+    # body size in bytes of each URL
+    size: int = MB
+    # number of URLs per operation, only for the multiple URL tools
+    files: int = 1
+    # number of operations
+    iterations: int = 10
+    # number of concurrent operations
+    concurrency: int = 1
+    # extra query parameters of the stand-in server
+    query: dict[str, Any] = field(default_factory=dict)
+    # extra tool parameters
+    tool_params: dict[str, Any] = field(default_factory=dict)
+    # expect some operations to fail, e.g. with the injected errors
+    allow_errors: bool = False
+
+
+SCENARIOS = [
+    Scenario("temp_small_files", "download_to_temp", size=64 * 1024, iterations=400, concurrency=16),
+    Scenario("temp_large_file_segmented", "download_to_temp", size=64 * MB, iterations=3),
+    Scenario("temp_large_file_http2", "download_to_temp", protocol="http2", size=64 * MB, iterations=3),
+    Scenario("temp_gzip", "download_to_temp", size=16 * MB, iterations=5, query={"gzip": 1, "content": "text"}),
+    Scenario("temp_latency_throttled", "download_to_temp", size=4 * MB, iterations=16, concurrency=8,
+             query={"latency_ms": 50, "bandwidth": 20 * MB}),
+    Scenario("temp_retry_injected", "download_to_temp", size=256 * 1024, iterations=20, concurrency=4,
+             query={"fail_first": 1}),
+    Scenario("single_file_tool", "single_file_download", size=8 * MB, iterations=10),
+    Scenario("multiple_file_tool", "multiple_file_download", size=256 * 1024, files=50, iterations=5),
+    Scenario("multiple_file_tool_http2", "multiple_file_download", protocol="http2",
+             size=256 * 1024, files=50, iterations=5),
+    Scenario("multiple_file_tool_zip", "multiple_file_download", size=256 * 1024, files=50, iterations=5,
+             tool_params={"output_format": "zip"}),
+    Scenario("multiple_file_tool_partial_errors", "multiple_file_download", size=256 * 1024, files=50,
+             iterations=5, query={"fail_rate": 0.1, "fail_status": 404},
+             tool_params={"failure_mode": "partial"}, allow_errors=True),
+    Scenario("text_tool_html", "download_to_text", size=2 * MB, files=4, iterations=10,
+             query={"content": "html"}),
+    Scenario("text_tool_max_chars", "download_to_text", size=32 * MB, files=1, iterations=5,
+             query={"content": "text", "bandwidth": 64 * MB}, tool_params={"max_chars": 10000}),
+]
+
+
+class ResourceSampler:
+    """
+    Samples the peak RSS, number of threads and temporary disk usage of the process in the background,
+    including the spool directories of the downloads.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        from tools.utils.spool_manager import spool_manager
+        self.interval = interval
+        self.temp_dirs = [Path(tempfile.gettempdir()), *[Path(d) for d in spool_manager.directories]]
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self.peak_os_threads = 0
+        self.peak_temp_disk = 0
+        self._initial_temp_files = set()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "ResourceSampler":
+        self._initial_temp_files = set(self._list_temp_files())
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop_event.set()
+        self._thread.join()
+        self._sample()
+
+    def leaked_temp_files(self) -> int:
+        return len(set(self._list_temp_files()) - self._initial_temp_files)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss, os_threads = read_proc_status()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_os_threads = max(self.peak_os_threads, os_threads)
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+        temp_disk = 0
+        for path in self._list_temp_files():
+            if path not in self._initial_temp_files:
+                try:
+                    temp_disk += path.stat().st_blocks * 512
+                except OSError:
+                    pass
+        self.peak_temp_disk = max(self.peak_temp_disk, temp_disk)
+
+    def _list_temp_files(self) -> list[Path]:
+        files = []
+        for temp_dir in self.temp_dirs:
+            try:
+                files.extend(p for p in temp_dir.iterdir() if p.is_file())
+            except OSError:
+                pass
+        return files
+
+
+def read_proc_status() -> tuple[int, int]:
+    """
+    :return: the RSS in bytes and the number of OS threads of the process, falling back to the peak RSS
+    """
+    rss, threads = 0, 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except OSError:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # in kilobytes on Linux, while in bytes on macOS
+        rss = max_rss if sys.platform == "darwin" else max_rss * 1024
+    return rss, threads
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Nearest-rank percentile.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class StandInServer:
+    """
+    The stand-in HTTP server running in a child process, so that it does not compete with the measured process.
+    """
+
+    def __init__(self):
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.bench_server"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        ports = json.loads(self._process.stdout.readline())
+        self.base_urls = {
+            "http1": f"http://127.0.0.1:{ports['http1']}",
+            "http2": f"https://127.0.0.1:{ports['http2']}" if ports.get("http2") else None,
+        }
+
+    def url(self, scenario: Scenario, iteration: int, file_index: int) -> Optional[str]:
+        base_url = self.base_urls[scenario.protocol]
+        if not base_url:
+            return None
+        query = {"size": scenario.size, "id": f"{iteration}-{file_index}", **scenario.query}
+        return f"{base_url}/{scenario.name}/{iteration}/{file_index}.bin?{urlencode(query)}"
+
+    def close(self):
+        self._process.stdin.close()
+        try:
+            self._process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+
+
+def create_operation(scenario: Scenario, server: StandInServer) -> Callable[[int], int]:
+    """
+    :return: the operation of the iteration, returning the number of the output bytes,
+        i.e. the downloaded content, the blobs or the extracted text
+    """
+    tool_params = {
+        "request_timeout": 30,
+        "ssl_certificate_verify": "false",
+        **scenario.tool_params,
+    }
+
+    if scenario.target == "download_to_temp":
+        from tools.utils.download_utils import download_to_temp
+
+        def download(iteration: int) -> int:
+            _, content, _, _, _ = download_to_temp(
+                "GET", server.url(scenario, iteration, 0), timeout=30, ssl_certificate_verify=False)
+            try:
+                return content.size
+            finally:
+                content.release()
+
+        return download
+
+    if scenario.target == "single_file_download":
+        from tools.single_file_download.single_file_download import SingleFileDownloadTool as tool_class
+    elif scenario.target == "multiple_file_download":
+        from tools.multiple_file_download.multiple_file_download import MultipleFileDownloadTool as tool_class
+    elif scenario.target == "download_to_text":
+        from tools.download_to_text.download_to_text import DownloadToTextTool as tool_class
+    else:
+        raise ValueError(f"Invalid benchmark target: {scenario.target}")
+
+    def invoke(iteration: int) -> int:
+        urls = [server.url(scenario, iteration, i) for i in range(scenario.files)]
+        tool = tool_class.from_credentials({})
+        size = 0
+        for message in tool._invoke({**tool_params, "url": "\n".join(urls)}):
+            blob = getattr(message.message, "blob", None)
+            text = getattr(message.message, "text", None)
+            if blob is not None:
+                size += len(blob)
+            elif text is not None:
+                size += len(text.encode("utf-8"))
+        return size
+
+    return invoke
+
+
+def run_scenario(scenario: Scenario, server: StandInServer) -> dict[str, Any]:
+    if not server.base_urls[scenario.protocol]:
+        return {"name": scenario.name, "skipped": f"{scenario.protocol} server is not available"}
+    operation = create_operation(scenario, server)
+    latencies: list[float] = []
+    errors: list[str] = []
+    total_size = 0
+    lock = threading.Lock()
+
+    def run_iteration(iteration: int):
+        nonlocal total_size
+        started_at = time.perf_counter()
+        try:
+            size = operation(iteration)
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started_at)
+            total_size += size
+
+    with ResourceSampler() as sampler:
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=scenario.concurrency) as executor:
+            list(executor.map(run_iteration, range(scenario.iterations)))
+        wall_time = time.perf_counter() - started_at
+    # wait for the downloads cancelled in the background to clean up
+    time.sleep(0.2)
+
+    return {
+        "name": scenario.name,
+        "target": scenario.target,
+        "protocol": scenario.protocol,
+        "size": scenario.size,
+        "files": scenario.files,
+        "iterations": scenario.iterations,
+        "concurrency": scenario.concurrency,
+        "query": scenario.query,
+        "tool_params": scenario.tool_params,
+        "wall_time_s": round(wall_time, 3),
+        "output_mb": round(total_size / MB, 3),
+        "throughput_mb_s": round(total_size / MB / wall_time, 3) if wall_time > 0 else 0.0,
+        "operations_per_s": round(len(latencies) / wall_time, 3) if wall_time > 0 else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "latency_mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+        "peak_rss_mb": round(sampler.peak_rss / MB, 3),
+        "peak_threads": sampler.peak_threads,
+        "peak_os_threads": sampler.peak_os_threads,
+        "peak_temp_disk_mb": round(sampler.peak_temp_disk / MB, 3),
+        "leaked_temp_files": sampler.leaked_temp_files(),
+        "errors": len(errors),
+        "first_error": errors[0] if errors and not scenario.allow_errors else None,
+    }
+
+
+def scale_scenario(scenario: Scenario, factor: float) -> Scenario:
+    """
+    Scale down the sizes and iterations for a quick run.
+    """
+    return Scenario(**{
+        **asdict(scenario),
+        "size": max(1024, int(scenario.size * factor)),
+        "iterations": max(2, int(scenario.iterations * factor)),
+    })
+
+
+def compare_results(results: list[dict[str, Any]], baseline: dict[str, Any]) -> list[str]:
+    """
+    :return: lines of the relative changes of the metrics from the baseline
+    """
+    baseline_results = {r["name"]: r for r in baseline.get("results", [])}
+    lines = []
+    for result in results:
+        baseline_result = baseline_results.get(result["name"])
+        if not baseline_result or "skipped" in result or "skipped" in baseline_result:
+            continue
+        changes = []
+        for metric, is_larger_better in COMPARED_METRICS.items():
+            before, after = baseline_result.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            is_better = change > 0 if is_larger_better else change < 0
+            changes.append(f"{metric} {before} -> {after} ({change:+.1f}%{'' if is_better else ' worse'})")
+        lines.append(f"{result['name']}: " + ", ".join(changes))
+    return lines
+
+
+def get_git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the download tools against a local stand-in server")
+    parser.add_argument("--scenario", action="append", help="name of the scenario to run, all by default")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], help="download engine, DOWNLOAD_ENGINE by default")
+    parser.add_argument("--quick", action="store_true", help="scale down the sizes and iterations")
+    parser.add_argument("--output", default="bench_output.json", help="path of the JSON results")
+    parser.add_argument("--compare", help="path of the JSON results of a baseline to compare with")
+    args = parser.parse_args()
+
+    if args.engine:
+        # read when importing the tools
+        os.environ["DOWNLOAD_ENGINE"] = args.engine
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    if args.quick:
+        scenarios = [scale_scenario(s, 0.1) for s in scenarios]
+
+    # httpcore optionally imports trio, which is not importable once gevent patches the select module,
+    import httpcore  # noqa: F401
+    # while the plugin SDK monkey patches the standard library with gevent on import,
+    # which has to be done before starting the server process
+    import tools.utils.download_utils  # noqa: F401
+
+    server = StandInServer()
+    results = []
+    try:
+        for scenario in scenarios:
+            result = run_scenario(scenario, server)
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+    finally:
+        server.close()
+
+    output = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_revision": get_git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "engine": os.environ.get("DOWNLOAD_ENGINE", "thread"),
+        "quick": args.quick,
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(output, indent=2, ensure_ascii=False))
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        for line in compare_results(results, baseline):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Fixtures of the tests, running the tools against a local HTTP server in the same way as the plugin runtime.
+"""
+import sys
+
+# trio is not a dependency of the plugin, and is not importable once gevent patches the select module,
+# so it is hidden from the optional import of httpcore as in the plugin runtime
+sys.modules.setdefault("trio", None)
+
+# the plugin SDK monkey patches the standard library with gevent on import, as in the plugin runtime,
+# which has to be done before starting any thread
+import dify_plugin  # noqa: E402,F401
+
+from dataclasses import dataclass  # noqa: E402
+from typing import Any, Callable  # noqa: E402
+
+import pytest  # noqa: E402
+
+from tests.local_server import LocalServer  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def local_server() -> LocalServer:
+    server = LocalServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def http_server(local_server: LocalServer) -> LocalServer:
+    local_server.reset()
+    return local_server
+
+
+@dataclass
+class ToolResult:
+    messages: list[Any]
+
+    @property
+    def files(self) -> list[tuple[dict, bytes]]:
+        """
+        :return: the meta and the content of the blob messages, including the ones sent in chunks
+        """
+        files = []
+        chunks: dict[str, list[bytes]] = {}
+        for message in self.messages:
+            if message.type.value == "blob":
+                files.append((message.meta, message.message.blob))
+            elif message.type.value == "blob_chunk":
+                chunks.setdefault(message.message.id, []).append(message.message.blob)
+                if message.message.end:
+                    files.append((message.meta, b"".join(chunks.pop(message.message.id))))
+        return files
+
+    @property
+    def texts(self) -> list[str]:
+        return [m.message.text for m in self.messages if m.type.value == "text"]
+
+    @property
+    def jsons(self) -> list[dict]:
+        return [m.message.json_object for m in self.messages if m.type.value == "json"]
+
+
+@pytest.fixture
+def invoke_tool() -> Callable[..., ToolResult]:
+    """
+    Invoke a tool by its name with the tool parameters, as the plugin runtime does.
+    """
+
+    def invoke(tool_name: str, **tool_parameters) -> ToolResult:
+        if tool_name == "single_file_download":
+            from tools.single_file_download.single_file_download import SingleFileDownloadTool as tool_class
+        elif tool_name == "multiple_file_download":
+            from tools.multiple_file_download.multiple_file_download import MultipleFileDownloadTool as tool_class
+        elif tool_name == "download_to_text":
+            from tools.download_to_text.download_to_text import DownloadToTextTool as tool_class
+        else:
+            raise ValueError(f"Invalid tool name: {tool_name}")
+        return ToolResult(list(tool_class.from_credentials({})._invoke(tool_parameters)))
+
+    return invoke
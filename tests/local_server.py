@@ -0,0 +1,170 @@
+"""
+Local HTTP server of the tests, recording the requests and responding by their paths.
+"""
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Iterable, Optional, Union
+from urllib.parse import urlsplit
+
+from benchmarks.bench_server import BenchServer
+
+
+@dataclass
+class RecordedRequest:
+    method: str
+    path: str
+    # with lower case names
+    headers: dict[str, str]
+    body: bytes
+
+
+@dataclass
+class LocalResponse:
+    status: int = 200
+    headers: list[tuple[str, str]] = field(default_factory=list)
+    body: bytes = b""
+    # delay before the response headers in seconds
+    delay: float = 0.0
+    # bytes of the body sent before closing the connection, None to send the whole body
+    drop_after: Optional[int] = None
+
+
+Route = Union[LocalResponse, Callable[[RecordedRequest], LocalResponse]]
+
+
+class LocalServer:
+    """
+    Local HTTP/1.1 server recording the requests, responding from the routes by path,
+    or as the stand-in server of the benchmarks controlled by the query parameters (e.g. "?size=1024").
+    """
+
+    def __init__(self):
+        self.bench_server = BenchServer()
+        self.routes: dict[str, Route] = {}
+        self.requests: list[RecordedRequest] = []
+        self._lock = threading.Lock()
+        handler = type("LocalHandler", (_LocalHandler,), {"local_server": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="local-http-server", daemon=True).start()
+
+    @property
+    def origin(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def url(self, path: str) -> str:
+        return self.origin + path
+
+    def route(self, path: str, response: Optional[Route] = None, **kwargs):
+        """
+        :param response: the response or a function building it from the request,
+            or None to build the response from the keyword arguments of LocalResponse
+        """
+        self.routes[path] = response if response is not None else LocalResponse(**kwargs)
+
+    def route_content(self, path: str, body: bytes, headers: Iterable[tuple[str, str]] = (),
+                      is_ranged: bool = True, drop_after: Optional[int] = None):
+        """
+        Serve the body at the path, honoring the Range requests if ranged,
+        where If-Range is matched against the strong ETag or the Last-Modified of the headers.
+        :param drop_after: bytes of the body sent by the first response before closing the connection
+        """
+        headers = list(headers)
+        validators = [v for k, v in headers if k.lower() in ["etag", "last-modified"] and not v.startswith("W/")]
+        drops = [drop_after]
+
+        def respond(request: RecordedRequest) -> LocalResponse:
+            drop = drops.pop() if drops else None
+            response_headers = list(headers)
+            if is_ranged:
+                response_headers.append(("accept-ranges", "bytes"))
+                match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("range", ""))
+                if_range = request.headers.get("if-range")
+                if match and (if_range is None or if_range in validators) and int(match.group(1)) < len(body):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)) if match.group(2) else len(body) - 1, len(body) - 1)
+                    response_headers.append(("content-range", f"bytes {start}-{end}/{len(body)}"))
+                    return LocalResponse(206, response_headers, body[start:end + 1], drop_after=drop)
+            return LocalResponse(200, response_headers, body, drop_after=drop)
+
+        self.route(path, respond)
+
+    def requests_to(self, path: str) -> list[RecordedRequest]:
+        with self._lock:
+            return [r for r in self.requests if urlsplit(r.path).path == path]
+
+    def respond(self, request: RecordedRequest) -> LocalResponse:
+        with self._lock:
+            self.requests.append(request)
+        route = self.routes.get(urlsplit(request.path).path)
+        if route is None:
+            response = self.bench_server.build_response(request.method, request.path, request.headers)
+            return LocalResponse(response.status, response.headers, response.body, response.latency)
+        return route(request) if callable(route) else route
+
+    def reset(self):
+        self.routes.clear()
+        with self._lock:
+            self.requests.clear()
+        self.bench_server = BenchServer()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _LocalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    local_server: LocalServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # the trailers end with an empty line
+                    while self.rfile.readline().strip():
+                        pass
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get("content-length", 0) or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _handle(self):
+        request = RecordedRequest(
+            method=self.command,
+            path=self.path,
+            headers={k.lower(): v for k, v in self.headers.items()},
+            body=self._read_body(),
+        )
+        response = self.local_server.respond(request)
+        if response.delay:
+            time.sleep(response.delay)
+        self.send_response(response.status)
+        header_names = {name.lower() for name, _ in response.headers}
+        for name, value in response.headers:
+            self.send_header(name, value)
+        if "content-length" not in header_names and "transfer-encoding" not in header_names:
+            self.send_header("content-length", str(len(response.body)))
+        self.end_headers()
+        if request.method == "HEAD":
+            return
+        try:
+            if response.drop_after is None:
+                self.wfile.write(response.body)
+            else:
+                self.wfile.write(response.body[:response.drop_after])
+                self.wfile.flush()
+                self.close_connection = True
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from tools.utils import download_engine, download_utils
+from tools.utils.async_download import async_download_engine, run_blocking
+from tools.utils.download_metrics import metrics_registry
+from tools.utils.http_cache import ResponseCache
+from tools.utils.retry_utils import HttpStatusError
+
+LARGE_BODY = os.urandom(3 * 1024 * 1024)
+
+
+@pytest.fixture(autouse=True)
+def asyncio_engine(monkeypatch):
+    monkeypatch.setattr(download_engine, "download_engine", "asyncio")
+
+
+def test_download_small_and_large_files(http_server, invoke_tool):
+    http_server.route("/large.bin", body=LARGE_BODY)
+    urls = [http_server.url("/small.bin?size=1000"), http_server.url("/large.bin")]
+
+    result = invoke_tool("multiple_file_download", url="\n".join(urls))
+
+    assert [len(blob) for _, blob in result.files] == [1000, len(LARGE_BODY)]
+    assert result.files[1][1] == LARGE_BODY
+
+
+def test_resume_after_dropped_connection(http_server, invoke_tool):
+    http_server.route_content("/resumable.bin", LARGE_BODY, [("etag", '"v1"')], drop_after=1024 * 1024)
+
+    result = invoke_tool("single_file_download", url=http_server.url("/resumable.bin"))
+
+    assert result.files[0][1] == LARGE_BODY
+    assert "range" in http_server.requests_to("/resumable.bin")[-1].headers
+
+
+def test_cached_content_is_served(http_server, invoke_tool, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_utils, "response_cache", ResponseCache(str(tmp_path), 64 * 1024 * 1024))
+    http_server.route("/cached.bin", headers=[("cache-control", "max-age=60")], body=LARGE_BODY)
+    url = http_server.url("/cached.bin")
+
+    invoke_tool("single_file_download", url=url)
+    result = invoke_tool("single_file_download", url=url)
+
+    assert result.files[0][1] == LARGE_BODY
+    assert result.files[0][0]["metrics"]["cached"] is True
+    assert len(http_server.requests_to("/cached.bin")) == 1
+
+
+def test_error_is_raised(http_server, invoke_tool):
+    http_server.route("/missing.bin", status=404)
+    with pytest.raises(HttpStatusError):
+        invoke_tool("single_file_download", url=http_server.url("/missing.bin"))
+
+
+def test_blocking_calls_run_off_the_event_loop():
+    async def main():
+        loop_thread = threading.get_ident()
+        return loop_thread, await run_blocking(threading.get_ident)
+
+    with async_download_engine.session() as session:
+        loop_thread, call_thread = session.submit(main).result(timeout=10)
+    assert call_thread != loop_thread
+
+
+def test_result_of_cancelled_blocking_call_is_released():
+    released = []
+    started = threading.Event()
+
+    def blocking_call():
+        started.set()
+        threading.Event().wait(0.1)
+        return "result"
+
+    async def main():
+        task = asyncio.ensure_future(run_blocking(blocking_call, on_cancelled=released.append))
+        while not started.is_set():
+            await asyncio.sleep(0.001)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with async_download_engine.session() as session:
+        session.submit(main).result(timeout=10)
+    assert released == ["result"]
+
+
+def test_stats_are_exported_to_metrics(http_server, invoke_tool):
+    invoke_tool("single_file_download", url=http_server.url("/small.bin?size=1000"))
+
+    assert metrics_registry.snapshot()["stats"]["async_engine"]["started_jobs"] >= 1
+    assert async_download_engine.stats()["running_jobs"] == 0
+    assert "download_async_engine_wait_seconds_count " in metrics_registry.render_prometheus()
@@ -0,0 +1,85 @@
+import gzip
+import json
+
+import pytest
+
+from benchmarks.bench_server import BenchServer
+from benchmarks.run_benchmarks import Scenario, StandInServer, compare_results, percentile, run_scenario
+
+
+def test_bench_response_of_the_query():
+    response = BenchServer().build_response("GET", "/a.bin?size=1000&content=text&latency_ms=20", {})
+
+    assert response.status == 200
+    assert len(response.body) == 1000
+    assert response.latency == 0.02
+    assert ("content-type", "text/plain; charset=utf-8") in response.headers
+
+
+def test_bench_range_requests():
+    bench_server = BenchServer()
+    etag = dict(bench_server.build_response("HEAD", "/a.bin?size=1000", {}).headers)["etag"]
+    body = bench_server.build_response("GET", "/a.bin?size=1000", {}).body
+
+    partial = bench_server.build_response("GET", "/a.bin?size=1000", {"range": "bytes=100-", "if-range": etag})
+    changed = bench_server.build_response("GET", "/a.bin?size=1000", {"range": "bytes=100-", "if-range": '"old"'})
+    not_ranged = bench_server.build_response("GET", "/a.bin?size=1000&ranges=0", {"range": "bytes=100-"})
+
+    assert (partial.status, partial.body) == (206, body[100:])
+    assert ("content-range", "bytes 100-999/1000") in partial.headers
+    assert (changed.status, not_ranged.status) == (200, 200)
+
+
+def test_bench_injected_failures_and_compression():
+    bench_server = BenchServer()
+    statuses = [bench_server.build_response("GET", "/f.bin?size=10&fail_first=2&fail_status=500", {}).status
+                for _ in range(3)]
+    compressed = bench_server.build_response("GET", "/g.bin?size=1000&content=text&gzip=1", {})
+
+    assert statuses == [500, 500, 200]
+    assert len(gzip.decompress(compressed.body)) == 1000
+    assert ("content-encoding", "gzip") in compressed.headers
+
+
+def test_percentile_and_comparison():
+    assert percentile([3.0, 1.0, 2.0, 4.0], 50) == 2.0
+    assert percentile([3.0, 1.0, 2.0, 4.0], 99) == 4.0
+    assert percentile([], 50) == 0.0
+
+    lines = compare_results([{"name": "s", "throughput_mb_s": 120.0, "latency_p50_ms": 20.0}],
+                            {"results": [{"name": "s", "throughput_mb_s": 100.0, "latency_p50_ms": 10.0}]})
+
+    assert lines == ["s: throughput_mb_s 100.0 -> 120.0 (+20.0%), latency_p50_ms 10.0 -> 20.0 (+100.0% worse)"]
+
+
+@pytest.fixture(scope="module")
+def stand_in_server() -> StandInServer:
+    server = StandInServer()
+    yield server
+    server.close()
+
+
+@pytest.mark.parametrize("scenario", [
+    Scenario("test_temp", "download_to_temp", size=64 * 1024, iterations=4, concurrency=2, query={"fail_first": 1}),
+    Scenario("test_multiple", "multiple_file_download", size=16 * 1024, files=3, iterations=2),
+    Scenario("test_text", "download_to_text", size=16 * 1024, iterations=2, query={"content": "html"}),
+])
+def test_run_scenario(stand_in_server, scenario):
+    result = run_scenario(scenario, stand_in_server)
+
+    assert result["errors"] == 0
+    assert result["output_mb"] > 0
+    assert 0 < result["latency_p50_ms"] <= result["latency_p99_ms"]
+    assert result["peak_rss_mb"] > 0
+    assert result["leaked_temp_files"] == 0
+    json.dumps(result)
+
+
+def test_failed_operations_are_counted(stand_in_server):
+    scenario = Scenario("test_failures", "download_to_temp", size=1024, iterations=2,
+                        query={"fail_rate": 1, "fail_status": 404})
+
+    result = run_scenario(scenario, stand_in_server)
+
+    assert result["errors"] == 2
+    assert result["first_error"].startswith("HttpStatusError")
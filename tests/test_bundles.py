@@ -0,0 +1,80 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from tools.utils.bundle_utils import DownloadBundle
+from tools.utils.content_utils import DownloadedContent
+from tools.utils.retry_utils import HttpStatusError
+from tools.utils.spool_manager import spool_manager
+
+FIRST_BODY = b"first" * 1000
+SECOND_BODY = b"second" * 1000
+
+
+@pytest.fixture
+def same_named_urls(http_server) -> list[str]:
+    http_server.route("/a/data.bin", body=FIRST_BODY)
+    http_server.route("/b/data.bin", body=SECOND_BODY)
+    return [http_server.url("/a/data.bin"), http_server.url("/b/data.bin")]
+
+
+def test_zip_bundle(invoke_tool, same_named_urls):
+    result = invoke_tool("multiple_file_download", url="\n".join(same_named_urls), output_format="zip")
+
+    [(meta, blob)] = result.files
+    assert (meta["filename"], meta["mime_type"], meta["files"]) == ("downloads.zip", "application/zip", 2)
+    with zipfile.ZipFile(io.BytesIO(blob)) as archive:
+        assert archive.namelist() == ["data.bin", "data_1.bin"]
+        assert archive.read("data.bin") == FIRST_BODY
+        assert archive.read("data_1.bin") == SECOND_BODY
+
+
+def test_tar_gz_bundle(invoke_tool, same_named_urls):
+    result = invoke_tool("multiple_file_download", url="\n".join(same_named_urls), output_format="tar.gz")
+
+    [(meta, blob)] = result.files
+    assert (meta["filename"], meta["mime_type"]) == ("downloads.tar.gz", "application/gzip")
+    with tarfile.open(fileobj=io.BytesIO(blob), mode="r:gz") as archive:
+        assert archive.getnames() == ["data.bin", "data_1.bin"]
+        assert archive.extractfile("data_1.bin").read() == SECOND_BODY
+
+
+def test_bundle_with_partial_success(http_server, invoke_tool, same_named_urls):
+    http_server.route("/missing.bin", status=404)
+    urls = [same_named_urls[0], http_server.url("/missing.bin")]
+
+    result = invoke_tool("multiple_file_download", url="\n".join(urls), output_format="zip", failure_mode="partial")
+
+    [(meta, blob)] = result.files
+    with zipfile.ZipFile(io.BytesIO(blob)) as archive:
+        assert archive.namelist() == ["data.bin"]
+    assert [r["status"] for r in result.jsons[-1]["results"]] == ["succeeded", "failed"]
+
+
+def test_bundle_is_discarded_on_failure(http_server, invoke_tool):
+    http_server.route("/missing.bin", status=404)
+    spool_files = spool_manager.stats()["files"]
+
+    with pytest.raises(HttpStatusError):
+        invoke_tool("multiple_file_download", url=http_server.url("/missing.bin"), output_format="zip")
+
+    assert spool_manager.stats()["files"] == spool_files
+
+
+def test_entry_names_stay_inside_the_archive():
+    bundle = DownloadBundle("zip")
+    try:
+        for filename in ["../../etc/passwd", "..", None]:
+            bundle.add(filename, DownloadedContent(data=b"data"), idx=7)
+        assert bundle.entry_names == ["passwd", "file_7", "file_7_1"]
+    finally:
+        bundle.discard()
+    assert not os.path.exists(bundle.file_path)
+
+
+def test_invalid_output_format():
+    with pytest.raises(ValueError):
+        DownloadBundle.create("rar")
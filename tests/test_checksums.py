@@ -0,0 +1,63 @@
+import hashlib
+import zlib
+
+import pytest
+
+from tools.utils.download_utils import download_to_temp
+from tools.utils.hash_utils import ChecksumMismatchError, parse_expected_checksums, verify_checksums
+
+BODY = b"checksummed body" * 1000
+SHA256 = hashlib.sha256(BODY).hexdigest()
+MD5 = hashlib.md5(BODY).hexdigest()
+
+
+def test_checksums_are_reported(http_server, invoke_tool):
+    http_server.route("/file.bin", body=BODY)
+
+    result = invoke_tool("single_file_download", url=http_server.url("/file.bin"), checksum_algorithms="md5,crc32")
+
+    meta = result.files[0][0]
+    assert (meta["sha256"], meta["md5"], meta["crc32"]) == (SHA256, MD5, f"{zlib.crc32(BODY):08x}")
+
+
+def test_expected_checksums_are_verified(http_server, invoke_tool):
+    http_server.route("/file.bin", body=BODY)
+
+    result = invoke_tool("single_file_download", url=http_server.url("/file.bin"),
+                         expected_checksums=f"sha256:{SHA256} md5:{MD5.upper()}")
+
+    assert result.files[0][1] == BODY
+
+
+def test_checksum_mismatch_is_raised(http_server, invoke_tool):
+    http_server.route("/file.bin", body=BODY)
+
+    with pytest.raises(ChecksumMismatchError) as e:
+        invoke_tool("single_file_download", url=http_server.url("/file.bin"), expected_checksums="0" * 32)
+
+    assert (e.value.algorithm, e.value.actual) == ("md5", MD5)
+
+
+def test_checksum_not_computed_is_raised():
+    with pytest.raises(ChecksumMismatchError) as e:
+        verify_checksums("http://example.com/file.bin", {"sha256": SHA256}, {"md5": MD5})
+    assert (e.value.algorithm, e.value.actual) == ("md5", None)
+
+
+def test_unknown_algorithm_is_rejected_before_downloading(http_server):
+    http_server.route("/file.bin", body=BODY)
+
+    with pytest.raises(ValueError):
+        download_to_temp("GET", http_server.url("/file.bin"), expected_checksums={"sha1": "0" * 40})
+    with pytest.raises(ValueError):
+        verify_checksums("http://example.com/file.bin", {"sha256": SHA256}, {"sha1": "0" * 40})
+
+    assert not http_server.requests_to("/file.bin")
+
+
+def test_invalid_expected_checksum_is_rejected():
+    assert parse_expected_checksums(f"sha-256:{SHA256}, {MD5}") == {"sha256": SHA256, "md5": MD5}
+    with pytest.raises(ValueError):
+        parse_expected_checksums("sha1:abcd")
+    with pytest.raises(ValueError):
+        parse_expected_checksums("md5:not-hex")
@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from yarl import URL
+
+from tools.utils import connection_warmer, download_engine
+from tools.utils.client_pool import ClientHolder
+from tools.utils.connection_warmer import get_warm_connection_count, plan_origins, warm_connection
+from tools.utils.dns_cache import WarmStreams
+from tools.utils.download_engine import DownloadSession
+from tools.utils.download_metrics import metrics_registry
+
+
+def count_prewarmed_connections(status: str) -> float:
+    series = metrics_registry.snapshot()["counters"].get("prewarmed_connections_total", [])
+    return sum(s["value"] for s in series if s["labels"].get("status") == status)
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def wait_for_warm_ups():
+    """
+    Wait until no warm-up is queued or in progress, e.g. left by the previous tests.
+    """
+    max_pending = connection_warmer.prewarm_max_workers * connection_warmer.PREWARM_MAX_PENDING_PER_WORKER
+    acquired = 0
+    try:
+        while acquired < max_pending:
+            wait_for(lambda: connection_warmer._prewarm_slots.acquire(blocking=False))
+            acquired += 1
+    finally:
+        for _ in range(acquired):
+            connection_warmer._prewarm_slots.release()
+
+
+def test_origins_and_connection_counts():
+    urls = [URL(u) for u in ["http://a.com/1", "http://a.com/2", "https://b.com/1", "https://b.com/2", "http://c.com/1"]]
+
+    assert plan_origins(urls) == {"http://a.com": 2, "https://b.com": 2}
+    assert get_warm_connection_count("http://a.com", 20, 0) == 8
+    assert get_warm_connection_count("http://a.com", 20, 3) == 3
+    assert get_warm_connection_count("https://b.com", 20, 0) == 1
+
+
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_prewarm_opens_connections_without_requests(http_server, monkeypatch, engine):
+    monkeypatch.setattr(download_engine, "download_engine", engine)
+    # without the idle connections left to the local server by the other tests
+    monkeypatch.setattr(connection_warmer, "client_holder", ClientHolder())
+    urls = [URL(http_server.url(f"/warm/{i}.bin?size=100")) for i in range(3)]
+    opened = count_prewarmed_connections("opened")
+
+    with DownloadSession() as session:
+        session.prewarm(urls, None, False, 5.0)
+        wait_for(lambda: count_prewarmed_connections("opened") >= opened + 3)
+
+    assert not http_server.requests
+
+
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_prewarm_does_not_wait_for_the_connections(http_server, monkeypatch, engine):
+    monkeypatch.setattr(download_engine, "download_engine", engine)
+    started, release = threading.Event(), threading.Event()
+
+    def blocking_warm_connection(*args):
+        started.set()
+        release.wait(5)
+
+    async def async_blocking_warm_connection(*args):
+        started.set()
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+
+    monkeypatch.setattr(download_engine, "warm_connection", blocking_warm_connection)
+    monkeypatch.setattr(download_engine, "async_warm_connection", async_blocking_warm_connection)
+    urls = [URL(http_server.url(f"/warm/{i}.bin")) for i in range(2)]
+
+    try:
+        with DownloadSession() as session:
+            # returns while the warm-up is blocked
+            session.prewarm(urls, None, False, 5.0)
+            assert not release.is_set()
+        assert started.wait(5)
+    finally:
+        release.set()
+
+
+def test_warm_ups_are_bounded_across_invocations(http_server, monkeypatch):
+    monkeypatch.setattr(download_engine, "download_engine", "thread")
+    release = threading.Event()
+    thread_names = set()
+
+    def blocking_warm_connection(*args):
+        thread_names.add(threading.current_thread().name)
+        release.wait(5)
+
+    monkeypatch.setattr(download_engine, "warm_connection", blocking_warm_connection)
+    max_pending = connection_warmer.prewarm_max_workers * connection_warmer.PREWARM_MAX_PENDING_PER_WORKER
+    wait_for_warm_ups()
+    skipped = count_prewarmed_connections("skipped")
+    threads_before = threading.active_count()
+
+    try:
+        for i in range(max_pending):
+            urls = [URL(f"http://origin{i}.invalid/{j}") for j in range(2)]
+            with DownloadSession() as session:
+                session.prewarm(urls, None, False, 5.0)
+        assert count_prewarmed_connections("skipped") - skipped == max_pending * 2 - max_pending
+        assert threading.active_count() - threads_before <= connection_warmer.prewarm_max_workers
+    finally:
+        release.set()
+    wait_for_warm_ups()
+    assert all(name.startswith("download-prewarm") for name in thread_names)
+
+
+def test_origin_with_idle_connections_is_not_warmed(http_server, invoke_tool):
+    urls = [http_server.url(f"/idle/{i}.bin?size=100") for i in range(3)]
+    # leaves idle keep-alive connections in the pool of the client
+    invoke_tool("multiple_file_download", url="\n".join(urls), request_timeout="200")
+    opened = count_prewarmed_connections("opened")
+
+    assert warm_connection(http_server.origin, None, False, 200.0, 5.0) is False
+    assert count_prewarmed_connections("opened") == opened
+
+
+def test_downloads_take_over_the_warm_connections(http_server, invoke_tool):
+    # a request timeout of its own starts from a new pooled client without idle connections
+    urls = [http_server.url(f"/warm/{i}.bin?size=100") for i in range(3)]
+    opened, used = count_prewarmed_connections("opened"), count_prewarmed_connections("used")
+    with DownloadSession() as session:
+        session.prewarm([URL(u) for u in urls], None, False, 100.0)
+    wait_for(lambda: count_prewarmed_connections("opened") >= opened + 3)
+
+    result = invoke_tool("multiple_file_download", url="\n".join(urls), request_timeout="100")
+
+    assert len(result.files) == 3
+    assert count_prewarmed_connections("used") > used
+    assert all(r.method == "GET" for r in http_server.requests)
+
+
+def test_unreachable_origin_is_not_warmed(http_server):
+    origin = "http://127.0.0.1:1"
+    started_at = time.monotonic()
+
+    assert warm_connection(origin, None, False, 5.0, 1.0) is False
+    assert time.monotonic() - started_at < 1.5
+
+
+def test_stale_warm_connections_are_closed():
+    class Stream:
+        def __init__(self, is_readable: bool = False):
+            self.is_readable = is_readable
+
+        def get_extra_info(self, info: str):
+            return self.is_readable if info == "is_readable" else None
+
+    warm_streams = WarmStreams(expiry=60)
+    closed_by_server, alive = Stream(is_readable=True), Stream()
+    warm_streams.put("a.com", 80, closed_by_server)
+    warm_streams.put("a.com", 80, alive)
+
+    assert warm_streams.take("a.com", 80) == (alive, [closed_by_server])
+    assert warm_streams.take("a.com", 80) == (None, [])
+
+    warm_streams.expiry = 0
+    expired = Stream()
+    warm_streams.put("b.com", 80, expired)
+    assert warm_streams.take("a.com", 80) == (None, [expired])
+    assert len(warm_streams) == 0
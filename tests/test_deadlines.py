@@ -0,0 +1,61 @@
+import time
+
+import httpx
+import pytest
+
+from tools.utils import deadline_utils
+from tools.utils.deadline_utils import (Deadline, DeadlineExceededError, ThroughputGuard, TransferStalledError,
+                                        get_request_timeout)
+from tools.utils.download_utils import download_to_temp
+
+
+def test_request_timeout_is_split_and_cut_to_the_deadline(monkeypatch):
+    monkeypatch.setattr(deadline_utils, "connect_timeout", 10.0)
+
+    timeout = get_request_timeout(30.0)
+    assert (timeout.connect, timeout.read) == (10.0, 30.0)
+
+    timeout = get_request_timeout(30.0, Deadline(2.0))
+    assert 1.0 < timeout.read <= 2.0
+    assert timeout.connect == timeout.read
+
+    timeout = get_request_timeout(0, Deadline(None))
+    assert (timeout.connect, timeout.read) == (None, None)
+
+
+def test_expired_deadline_sends_no_request(http_server):
+    deadline = Deadline(0.01)
+    time.sleep(0.02)
+
+    with pytest.raises(DeadlineExceededError):
+        download_to_temp("GET", http_server.url("/a.bin?size=100"), deadline=deadline)
+
+    assert not http_server.requests_to("/a.bin")
+
+
+def test_slow_response_is_stopped_at_the_deadline(http_server):
+    http_server.route("/slow.bin", body=b"slow", delay=3.0)
+    started_at = time.monotonic()
+
+    with pytest.raises((DeadlineExceededError, httpx.TimeoutException)):
+        download_to_temp("GET", http_server.url("/slow.bin"), timeout=30, deadline=Deadline(0.5))
+
+    assert time.monotonic() - started_at < 2.0
+    assert len(http_server.requests_to("/slow.bin")) == 1
+
+
+def test_tool_invocation_is_stopped_at_its_deadline(http_server, invoke_tool, monkeypatch):
+    monkeypatch.setattr(deadline_utils.Deadline, "for_invocation", staticmethod(lambda: Deadline(0.5)))
+    http_server.route("/slow.bin", body=b"slow", delay=3.0)
+
+    with pytest.raises((DeadlineExceededError, httpx.TimeoutException)):
+        invoke_tool("multiple_file_download", url=http_server.url("/slow.bin"), request_timeout="30")
+
+
+def test_stalled_transfer_is_aborted():
+    guard = ThroughputGuard("http://example.com/a.bin", min_bytes_per_second=1000, window=0.05)
+    guard.feed(10)
+    time.sleep(0.06)
+
+    with pytest.raises(TransferStalledError):
+        guard.feed(10)
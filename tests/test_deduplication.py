@@ -0,0 +1,74 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from tools.utils.content_utils import content_store
+from tools.utils.single_flight import SingleFlight
+
+BODY = b"identical body" * 1000
+
+
+def test_identical_urls_are_downloaded_once(http_server, invoke_tool):
+    http_server.route("/same.bin", body=BODY, delay=0.2)
+    url = http_server.url("/same.bin")
+
+    result = invoke_tool("multiple_file_download", url="\n".join([url] * 3), output_order="completion")
+
+    assert sorted(meta["index"] for meta, _ in result.files) == [0, 1, 2]
+    assert all(blob == BODY for _, blob in result.files)
+    assert len(http_server.requests_to("/same.bin")) == 1
+
+
+def test_concurrent_invocations_share_the_download(http_server, invoke_tool):
+    http_server.route("/shared.bin", body=BODY, delay=0.5)
+    url = http_server.url("/shared.bin")
+
+    with ThreadPoolExecutor(2) as executor:
+        results = list(executor.map(lambda _: invoke_tool("single_file_download", url=url), range(2)))
+
+    assert [r.files[0][1] for r in results] == [BODY, BODY]
+    assert len(http_server.requests_to("/shared.bin")) == 1
+
+
+def test_failure_is_fanned_out_to_every_index(http_server, invoke_tool):
+    http_server.route("/missing.bin", status=404, delay=0.2)
+    url = http_server.url("/missing.bin")
+
+    result = invoke_tool("multiple_file_download", url="\n".join([url] * 2), failure_mode="partial")
+
+    assert [r["status"] for r in result.jsons[-1]["results"]] == ["failed", "failed"]
+    assert len(http_server.requests_to("/missing.bin")) == 1
+
+
+def test_identical_bodies_are_kept_once(http_server, invoke_tool):
+    # the body of the second URL is kept alive until the first one completes, as the results are ordered
+    http_server.route("/first.bin", body=BODY, delay=0.3)
+    http_server.route("/second.bin", body=BODY)
+    deduplicated_contents = content_store.stats()["deduplicated_contents"]
+
+    result = invoke_tool("multiple_file_download",
+                         url="\n".join([http_server.url("/first.bin"), http_server.url("/second.bin")]))
+
+    assert [blob for _, blob in result.files] == [BODY, BODY]
+    assert content_store.stats()["deduplicated_contents"] == deduplicated_contents + 1
+
+
+def test_download_is_only_cancelled_with_its_last_caller():
+    single_flight = SingleFlight()
+    downloads: list[tuple[dict, Future]] = []
+
+    def submit(arguments: dict) -> Future:
+        downloads.append((arguments, Future()))
+        return downloads[-1][1]
+
+    arguments = {"method": "GET", "url": "http://example.com/file.bin", "cancel_event": threading.Event()}
+    first = single_flight.submit(dict(arguments, idx=0), submit)
+    second = single_flight.submit(dict(arguments, idx=1), submit)
+    assert len(downloads) == 1
+    shared_arguments, download = downloads[0]
+
+    first.cancel()
+    assert not shared_arguments["cancel_event"].is_set()
+    second.cancel()
+    assert shared_arguments["cancel_event"].is_set()
+    assert download.cancelled()
+    assert single_flight.stats()["flights_in_progress"] == 0
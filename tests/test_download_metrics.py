@@ -0,0 +1,80 @@
+import gzip
+import json
+import os
+import urllib.request
+
+import pytest
+
+from tools.utils import download_engine
+from tools.utils.download_metrics import DownloadTrace, metrics_registry, start_metrics_server
+
+
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_dns_is_timed_apart_from_connect(http_server, invoke_tool, monkeypatch, engine):
+    monkeypatch.setattr(download_engine, "download_engine", engine)
+    url = http_server.url("/a.bin?size=1000").replace("127.0.0.1", "localhost")
+
+    # a request timeout of its own opens a new connection with a new pooled client
+    result = invoke_tool("single_file_download", url=url, request_timeout=f"7.{len(engine)}")
+
+    metrics = result.files[0][0]["metrics"]
+    assert metrics["connection_reused"] is False
+    assert {"dns", "connect", "ttfb", "total"} <= set(metrics["timings_ms"])
+    assert 'phase="dns"' in metrics_registry.render_prometheus()
+
+
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_decompression_is_timed_as_the_decode_phase(http_server, invoke_tool, monkeypatch, engine):
+    monkeypatch.setattr(download_engine, "download_engine", engine)
+    body = os.urandom(1000) * 100
+    http_server.route_content("/c.bin", gzip.compress(body), headers=[("content-encoding", "gzip")],
+                              is_ranged=False)
+    http_server.route_content("/plain.bin", body, is_ranged=False)
+
+    compressed = invoke_tool("single_file_download", url=http_server.url("/c.bin"))
+    plain = invoke_tool("single_file_download", url=http_server.url("/plain.bin"))
+
+    assert compressed.files[0][1] == body
+    assert compressed.files[0][0]["metrics"]["timings_ms"]["decode"] > 0
+    assert "decode" not in plain.files[0][0]["metrics"]["timings_ms"]
+
+
+def test_label_values_are_escaped():
+    metrics_registry.inc("test_escaped_labels_total", host='a\\b"c\nd')
+
+    assert 'test_escaped_labels_total{host="a\\\\b\\"c\\nd"} 1' in metrics_registry.render_prometheus()
+
+
+def test_connect_excludes_the_dns_time():
+    trace = DownloadTrace()
+    trace.start_attempt()
+    trace.on_http_event("connection.connect_tcp.started", {})
+    trace.on_dns_resolved(10.0)
+    trace.on_http_event("connection.connect_tcp.complete", {})
+
+    assert trace.timings["dns"] == 10.0
+    assert 0 <= trace.timings["connect"] < 1.0
+
+
+def test_metrics_server_listens_on_loopback_by_default():
+    server = start_metrics_server(0)
+    try:
+        host, port = server.server_address[:2]
+        assert host == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics.json") as response:
+            assert "counters" in json.loads(response.read())
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/unknown")
+        assert e.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_metrics_server_host_is_configurable():
+    server = start_metrics_server(0, host="localhost")
+    try:
+        assert server.server_address[0] in ("127.0.0.1", "::1")
+    finally:
+        server.shutdown()
+        server.server_close()
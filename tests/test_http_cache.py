@@ -0,0 +1,111 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from tests.local_server import LocalResponse
+from tools.utils import download_utils
+from tools.utils.http_cache import ResponseCache
+
+SMALL_BODY = os.urandom(1000)
+LARGE_BODY = os.urandom(2 * 1024 * 1024)
+
+
+@pytest.fixture
+def response_cache(tmp_path, monkeypatch) -> ResponseCache:
+    cache = ResponseCache(str(tmp_path / "cache"), 64 * 1024 * 1024)
+    monkeypatch.setattr(download_utils, "response_cache", cache)
+    return cache
+
+
+def route_revalidated(http_server, path: str, body: bytes):
+    def respond(request):
+        if request.headers.get("if-none-match") == '"v1"':
+            return LocalResponse(304, [("etag", '"v1"')])
+        return LocalResponse(200, [("etag", '"v1"'), ("cache-control", "no-cache")], body)
+
+    http_server.route(path, respond)
+
+
+@pytest.mark.parametrize("body", [SMALL_BODY, LARGE_BODY], ids=["in_memory", "spooled"])
+def test_fresh_entry_is_served_without_request(http_server, invoke_tool, response_cache, body):
+    http_server.route("/fresh.bin", headers=[("cache-control", "max-age=60")], body=body)
+    url = http_server.url("/fresh.bin")
+
+    first = invoke_tool("single_file_download", url=url)
+    second = invoke_tool("single_file_download", url=url)
+
+    assert first.files[0][1] == second.files[0][1] == body
+    assert second.files[0][0]["metrics"]["cached"] is True
+    assert len(http_server.requests_to("/fresh.bin")) == 1
+    stats = response_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["bytes_saved"]) == (1, 1, len(body))
+
+
+def test_stale_entry_is_revalidated(http_server, invoke_tool, response_cache):
+    route_revalidated(http_server, "/stale.bin", SMALL_BODY)
+    url = http_server.url("/stale.bin")
+
+    invoke_tool("single_file_download", url=url)
+    second = invoke_tool("single_file_download", url=url)
+
+    assert second.files[0][1] == SMALL_BODY
+    assert http_server.requests_to("/stale.bin")[-1].headers["if-none-match"] == '"v1"'
+    assert response_cache.stats()["revalidated_hits"] == 1
+
+
+@pytest.mark.parametrize("body", [SMALL_BODY, LARGE_BODY], ids=["in_memory", "spooled"])
+def test_evicted_fresh_body_falls_back_to_download(http_server, invoke_tool, response_cache, monkeypatch, body):
+    http_server.route("/evicted.bin", headers=[("cache-control", "max-age=60")], body=body)
+    url = http_server.url("/evicted.bin")
+    invoke_tool("single_file_download", url=url)
+    evict_after_lookup(response_cache, monkeypatch)
+
+    result = invoke_tool("single_file_download", url=url)
+
+    [(meta, blob)] = result.files
+    assert blob == body
+    assert meta["metrics"]["cached"] is False
+    assert len(http_server.requests_to("/evicted.bin")) == 2
+    # stored again by the fallback download
+    assert response_cache.stats()["entries"] == 1
+
+
+def test_evicted_revalidated_body_falls_back_to_download(http_server, invoke_tool, response_cache, monkeypatch):
+    route_revalidated(http_server, "/evicted-stale.bin", SMALL_BODY)
+    url = http_server.url("/evicted-stale.bin")
+    invoke_tool("single_file_download", url=url)
+    evict_after_lookup(response_cache, monkeypatch)
+
+    result = invoke_tool("single_file_download", url=url)
+
+    assert result.files[0][1] == SMALL_BODY
+    requests = http_server.requests_to("/evicted-stale.bin")
+    # revalidated, then downloaded again without the conditional headers
+    assert [r.headers.get("if-none-match") for r in requests] == [None, '"v1"', None]
+
+
+def evict_after_lookup(cache: ResponseCache, monkeypatch):
+    """
+    Delete the files of the entries right after they are looked up, as a concurrent store evicting them would.
+    """
+    lookup = cache.lookup
+
+    def lookup_and_evict(key):
+        entry = lookup(key)
+        if entry:
+            cache._delete_files(key)
+        return entry
+
+    monkeypatch.setattr(cache, "lookup", lookup_and_evict)
+
+
+def test_stats_are_exported_to_metrics(tmp_path):
+    code = ("import sys; sys.modules.setdefault('trio', None); import dify_plugin; "
+            "from tools.utils.http_cache import response_cache; "
+            "from tools.utils.download_metrics import metrics_registry; "
+            "print(sorted(metrics_registry.collect()['response_cache']))")
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            env={**os.environ, "DOWNLOAD_CACHE_DIR": str(tmp_path)}).stdout
+    assert "'bytes_saved', " in output and "'hits', " in output and "'misses', " in output
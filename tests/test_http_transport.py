@@ -0,0 +1,68 @@
+import httpcore
+import httpx
+import pytest
+from httpx import Limits
+
+from tools.utils.dns_cache import DnsCache
+from tools.utils.http_transport import (AsyncCachingDnsTransport, CachingDnsTransport, create_transport,
+                                        get_env_proxy_urls)
+
+LIMITS = Limits(max_connections=10, max_keepalive_connections=5)
+
+
+def test_transport_connects_through_the_proxy_of_its_scheme():
+    dns_cache = DnsCache(ttl=60)
+    direct = create_transport(dns_cache, verify=True, http2=False, limits=LIMITS)
+    http_proxy = create_transport(dns_cache, verify=True, http2=False, limits=LIMITS,
+                                  proxy_url="http://127.0.0.1:3128")
+    socks_proxy = create_transport(dns_cache, verify=True, http2=False, limits=LIMITS,
+                                   proxy_url="socks5://127.0.0.1:1080")
+    async_direct = create_transport(dns_cache, verify=True, http2=False, limits=LIMITS, is_async=True)
+
+    assert isinstance(direct, CachingDnsTransport) and isinstance(direct.pool, httpcore.ConnectionPool)
+    assert isinstance(http_proxy.pool, httpcore.HTTPProxy)
+    assert isinstance(socks_proxy.pool, httpcore.SOCKSProxy)
+    assert isinstance(async_direct, AsyncCachingDnsTransport)
+    assert isinstance(async_direct.pool, httpcore.AsyncConnectionPool)
+    for transport in (direct, http_proxy, socks_proxy):
+        transport.close()
+
+
+def test_transport_rejects_an_unknown_proxy_scheme():
+    with pytest.raises(ValueError, match="proxy URL"):
+        create_transport(DnsCache(ttl=60), verify=True, http2=False, limits=LIMITS, proxy_url="ftp://127.0.0.1:21")
+
+
+def test_transport_serves_the_requests(http_server):
+    transport = create_transport(DnsCache(ttl=60), verify=True, http2=False, limits=LIMITS)
+    with httpx.Client(transport=transport) as client:
+        response = client.get(http_server.url("/data.bin?size=1000"))
+    assert response.status_code == 200
+    assert len(response.content) == 1000
+
+
+def test_transport_raises_the_httpx_exceptions():
+    transport = create_transport(DnsCache(ttl=60), verify=True, http2=False, limits=LIMITS)
+    with httpx.Client(transport=transport) as client:
+        with pytest.raises(httpx.ConnectError):
+            client.get("http://127.0.0.1:1/")
+
+
+def test_env_proxy_urls(monkeypatch):
+    for name in ("http_proxy", "https_proxy", "all_proxy", "no_proxy",
+                 "HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "NO_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+    assert get_env_proxy_urls() == {}
+
+    monkeypatch.setenv("HTTPS_PROXY", "proxy.internal:3128")
+    monkeypatch.setenv("NO_PROXY", "localhost,127.0.0.1,::1,.example.com")
+    assert get_env_proxy_urls() == {
+        "https://": "http://proxy.internal:3128",
+        "all://localhost": None,
+        "all://127.0.0.1": None,
+        "all://[::1]": None,
+        "all://*.example.com": None,
+    }
+
+    monkeypatch.setenv("NO_PROXY", "*")
+    assert get_env_proxy_urls() == {}
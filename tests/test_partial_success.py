@@ -0,0 +1,43 @@
+import pytest
+
+from tools.utils import deadline_utils
+from tools.utils.deadline_utils import Deadline
+from tools.utils.retry_utils import HttpStatusError
+
+
+def test_failures_are_reported_in_the_summary(http_server, invoke_tool):
+    http_server.route("/missing.bin", status=404)
+    urls = [http_server.url("/a.bin?size=100"), http_server.url("/missing.bin"), http_server.url("/b.bin?size=200")]
+
+    result = invoke_tool("multiple_file_download", url="\n".join(urls), failure_mode="partial")
+
+    assert [len(blob) for _, blob in result.files] == [100, 200]
+    summary = result.jsons[-1]
+    assert (summary["total"], summary["succeeded"], summary["failed"], summary["timeout"]) == (3, 2, 1, 0)
+    assert [r["status"] for r in summary["results"]] == ["succeeded", "failed", "succeeded"]
+    failure = summary["results"][1]
+    assert failure["index"] == 1
+    assert failure["url"] == urls[1]
+    assert failure["http_status_code"] == 404
+    assert failure["error_type"] == HttpStatusError.__name__
+    assert failure["elapsed"] >= 0
+    assert summary["results"][2]["size"] == 200
+
+
+def test_downloads_not_completed_in_time_are_reported_as_timed_out(http_server, invoke_tool, monkeypatch):
+    monkeypatch.setattr(deadline_utils.Deadline, "for_invocation", staticmethod(lambda: Deadline(1.0)))
+    http_server.route("/slow.bin", body=b"slow", delay=3.0)
+    urls = [http_server.url("/slow.bin"), http_server.url("/fast.bin?size=100")]
+
+    result = invoke_tool("multiple_file_download", url="\n".join(urls), failure_mode="partial")
+
+    assert [len(blob) for _, blob in result.files] == [100]
+    assert [r["status"] for r in result.jsons[-1]["results"]] == ["timeout", "succeeded"]
+
+
+def test_first_failure_aborts_the_batch_by_default(http_server, invoke_tool):
+    http_server.route("/missing.bin", status=404)
+    urls = [http_server.url("/missing.bin"), http_server.url("/a.bin?size=100")]
+
+    with pytest.raises(HttpStatusError):
+        invoke_tool("multiple_file_download", url="\n".join(urls))
@@ -0,0 +1,50 @@
+import httpx
+import pytest
+
+from tools.utils import download_engine
+
+FILE_BODY = b"file content " * 10000
+
+
+@pytest.fixture(params=["thread", "asyncio"])
+def engine(request, monkeypatch):
+    monkeypatch.setattr(download_engine, "download_engine", request.param)
+    return request.param
+
+
+def upload(http_server, invoke_tool, file_url: str):
+    # the hosts are only known to the local server acting as the HTTP proxy
+    return invoke_tool("single_file_download",
+                       url="http://upload.invalid/upload",
+                       request_method="POST",
+                       request_body_type="multipart",
+                       request_body_str='{"name": "value"}',
+                       request_files=[{"url": file_url, "filename": "a.txt", "mime_type": "text/plain"}],
+                       proxy_url=http_server.origin,
+                       ssl_certificate_verify=False)
+
+
+def test_multipart_files_are_read_through_the_proxy(http_server, invoke_tool, engine):
+    http_server.route_content("/a.txt", FILE_BODY)
+    http_server.route("/upload", body=b"uploaded")
+
+    result = upload(http_server, invoke_tool, "http://files.invalid/a.txt")
+
+    assert result.files[0][1] == b"uploaded"
+    [request] = http_server.requests_to("/upload")
+    assert request.headers["content-type"].startswith("multipart/form-data; boundary=")
+    assert b'name="name"\r\n\r\nvalue\r\n' in request.body
+    assert b"filename*=UTF-8''a.txt\r\nContent-Type: text/plain\r\n\r\n" + FILE_BODY + b"\r\n" in request.body
+    assert [r.path for r in http_server.requests_to("/a.txt")] == ["http://files.invalid/a.txt"]
+
+
+def test_multipart_upload_fails_on_a_missing_file(http_server, invoke_tool, engine):
+    http_server.route("/missing.txt", status=404)
+    http_server.route("/upload", body=b"uploaded")
+
+    with pytest.raises(httpx.HTTPStatusError, match="404"):
+        upload(http_server, invoke_tool, "http://files.invalid/missing.txt")
+
+    assert [r.path for r in http_server.requests_to("/missing.txt")] == ["http://files.invalid/missing.txt"]
+    # the upload is aborted before the closing boundary of the body
+    assert not any(r.body.endswith(b"--\r\n") for r in http_server.requests_to("/upload"))
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from tools.utils import retry_utils
+from tools.utils.retry_utils import HttpStatusError, RetryableStatusError, parse_retry_after
+
+BODY = os.urandom(200 * 1024)
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(retry_utils, "retry_backoff_base", 0.01)
+
+
+def test_resume_from_last_received_byte(http_server, invoke_tool):
+    http_server.route_content("/resumable.bin", BODY, [("etag", '"v1"')], drop_after=50000)
+
+    result = invoke_tool("single_file_download", url=http_server.url("/resumable.bin"))
+
+    [(meta, blob)] = result.files
+    assert blob == BODY
+    assert meta["metrics"]["retries"] == 1
+    first, second = http_server.requests_to("/resumable.bin")
+    assert "range" not in first.headers
+    # resumed from the bytes received before the connection is closed
+    resume_offset = int(second.headers["range"].removeprefix("bytes=").removesuffix("-"))
+    assert 0 < resume_offset <= 50000
+    assert second.headers["if-range"] == '"v1"'
+
+
+def test_restart_when_not_resumable(http_server, invoke_tool):
+    http_server.route_content("/not-resumable.bin", BODY, is_ranged=False, drop_after=50000)
+
+    result = invoke_tool("single_file_download", url=http_server.url("/not-resumable.bin"))
+
+    assert result.files[0][1] == BODY
+    assert ["range" in r.headers for r in http_server.requests_to("/not-resumable.bin")] == [False, False]
+
+
+def test_retry_transient_status(http_server, invoke_tool):
+    result = invoke_tool("single_file_download", url=http_server.url("/flaky.bin?size=1000&fail_first=2"))
+
+    assert len(result.files[0][1]) == 1000
+    assert len(http_server.requests_to("/flaky.bin")) == 3
+
+
+def test_retries_are_limited(http_server, invoke_tool):
+    with pytest.raises(RetryableStatusError):
+        invoke_tool("single_file_download", url=http_server.url("/down.bin?size=1000&fail_first=100"))
+    assert len(http_server.requests_to("/down.bin")) == retry_utils.max_retries + 1
+
+
+def test_client_error_is_not_retried(http_server, invoke_tool):
+    http_server.route("/missing.bin", status=404)
+    with pytest.raises(HttpStatusError) as e:
+        invoke_tool("single_file_download", url=http_server.url("/missing.bin"))
+    assert e.value.status_code == 404
+    assert len(http_server.requests_to("/missing.bin")) == 1
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
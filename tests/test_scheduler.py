@@ -0,0 +1,156 @@
+import threading
+import time
+
+import pytest
+
+from tools.utils.download_metrics import metrics_registry
+from tools.utils.scheduler import DownloadScheduler, download_scheduler
+
+
+def test_bounded_concurrency():
+    scheduler = DownloadScheduler(max_concurrency=2)
+    lock = threading.Lock()
+    running = []
+    max_running = []
+
+    def job(i: int) -> int:
+        with lock:
+            running.append(i)
+            max_running.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(i)
+        return i
+
+    with scheduler.session() as session:
+        futures = [session.submit(job, i) for i in range(8)]
+        assert [f.result(timeout=5) for f in futures] == list(range(8))
+    assert max(max_running) == 2
+    assert scheduler.stats()["workers"] == 2
+
+
+def test_jobs_submitted_together_run_concurrently():
+    scheduler = DownloadScheduler(max_concurrency=4)
+    with scheduler.session() as session:
+        # leave an idle worker
+        session.submit(time.sleep, 0).result(timeout=5)
+        while scheduler.stats()["running_jobs"]:
+            time.sleep(0.001)
+        barrier = threading.Barrier(2, timeout=5)
+        futures = [session.submit(barrier.wait) for _ in range(2)]
+        assert sorted(f.result(timeout=5) for f in futures) == [0, 1]
+
+
+def test_sessions_are_served_round_robin():
+    scheduler = DownloadScheduler(max_concurrency=1)
+    gate = threading.Event()
+    started = []
+
+    def job(name: str):
+        started.append(name)
+        if name == "gate":
+            gate.wait(5)
+
+    large_session = scheduler.session()
+    small_session = scheduler.session()
+    futures = [large_session.submit(job, "gate")]
+    while not started:
+        time.sleep(0.001)
+    futures += [large_session.submit(job, f"large-{i}") for i in range(5)]
+    futures.append(small_session.submit(job, "small"))
+    gate.set()
+    for future in futures:
+        future.result(timeout=5)
+    # the small batch is not starved by the pending jobs of the large one
+    assert started[:2] == ["gate", "small"]
+    assert started[2:] == [f"large-{i}" for i in range(5)]
+
+
+def test_close_session_cancels_pending_jobs():
+    scheduler = DownloadScheduler(max_concurrency=1)
+    gate = threading.Event()
+    session = scheduler.session()
+    running = session.submit(gate.wait, 5)
+    while not running.running():
+        time.sleep(0.001)
+    pending = [session.submit(time.sleep, 0) for _ in range(3)]
+    session.close()
+    gate.set()
+    assert running.result(timeout=5) is True
+    assert all(f.cancelled() for f in pending)
+    assert scheduler.stats()["cancelled_jobs"] == 3
+    with pytest.raises(RuntimeError):
+        session.submit(time.sleep, 0)
+
+
+def test_job_exception_is_set_on_future():
+    scheduler = DownloadScheduler(max_concurrency=1)
+    with scheduler.session() as session:
+        future = session.submit(int, "not a number")
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+        # the worker survives the failed job
+        assert session.submit(int, "1").result(timeout=5) == 1
+
+
+def test_stats_are_exported_to_metrics():
+    with download_scheduler.session() as session:
+        session.submit(time.sleep, 0).result(timeout=5)
+
+    stats = metrics_registry.snapshot()["stats"]["scheduler"]
+    assert stats["started_jobs"] >= 1
+    assert stats["queue_depth"] == 0
+    prometheus = metrics_registry.render_prometheus()
+    assert "# TYPE download_scheduler_queue_depth gauge" in prometheus
+    assert "download_scheduler_avg_wait_time " in prometheus
+    assert "download_scheduler_wait_seconds_count " in prometheus
+
+
+def test_per_host_concurrency_cap():
+    scheduler = DownloadScheduler(max_concurrency=8, max_concurrency_per_host=2)
+    lock = threading.Lock()
+    running: dict[str, int] = {}
+    max_running: dict[str, int] = {}
+
+    def job(host: str):
+        with lock:
+            running[host] = running.get(host, 0) + 1
+            max_running[host] = max(max_running.get(host, 0), running[host])
+        time.sleep(0.02)
+        with lock:
+            running[host] -= 1
+
+    with scheduler.session() as session:
+        futures = [session.submit_to_host(host, job, host) for host in ["a", "b"] * 6]
+        for future in futures:
+            future.result(timeout=5)
+    assert max_running == {"a": 2, "b": 2}
+
+
+def test_per_host_rate_limit():
+    scheduler = DownloadScheduler(max_concurrency=4, max_requests_per_second_per_host=10)
+    started_at = []
+    with scheduler.session() as session:
+        futures = [session.submit_to_host("a", lambda: started_at.append(time.monotonic())) for _ in range(13)]
+        for future in futures:
+            future.result(timeout=5)
+    # a burst of one second of the budget, then the requests are spaced by 1/10 second
+    assert started_at[9] - started_at[0] < 0.1
+    assert started_at[-1] - started_at[0] >= 3 / 10 * 0.9
+    assert scheduler.stats()["host_throttled_times"] > 0
+
+
+def test_host_jobs_start_by_priority():
+    scheduler = DownloadScheduler(max_concurrency=1)
+    gate = threading.Event()
+    started = []
+    with scheduler.session() as session:
+        blocking = session.submit_to_host("a", gate.wait, 5)
+        while not blocking.running():
+            time.sleep(0.001)
+        futures = [session.submit_to_host("a", started.append, name, priority=priority)
+                   for name, priority in [("large", 10), ("unknown", 0), ("small", 1), ("first", -1)]]
+        gate.set()
+        for future in futures:
+            future.result(timeout=5)
+    assert started == ["first", "unknown", "small", "large"]
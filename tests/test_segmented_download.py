@@ -0,0 +1,102 @@
+import os
+import threading
+
+import httpx
+import pytest
+
+from tools.utils import segmented_download
+from tools.utils.deadline_utils import Deadline
+from tools.utils.retry_utils import RetryableStatusError
+from tools.utils.scheduler import DownloadScheduler, download_scheduler
+from tools.utils.segmented_download import SegmentProgress, download_segment, split_segments
+
+SIZE = 2 * 1024 * 1024
+BODY = os.urandom(SIZE)
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(segmented_download, "segment_count", 4)
+    monkeypatch.setattr(segmented_download, "segment_min_size", 256 * 1024)
+
+
+def test_split_segments_cover_content():
+    segments = split_segments(SIZE + 1)
+    assert len(segments) == 4
+    assert segments[0][0] == 0 and segments[-1][1] == SIZE
+    assert all(end + 1 == start for (_, end), (start, _) in zip(segments, segments[1:]))
+
+
+def test_download_in_segments(http_server, invoke_tool):
+    http_server.route_content("/large.bin", BODY, [("etag", '"v1"')])
+
+    result = invoke_tool("single_file_download", url=http_server.url("/large.bin"))
+
+    [(meta, blob)] = result.files
+    assert blob == BODY
+    assert meta["metrics"]["segmented"] is True
+    range_requests = [r for r in http_server.requests_to("/large.bin") if "range" in r.headers]
+    assert len(range_requests) == 3
+    assert all(r.headers["if-range"] == '"v1"' for r in range_requests)
+
+
+@pytest.mark.parametrize("max_concurrency_per_host, range_request_count", [(2, 1), (1, 0)])
+def test_segments_take_the_slots_of_the_host(http_server, invoke_tool, monkeypatch,
+                                             max_concurrency_per_host, range_request_count):
+    http_server.route_content("/capped.bin", BODY, [("etag", '"v1"')])
+    # the download itself takes one of the slots
+    monkeypatch.setattr(download_scheduler, "max_concurrency_per_host", max_concurrency_per_host)
+
+    result = invoke_tool("single_file_download", url=http_server.url("/capped.bin"))
+
+    assert result.files[0][1] == BODY
+    range_requests = [r for r in http_server.requests_to("/capped.bin") if "range" in r.headers]
+    assert len(range_requests) == range_request_count
+    assert download_scheduler.stats()["active_hosts"] == 0
+
+
+def test_extra_host_slots_are_bounded_by_the_concurrency_and_rate_limits():
+    scheduler = DownloadScheduler(max_concurrency=8, max_concurrency_per_host=4)
+    assert scheduler.try_acquire_host("http://a.com", 5) == 4
+    assert scheduler.try_acquire_host("http://a.com", 1) == 0
+    scheduler.release_host("http://a.com", 4)
+    assert scheduler.stats()["active_hosts"] == 0
+
+    rate_limited = DownloadScheduler(max_concurrency=8, max_concurrency_per_host=4, max_requests_per_second_per_host=2)
+    # the token bucket holds a burst of 2 requests
+    assert rate_limited.try_acquire_host("http://a.com", 3) == 2
+    rate_limited.release_host("http://a.com", 2)
+
+
+def test_weak_etag_is_not_used_for_if_range(http_server, invoke_tool):
+    last_modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+    http_server.route_content("/weak.bin", BODY, [("etag", 'W/"v1"'), ("last-modified", last_modified)])
+
+    result = invoke_tool("single_file_download", url=http_server.url("/weak.bin"))
+
+    assert result.files[0][1] == BODY
+    range_requests = [r for r in http_server.requests_to("/weak.bin") if "range" in r.headers]
+    assert len(range_requests) == 3
+    assert all(r.headers["if-range"] == last_modified for r in range_requests)
+
+
+def test_segment_is_not_retried_after_deadline(http_server, tmp_path):
+    # the deadline passes while waiting for the response
+    http_server.route("/failing.bin", status=503, headers=[("retry-after", "0")], delay=0.1)
+    segment = SegmentProgress(start=0, end=99, offset=0)
+    with open(tmp_path / "segment.bin", "wb") as file, httpx.Client() as client:
+        with pytest.raises(RetryableStatusError):
+            download_segment(client, http_server.url("/failing.bin"), {}, httpx.Timeout(5), file.fileno(),
+                             segment, lambda: False, threading.Event(), Deadline(0.05))
+    assert len(http_server.requests_to("/failing.bin")) == 1
+
+
+def test_segment_is_retried_before_deadline(http_server, tmp_path):
+    http_server.route_content("/segment.bin", BODY[:100], [("etag", '"v1"')], drop_after=50)
+    segment = SegmentProgress(start=0, end=99, offset=0)
+    with open(tmp_path / "segment.bin", "w+b") as file, httpx.Client() as client:
+        download_segment(client, http_server.url("/segment.bin"), {}, httpx.Timeout(5), file.fileno(),
+                         segment, lambda: False, threading.Event(), Deadline(30))
+        assert file.read() == BODY[:100]
+    # resumed from the last received byte
+    assert http_server.requests_to("/segment.bin")[-1].headers["range"] == "bytes=50-99"
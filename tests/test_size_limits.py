@@ -0,0 +1,49 @@
+import pytest
+
+from tools.utils.quota_utils import DownloadSizeExceededError, DownloadSizeLimiter, SizeLimit
+
+MB = 1024 * 1024
+
+
+def test_oversize_file_is_aborted(http_server, invoke_tool):
+    with pytest.raises(DownloadSizeExceededError):
+        invoke_tool("single_file_download", url=http_server.url("/large.bin?size=2097152"), max_file_size_mb="1")
+
+
+def test_oversize_file_without_content_length_is_aborted(http_server, invoke_tool):
+    # the size is only known while streaming
+    http_server.route("/chunked.bin", headers=[("transfer-encoding", "chunked")],
+                      body=b"%x\r\n%s\r\n0\r\n\r\n" % (2 * MB, b"x" * 2 * MB))
+    with pytest.raises(DownloadSizeExceededError):
+        invoke_tool("single_file_download", url=http_server.url("/chunked.bin"), max_file_size_mb="1")
+
+
+def test_oversize_file_is_truncated(http_server, invoke_tool):
+    result = invoke_tool("single_file_download", url=http_server.url("/large.bin?size=2097152"),
+                         max_file_size_mb="1", oversize_action="truncate")
+
+    [(meta, blob)] = result.files
+    assert meta["truncated"] is True
+    assert len(blob) == meta["size"] == MB
+
+
+def test_total_size_is_shared_by_the_invocation(http_server, invoke_tool):
+    urls = [http_server.url(f"/file-{i}.bin?size=400000&id={i}") for i in range(3)]
+
+    result = invoke_tool("multiple_file_download", url="\n".join(urls),
+                         max_total_size_mb="1", oversize_action="truncate")
+
+    sizes = [len(blob) for _, blob in result.files]
+    assert sum(sizes) == MB
+    # the concurrent downloads share the budget as they stream
+    assert any(meta.get("truncated") for meta, _ in result.files)
+
+
+def test_limiter_releases_the_quota_on_reset():
+    size_limit = SizeLimit.create(0, 100, is_truncating=False)
+    limiter = DownloadSizeLimiter("http://example.com/a", size_limit)
+    assert limiter.accept(80) == 80
+    with pytest.raises(DownloadSizeExceededError):
+        DownloadSizeLimiter("http://example.com/b", size_limit).accept(30)
+    limiter.reset()
+    assert DownloadSizeLimiter("http://example.com/b", size_limit).accept(30) == 30
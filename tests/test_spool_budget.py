@@ -0,0 +1,146 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from tools.utils.deadline_utils import size_hints
+from tools.utils.scheduler import download_scheduler
+from concurrent.futures import Future
+
+from tools.utils.spool_manager import (OutputOrder, SpoolManager, get_host_id, get_process_owner_id,
+                                       get_process_start_time, spool_manager)
+
+FILE_SIZE = 2 * 1024 * 1024
+
+
+def test_ordered_results_complete_with_a_budget_of_less_than_two_files(http_server, invoke_tool, monkeypatch):
+    bodies = [os.urandom(FILE_SIZE) for _ in range(4)]
+    for i, body in enumerate(bodies):
+        http_server.route_content(f"/file{i}.bin", body)
+    monkeypatch.setattr(spool_manager, "max_size", 3 * 1024 * 1024)
+    urls = [http_server.url(f"/file{i}.bin") for i in range(len(bodies))]
+    # the first file is known to be the largest, so it is started last, after the others completed one by one
+    monkeypatch.setattr(download_scheduler, "max_concurrency_per_host", 1)
+    size_hints.record(urls[0], 100 * FILE_SIZE)
+
+    result = invoke_tool("multiple_file_download", url="\n".join(urls), output_order="input", request_timeout="10")
+
+    assert [blob for _, blob in result.files] == bodies
+
+
+def test_ordered_results_complete_with_the_budget_held_by_other_files(http_server, invoke_tool, monkeypatch):
+    bodies = [os.urandom(FILE_SIZE) for _ in range(3)]
+    for i, body in enumerate(bodies):
+        http_server.route_content(f"/held{i}.bin", body)
+    monkeypatch.setattr(spool_manager, "max_size", FILE_SIZE)
+    # e.g. the results of another invocation not yet yielded
+    held_file = spool_manager.create(FILE_SIZE)
+    exempted_times = spool_manager.stats()["exempted_times"]
+    urls = [http_server.url(f"/held{i}.bin") for i in range(len(bodies))]
+
+    try:
+        result = invoke_tool("multiple_file_download", url="\n".join(urls), output_order="input",
+                             request_timeout="10")
+    finally:
+        held_file.file.close()
+        spool_manager.delete(held_file.path)
+
+    assert [blob for _, blob in result.files] == bodies
+    # each download starts once the ones before it are completed
+    assert spool_manager.stats()["exempted_times"] - exempted_times == len(bodies)
+
+
+def test_completed_files_are_kept_in_the_budget(tmp_path):
+    manager = SpoolManager(spool_dir=str(tmp_path), max_size=FILE_SIZE, reap_interval=0)
+    spool_file = manager.create(FILE_SIZE)
+    spool_file.file.close()
+    manager.track(spool_file.path, FILE_SIZE)
+    assert not manager.has_space()
+
+    manager.delete(spool_file.path)
+    assert manager.has_space()
+    assert manager.stats()["reserved_size"] == 0
+    assert not os.path.exists(spool_file.path)
+
+
+def test_download_next_in_the_output_order_does_not_wait(tmp_path):
+    manager = SpoolManager(spool_dir=str(tmp_path), max_size=FILE_SIZE, reap_interval=0)
+    manager.create(FILE_SIZE)
+    output_order = OutputOrder()
+    first, second = Future(), Future()
+    output_order.add(first)
+    output_order.add(second)
+    cancel_event = threading.Event()
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(
+        manager.wait_for_space(cancel_event, is_exempt=lambda: output_order.is_unblocked(1))))
+
+    # the head of the output order starts over the budget
+    assert manager.wait_for_space(cancel_event, is_exempt=lambda: output_order.is_unblocked(0))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()
+    # unblocked once the download before it is completed
+    first.set_result(None)
+    waiter.join(5)
+    assert waited == [True]
+    assert manager.stats()["exempted_times"] == 2
+
+
+def test_waiting_for_space_is_cancelled(tmp_path):
+    manager = SpoolManager(spool_dir=str(tmp_path), max_size=FILE_SIZE, reap_interval=0)
+    spool_file = manager.create(FILE_SIZE)
+    cancel_event = threading.Event()
+    cancel_event.set()
+
+    assert not manager.wait_for_space(cancel_event)
+
+    manager.delete(spool_file.path)
+    assert manager.wait_for_space(cancel_event)
+
+
+
+def create_spool_file(directory, owner_id: str, age: float = 0.0) -> str:
+    path = os.path.join(directory, f"dl-{owner_id}-{uuid.uuid4().hex}.spool")
+    with open(path, "wb") as f:
+        f.write(b"x")
+    if age:
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_reaper_deletes_the_files_of_dead_processes_of_this_host(tmp_path):
+    manager = SpoolManager(spool_dir=str(tmp_path), reap_interval=0, orphan_age=3600)
+    host_id, parent_pid = get_host_id(), os.getppid()
+    dead_process = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead_process.wait()
+    live = create_spool_file(tmp_path, f"{host_id}-{parent_pid}-{get_process_start_time(parent_pid) or 0}")
+    dead = create_spool_file(tmp_path, f"{host_id}-{dead_process.pid}-0")
+    # the PID of the creating process reused by a process started later
+    reused = create_spool_file(tmp_path, f"{host_id}-{parent_pid}-1")
+    untracked = create_spool_file(tmp_path, get_process_owner_id())
+    old_untracked = create_spool_file(tmp_path, get_process_owner_id(), age=7200)
+
+    manager.reap()
+
+    assert os.path.exists(live) and os.path.exists(untracked)
+    assert not os.path.exists(dead) and not os.path.exists(old_untracked)
+    assert os.path.exists(reused) == (get_process_start_time(parent_pid) is None)
+
+
+def test_reaper_keeps_the_recent_files_of_other_hosts(tmp_path):
+    manager = SpoolManager(spool_dir=str(tmp_path), reap_interval=0, orphan_age=3600)
+    # the PIDs of another host or container are not of this PID namespace
+    other_host = create_spool_file(tmp_path, "0123456789ab-999999-0")
+    old_other_host = create_spool_file(tmp_path, "0123456789ab-999999-0", age=7200)
+    old_unnamed_host = os.path.join(tmp_path, f"dl-999999-{uuid.uuid4().hex}.spool")
+    open(old_unnamed_host, "wb").close()
+    os.utime(old_unnamed_host, (time.time() - 7200, time.time() - 7200))
+
+    assert manager.reap() == 2
+
+    assert os.path.exists(other_host)
+    assert not os.path.exists(old_other_host) and not os.path.exists(old_unnamed_host)
@@ -0,0 +1,54 @@
+import os
+
+from tools.utils.content_utils import SpooledContentFile
+from tools.utils.spool_manager import spool_manager
+
+LARGE_SIZE = 3 * 1024 * 1024
+
+
+def test_small_file_is_kept_in_memory(http_server, invoke_tool):
+    files_before = spool_manager.stats()["files"]
+
+    result = invoke_tool("single_file_download", url=http_server.url("/small.bin?size=1000"))
+
+    assert [m.type.value for m in result.messages] == ["blob"]
+    assert len(result.files[0][1]) == 1000
+    assert spool_manager.stats()["files"] == files_before
+
+
+def test_large_file_is_streamed_from_disk_in_chunks(http_server, invoke_tool):
+    body = os.urandom(LARGE_SIZE)
+    http_server.route("/large.bin", body=body)
+    files_before = spool_manager.stats()["files"]
+
+    result = invoke_tool("single_file_download", url=http_server.url("/large.bin"))
+
+    assert {m.type.value for m in result.messages} == {"blob_chunk"}
+    [(meta, blob)] = result.files
+    assert blob == body
+    assert meta["size"] == LARGE_SIZE
+    # the spooled file is deleted once sent
+    assert spool_manager.stats()["files"] == files_before
+
+
+def test_spooled_file_rolls_over_to_disk():
+    file = SpooledContentFile(max_memory_size=10)
+    file.write(b"0123456789")
+    assert not file.is_rolled_over
+    file.write(b"abc")
+    assert file.is_rolled_over and os.path.exists(file.file_path)
+
+    content = file.to_content()
+    try:
+        assert not content.is_in_memory
+        assert b"".join(content.iter_chunks(4)) == b"0123456789abc"
+    finally:
+        content.release()
+    assert not os.path.exists(content.file_path)
+
+
+def test_discarded_file_is_deleted():
+    file = SpooledContentFile(max_memory_size=10)
+    file.write(b"x" * 100)
+    file.discard()
+    assert not os.path.exists(file.file_path)
@@ -0,0 +1,29 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# run in a fresh interpreter, as the test process has already loaded the HTTP stack
+LOAD_PLUGIN_SCRIPT = """
+import json, sys
+sys.modules.setdefault("trio", None)
+import dify_plugin
+sdk_modules = set(sys.modules)
+from benchmarks.bench_startup import HEAVY_MODULES, load_plugin_classes
+load_plugin_classes()
+loaded_on_startup = [m for m in HEAVY_MODULES if m in sys.modules and m not in sdk_modules]
+from tools.utils.client_pool import client_holder
+client_holder.release(client_holder.acquire(None, True, 5.0))
+print(json.dumps({"startup": loaded_on_startup, "first_client": "httpcore" in sys.modules}))
+"""
+
+
+def test_http_stack_is_loaded_by_the_first_client_only():
+    completed = subprocess.run([sys.executable, "-c", LOAD_PLUGIN_SCRIPT], cwd=ROOT_DIR,
+                               capture_output=True, text=True, timeout=120)
+
+    assert completed.returncode == 0, completed.stderr
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    assert result == {"startup": [], "first_client": True}
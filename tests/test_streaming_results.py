@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+from tools.multiple_file_download.multiple_file_download import MultipleFileDownloadTool
+from tools.utils.retry_utils import HttpStatusError
+
+
+def test_results_are_yielded_in_input_order(http_server, invoke_tool):
+    urls = [http_server.url("/slow.bin?size=1000&latency_ms=200"), http_server.url("/fast.bin?size=2000")]
+
+    result = invoke_tool("multiple_file_download", url="\n".join(urls))
+
+    assert [len(blob) for _, blob in result.files] == [1000, 2000]
+
+
+def test_results_are_yielded_in_completion_order(http_server, invoke_tool):
+    urls = [http_server.url("/slow.bin?size=1000&latency_ms=200"), http_server.url("/fast.bin?size=2000")]
+
+    result = invoke_tool("multiple_file_download", url="\n".join(urls), output_order="completion")
+
+    assert [(meta["index"], len(blob)) for meta, blob in result.files] == [(1, 2000), (0, 1000)]
+
+
+def test_first_result_is_yielded_before_the_others_complete(http_server):
+    urls = [http_server.url("/fast.bin?size=1000"), http_server.url("/slow.bin?size=1000&latency_ms=500")]
+    messages = MultipleFileDownloadTool.from_credentials({})._invoke({"url": "\n".join(urls)})
+
+    started_at = time.monotonic()
+    first = next(messages)
+    assert time.monotonic() - started_at < 0.4
+    assert len(first.message.blob) == 1000
+    assert len(list(messages)) == 1
+
+
+def test_fail_fast_on_first_error(http_server, invoke_tool):
+    http_server.route("/missing.bin", status=404)
+    urls = [http_server.url("/missing.bin"), http_server.url("/ok.bin?size=1000")]
+
+    with pytest.raises(HttpStatusError):
+        invoke_tool("multiple_file_download", url="\n".join(urls))
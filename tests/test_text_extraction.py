@@ -0,0 +1,44 @@
+import pytest
+
+from tools.utils.text_extraction import TextExtractOptions, extract_text
+
+
+def extract_html(html: str, max_chars: int = 0) -> tuple[str, bool]:
+    return extract_text([html.encode("utf-8")], TextExtractOptions(max_chars=max_chars), "text/html")
+
+
+@pytest.mark.parametrize("html", [
+    "<head><meta charset=utf-8><title>T</title><body><p>Hello world</p>",
+    "<head><meta charset=utf-8><title>T</title><p>Hello world</p>",
+    "<head><title>T</title><link rel=stylesheet href=a.css/><img src=a.png/>Hello world",
+    "<html><head><title>T</title></head>Hello world</html>",
+    "<head><title>T</title>Hello world",
+])
+def test_body_without_closing_head_is_kept(html):
+    text, _ = extract_html(html)
+    assert text.startswith("T")
+    assert "Hello world" in text
+
+
+def test_head_contents_and_boilerplate_are_skipped():
+    html = ("<html><head><title>Title</title><style>p {}</style><script>var x;</script></head>"
+            "<body><nav>Menu</nav><header><h1>Heading</h1></header><p>Text</p>"
+            "<form><label>Name</label><button>Send</button></form><footer>Footer</footer></body></html>")
+
+    text, _ = extract_html(html)
+
+    assert text.split() == ["Title", "Heading", "Text", "Name"]
+
+
+def test_text_is_cut_off_at_the_max_chars():
+    text, is_cut_off = extract_html("<p>" + "a" * 100 + "</p>", max_chars=10)
+    assert (text, is_cut_off) == ("a" * 10, True)
+
+
+def test_html_text_is_downloaded(http_server, invoke_tool):
+    html = b"<head><meta charset=utf-8><title>T</title><body><p>Hello world</p>"
+    http_server.route("/page.html", headers=[("content-type", "text/html")], body=html)
+
+    result = invoke_tool("download_to_text", url=http_server.url("/page.html"))
+
+    assert "Hello world" in result.texts[0]
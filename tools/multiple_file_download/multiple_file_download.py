@@ -1,13 +1,14 @@
 import threading
 from collections.abc import Generator
-from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures._base import DoneAndNotDoneFutures, wait, FIRST_EXCEPTION
 from typing import Any
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
-from tools.utils.download_utils import download_to_temp, handle_all_done, handle_partial_done
+from tools.utils.bundle_utils import DownloadBundle
+from tools.utils.deadline_utils import Deadline
+from tools.utils.download_engine import DownloadSession
+from tools.utils.download_utils import handle_futures_as_completed
 from tools.utils.param_utils import parse_common_params
 
 
@@ -21,45 +22,55 @@ class MultipleFileDownloadTool(Tool):
             raise ValueError("Missing or invalid 'url' parameter. It must be a list of URLs.")
 
         futures = []
+        # index and URL of the input of each future
+        download_inputs = []
         cancel_event = threading.Event()
-        with ThreadPoolExecutor() as executor:
-            try:
-                for idx, url in enumerate(urls):
-                    if not url or url.scheme not in ["http", "https"]:
-                        continue
+        # shared by all the downloads of the invocation
+        size_limit = params.create_size_limit()
+        request_body = params.create_request_body()
+        deadline = Deadline.for_invocation()
+        is_ordered = tool_parameters.get("output_order", "input") != "completion"
+        with DownloadSession(is_ordered=is_ordered) as session:
+            # open the connections to the origins with several URLs ahead of dispatching the downloads
+            session.prewarm(urls, params.proxy_url, params.ssl_certificate_verify, params.request_timeout, deadline)
+            for idx, url in enumerate(urls):
+                if not url or url.scheme not in ["http", "https"]:
+                    continue
 
-                    custom_output_filename = custom_output_filenames[idx] \
-                        if idx < len(custom_output_filenames) and custom_output_filenames[idx] else None
+                custom_output_filename = custom_output_filenames[idx] \
+                    if idx < len(custom_output_filenames) and custom_output_filenames[idx] else None
 
-                    # print(f"{idx} : {custom_output_filename}, {url}")
+                # print(f"{idx} : {custom_output_filename}, {url}")
 
-                    future = executor.submit(
-                        download_to_temp,
-                        params.request_method,
-                        str(url),
-                        params.request_timeout,
-                        params.ssl_certificate_verify,
-                        params.request_headers,
-                        params.request_body_str,
-                        params.proxy_url,
-                        cancel_event,
-                        custom_output_filename,
-                        idx=idx,
-                    )
-                    futures.append(future)
+                future = session.submit_download(
+                    str(url.origin()),
+                    params.request_method,
+                    str(url),
+                    params.request_timeout,
+                    params.ssl_certificate_verify,
+                    params.request_headers,
+                    request_body,
+                    params.proxy_url,
+                    cancel_event,
+                    custom_output_filename,
+                    idx=idx,
+                    size_limit=size_limit,
+                    deadline=deadline,
+                    checksum_algorithms=params.checksum_algorithms,
+                    expected_checksums=params.get_expected_checksums(idx),
+                )
+                futures.append(future)
+                download_inputs.append((idx, str(url)))
 
-                # Wait for all futures to complete or for first exception to occur
-                waited: DoneAndNotDoneFutures = wait(
-                    futures,
-                    timeout=params.request_timeout * 30,
-                    return_when=FIRST_EXCEPTION)
-                done = waited.done
-                not_done = waited.not_done
-                if not_done and len(not_done) > 0:
-                    handle_partial_done(cancel_event, done, not_done)
-                else:
-                    yield from handle_all_done(self, done)
-            finally:
-                # Force shutdown the executor if an exception occurs
-                if executor:
-                    executor.shutdown(wait=False, cancel_futures=True)
+            # Yield the downloaded results as soon as they complete,
+            # and either fail fast on the first exception or report the outcome of each download in a summary
+            yield from handle_futures_as_completed(
+                self,
+                futures,
+                cancel_event,
+                deadline=deadline,
+                is_ordered=is_ordered,
+                is_partial_success=tool_parameters.get("failure_mode", "fail_fast") == "partial",
+                download_inputs=download_inputs,
+                bundle=DownloadBundle.create(tool_parameters.get("output_format")),
+            )
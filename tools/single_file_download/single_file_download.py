@@ -1,12 +1,13 @@
 from collections.abc import Generator
-from pathlib import Path
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from typing import Any
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
-from tools.utils.download_utils import download_to_temp
-from tools.utils.file_utils import force_delete_path
+from tools.utils.deadline_utils import Deadline, DeadlineExceededError
+from tools.utils.download_engine import DownloadSession
+from tools.utils.download_utils import create_download_messages
 from tools.utils.param_utils import parse_common_params
 
 
@@ -20,25 +21,27 @@ class SingleFileDownloadTool(Tool):
         if url.scheme not in ["http", "https"]:
             raise ValueError("Invalid URL format. URL must start with 'http://' or 'https://'.")
 
-        _, file_path, mime_type, filename, _ = download_to_temp(
-            method=params.request_method,
-            url=str(url),
-            timeout=params.request_timeout,
-            ssl_certificate_verify=params.ssl_certificate_verify,
-            request_headers=params.request_headers,
-            request_body=params.request_body_str,
-            proxy_url=params.proxy_url,
-            custom_filename=custom_output_filename,
-        )
-        try:
-            downloaded_file_bytes = Path(file_path).read_bytes()
-            yield self.create_blob_message(
-                blob=downloaded_file_bytes,
-                meta={
-                    "mime_type": mime_type,
-                    "filename": custom_output_filename or filename,
-                }
+        deadline = Deadline.for_invocation()
+        with DownloadSession() as session:
+            future = session.submit_download(
+                str(url.origin()),
+                method=params.request_method,
+                url=str(url),
+                timeout=params.request_timeout,
+                ssl_certificate_verify=params.ssl_certificate_verify,
+                request_headers=params.request_headers,
+                request_body=params.create_request_body(),
+                proxy_url=params.proxy_url,
+                custom_filename=custom_output_filename,
+                size_limit=params.create_size_limit(),
+                checksum_algorithms=params.checksum_algorithms,
+                expected_checksums=params.get_expected_checksums(0),
+                deadline=deadline,
             )
-        finally:
-            # Clean up the downloaded temporary file
-            force_delete_path(file_path)
+            try:
+                result = future.result(timeout=deadline.remaining())
+            except FuturesTimeoutError:
+                future.cancel()
+                raise DeadlineExceededError(f"Deadline of {deadline} exceeded while downloading {url}")
+        # the downloaded content is released after the message is yielded
+        yield from create_download_messages(self, result)
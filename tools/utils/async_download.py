@@ -0,0 +1,502 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from dataclasses import dataclass, field
+from collections.abc import AsyncIterable, Iterable
+from typing import Any, Callable, Coroutine, Optional, Mapping, Union
+
+from httpx import AsyncClient, Timeout
+
+from tools.utils.client_pool import client_holder
+from tools.utils.content_utils import SpooledContentFile, DownloadedContent
+from tools.utils.deadline_utils import Deadline, ThroughputGuard, get_request_timeout
+from tools.utils.download_metrics import DownloadTrace, metrics_registry, current_download_trace
+from tools.utils.download_utils import patch_request_headers, lookup_cache_entry, serve_cached_content, \
+    finish_downloaded_content, get_attempt_headers, prepare_file_for_response, write_chunk_to_file, ResumeState, \
+    get_hash_algorithms, finish_download_trace, release_result_value
+from tools.utils.env_utils import get_env_int, get_env_float
+from tools.utils.http_cache import CacheEntry
+from tools.utils.quota_utils import SizeLimit, DownloadSizeLimiter
+from tools.utils.request_body import RequestBody, as_request_body
+from tools.utils.retry_utils import max_retries, is_retryable_error, get_retry_delay, check_response_status
+from tools.utils.scheduler import DEFAULT_MAX_CONCURRENCY_PER_HOST
+from tools.utils.spool_manager import spool_manager
+from tools.utils.text_extraction import TextExtractOptions
+
+DEFAULT_ASYNC_MAX_CONCURRENCY = 256
+# size of the chunks read from the responses, each written to a spooled file by a call on the executor
+ASYNC_WRITE_CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class _AsyncJob:
+    future: Future
+    fn: Callable[..., Coroutine[Any, Any, Any]]
+    args: tuple
+    kwargs: dict
+    host: Optional[str] = None
+    # jobs with a lower priority are started first
+    priority: float = 0.0
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started: bool = False
+
+
+class _AsyncPrioritySlots:
+    """
+    Semaphore of the global download slots, handing the released slots to the waiting jobs
+    in the order of their priority, then in the order of waiting, only used on the event loop.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.available = max_concurrency
+        self._waiters: list[tuple[float, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    async def acquire(self, priority: float):
+        if self.available > 0 and not self._waiters:
+            self.available -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # cancelled right after being handed a slot
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.available += 1
+
+
+class _AsyncHostLimiter:
+    """
+    Concurrency cap and request rate spacing of a single host, only used on the event loop.
+    """
+
+    def __init__(self, max_concurrency: int, rate_limit: float):
+        self.semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self.rate_limit = rate_limit
+        # event loop time when the next request to the host is allowed by the rate limit
+        self.next_start = 0.0
+        # number of jobs waiting for or holding the host
+        self.users = 0
+        self.throttled_times = 0
+
+    async def acquire(self):
+        if self.semaphore:
+            await self.semaphore.acquire()
+        try:
+            if self.rate_limit > 0:
+                now = asyncio.get_running_loop().time()
+                start = max(now, self.next_start)
+                self.next_start = start + 1 / self.rate_limit
+                if start > now:
+                    self.throttled_times += 1
+                    await asyncio.sleep(start - now)
+        except:
+            self.release()
+            raise
+
+    def release(self):
+        if self.semaphore:
+            self.semaphore.release()
+
+
+class AsyncDownloadSession:
+    """
+    A group of download tasks submitted by one tool invocation.
+    Tasks of the session not started yet are cancelled when the session is closed.
+    """
+
+    def __init__(self, engine: "AsyncDownloadEngine", session_id: int):
+        self.engine = engine
+        self.session_id = session_id
+        self._jobs: list[_AsyncJob] = []
+
+    def submit(self, fn: Callable[..., Coroutine[Any, Any, Any]], *args, **kwargs) -> Future:
+        return self.submit_to_host(None, fn, *args, **kwargs)
+
+    def submit_to_host(self,
+                       host: Optional[str],
+                       fn: Callable[..., Coroutine[Any, Any, Any]],
+                       *args,
+                       priority: float = 0.0,
+                       **kwargs) -> Future:
+        """
+        Submit a coroutine function bound to a host, which is subject to the per-host concurrency and rate limits.
+        :param priority: pending jobs with a lower priority are started first
+        """
+        job = _AsyncJob(future=Future(), fn=fn, args=args, kwargs=kwargs, host=host, priority=priority)
+        self._jobs.append(job)
+        self.engine.submit(job)
+        return job.future
+
+    def close(self):
+        for job in self._jobs:
+            if not job.started:
+                job.future.cancel()
+        self._jobs.clear()
+
+    def __enter__(self) -> "AsyncDownloadSession":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncDownloadEngine:
+    """
+    Process-wide asyncio event loop running the downloads of all tool invocations as tasks on a single thread,
+    instead of blocking a worker thread for each download.
+    Cancelling the future of a download cancels its task, without polling a cancel event between chunks.
+    """
+
+    def __init__(self,
+                 max_concurrency: int,
+                 max_concurrency_per_host: int = 0,
+                 max_requests_per_second_per_host: float = 0,
+                 ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_concurrency_per_host = max(0, max_concurrency_per_host)
+        self.max_requests_per_second_per_host = max(0.0, max_requests_per_second_per_host)
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots: Optional[_AsyncPrioritySlots] = None
+        self._hosts: dict[str, _AsyncHostLimiter] = {}
+        self._session_ids = itertools.count(1)
+        self._running_jobs = 0
+        # stats
+        self._submitted_jobs = 0
+        self._started_jobs = 0
+        self._cancelled_jobs = 0
+        self._host_throttled_times = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._run_loop,
+                    args=(self._loop,),
+                    name="download-event-loop",
+                    daemon=True).start()
+            return self._loop
+
+    @staticmethod
+    def _run_loop(loop: asyncio.AbstractEventLoop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def session(self) -> AsyncDownloadSession:
+        return AsyncDownloadSession(self, next(self._session_ids))
+
+    def spawn(self, fn: Callable[..., Coroutine[Any, Any, Any]], *args) -> Future:
+        """
+        Run a coroutine function on the event loop in the background, outside of the concurrency and host limits,
+        e.g. opening the connections ahead of the downloads.
+        """
+        return asyncio.run_coroutine_threadsafe(fn(*args), self._ensure_loop())
+
+    def submit(self, job: _AsyncJob):
+        loop = self._ensure_loop()
+        with self._lock:
+            self._submitted_jobs += 1
+        loop.call_soon_threadsafe(self._start_task, job)
+
+    def _start_task(self, job: _AsyncJob):
+        # on the event loop
+        if job.future.cancelled():
+            self._cancelled_jobs += 1
+            return
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(self._run_job(job))
+        # cancel the task when the future is cancelled from another thread
+        job.future.add_done_callback(
+            lambda f: loop.call_soon_threadsafe(task.cancel) if f.cancelled() else None)
+        task.add_done_callback(lambda t: self._on_task_done(job, t))
+
+    async def _run_job(self, job: _AsyncJob) -> Any:
+        if self._slots is None:
+            self._slots = _AsyncPrioritySlots(self.max_concurrency)
+        host_limiter = self._host_limiter(job.host) if job.host is not None else None
+        try:
+            # wait for the host before taking a global slot, so that a busy host does not block the others
+            if host_limiter:
+                await host_limiter.acquire()
+            try:
+                await self._slots.acquire(job.priority)
+                try:
+                    job.started = True
+                    wait_time = time.monotonic() - job.enqueued_at
+                    self._started_jobs += 1
+                    self._total_wait_time += wait_time
+                    self._max_wait_time = max(self._max_wait_time, wait_time)
+                    self._running_jobs += 1
+                    metrics_registry.observe("async_engine_wait_seconds", wait_time)
+                    try:
+                        return await job.fn(*job.args, **job.kwargs)
+                    finally:
+                        self._running_jobs -= 1
+                finally:
+                    self._slots.release()
+            finally:
+                if host_limiter:
+                    host_limiter.release()
+        except asyncio.CancelledError:
+            if not job.started:
+                self._cancelled_jobs += 1
+            raise
+        finally:
+            if host_limiter:
+                self._release_host_limiter(job.host, host_limiter)
+
+    def _host_limiter(self, host: str) -> _AsyncHostLimiter:
+        host_limiter = self._hosts.get(host)
+        if host_limiter is None:
+            host_limiter = _AsyncHostLimiter(self.max_concurrency_per_host, self.max_requests_per_second_per_host)
+            self._hosts[host] = host_limiter
+        host_limiter.users += 1
+        return host_limiter
+
+    def _release_host_limiter(self, host: str, host_limiter: _AsyncHostLimiter):
+        host_limiter.users -= 1
+        if host_limiter.users <= 0 and host_limiter.next_start <= asyncio.get_running_loop().time():
+            # forget idle hosts to keep the host table small
+            self._host_throttled_times += host_limiter.throttled_times
+            del self._hosts[host]
+
+    @staticmethod
+    def _on_task_done(job: _AsyncJob, task: asyncio.Task):
+        try:
+            if task.cancelled():
+                job.future.cancel()
+            elif task.exception() is not None:
+                job.future.set_exception(task.exception())
+            else:
+                job.future.set_result(task.result())
+                return
+        except InvalidStateError:
+            pass
+        if not task.cancelled() and task.exception() is None:
+            # the future is cancelled after the download completes, nobody is going to release the result
+            release_result_value(task.result())
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_concurrency_per_host": self.max_concurrency_per_host,
+            "max_requests_per_second_per_host": self.max_requests_per_second_per_host,
+            "running_jobs": self._running_jobs,
+            "active_hosts": len(self._hosts),
+            "submitted_jobs": self._submitted_jobs,
+            "started_jobs": self._started_jobs,
+            "cancelled_jobs": self._cancelled_jobs,
+            "host_throttled_times": self._host_throttled_times
+                                    + sum(h.throttled_times for h in list(self._hosts.values())),
+            "avg_wait_time": self._total_wait_time / self._started_jobs if self._started_jobs else 0.0,
+            "max_wait_time": self._max_wait_time,
+        }
+
+
+async def run_blocking(fn: Callable[..., Any], *args,
+                       on_cancelled: Optional[Callable[[Any], None]] = None, **kwargs) -> Any:
+    """
+    Run a blocking call, e.g. the file I/O of the spooled files or of the response cache, on the default executor
+    instead of blocking the event loop running all the downloads.
+    The call can not be interrupted, so a cancelled task waits for it to return before handling the cancellation.
+    :param on_cancelled: called with the result of the call if the task is cancelled meanwhile, e.g. to release it
+    """
+    future = asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        if on_cancelled and not future.cancelled() and future.exception() is None:
+            on_cancelled(future.result())
+        raise
+
+
+def release_content_result(result: Optional[tuple[DownloadedContent, Optional[str], Optional[str], Optional[str]]]):
+    if result:
+        result[0].release()
+
+
+async def async_download_to_temp(method: str, url: str,
+                                 timeout: float = 5.0,
+                                 ssl_certificate_verify: bool = True,
+                                 request_headers: Mapping[str, str] = None,
+                                 request_body: Optional[Union[str, RequestBody]] = None,
+                                 proxy_url: Optional[str] = None,
+                                 cancel_event: threading.Event = None,
+                                 custom_filename: Optional[str] = None,
+                                 idx: int = 0,
+                                 size_limit: Optional[SizeLimit] = None,
+                                 text_options: Optional[TextExtractOptions] = None,
+                                 checksum_algorithms: Optional[Iterable[str]] = None,
+                                 expected_checksums: Optional[Mapping[str, str]] = None,
+                                 deadline: Optional[Deadline] = None,
+                                 is_spool_exempt: Optional[Callable[[], bool]] = None,
+                                 ) -> tuple[int, Optional[DownloadedContent], Optional[str], Optional[str], Optional[str]]:
+    """
+    Coroutine version of download_to_temp with the same arguments and result.
+    The download is cancelled by cancelling its task, so the cancel event is not polled.
+    Large files are downloaded in a single stream instead of concurrent segments.
+    """
+    trace = DownloadTrace()
+    # reject the unknown checksum algorithms before waiting or sending any request
+    hash_algorithms = get_hash_algorithms(checksum_algorithms, expected_checksums)
+    await spool_manager.async_wait_for_space(deadline, is_spool_exempt)
+    request_headers = patch_request_headers(request_headers)
+    request_body = as_request_body(request_body)
+    if request_body:
+        request_headers = request_body.patch_headers(request_headers)
+    size_limiter = DownloadSizeLimiter(url, size_limit)
+    cache_key, cache_entry = await run_blocking(
+        lookup_cache_entry, method, url, request_headers, request_body, size_limiter)
+    spooled_file = SpooledContentFile(hash_algorithms=hash_algorithms)
+    pooled_client = client_holder.acquire(proxy_url, ssl_certificate_verify, timeout, is_async=True)
+    # the network backends time the resolving of the host names into the trace
+    trace_token = current_download_trace.set(trace)
+    try:
+        if cache_entry and cache_entry.is_fresh(request_headers):
+            # serve the fresh cached content without any request
+            result = await run_blocking(
+                serve_cached_content, url, cache_entry, custom_filename, spooled_file, size_limiter,
+                text_options=text_options, expected_checksums=expected_checksums, on_cancelled=release_content_result)
+            if result:
+                trace.cached = True
+                return idx, *finish_download_trace(trace, result)
+            # the cached body is gone, e.g. evicted by a concurrent download, so download it as not cached
+            cache_entry = None
+
+        while True:
+            resume_state = ResumeState(text_options=text_options, trace=trace)
+            attempt = 0
+            while True:
+                if deadline:
+                    deadline.check(url)
+                try:
+                    await async_download_attempt_to_file(
+                        pooled_client.client,
+                        method,
+                        url,
+                        timeout=get_request_timeout(timeout, deadline),
+                        request_headers=request_headers,
+                        request_content=request_body.aget_content(
+                            timeout, proxy_url, ssl_certificate_verify) if request_body else None,
+                        custom_filename=custom_filename,
+                        file=spooled_file,
+                        resume_state=resume_state,
+                        cache_entry=cache_entry,
+                        size_limiter=size_limiter,
+                    )
+                    break
+                except Exception as e:
+                    attempt += 1
+                    if attempt > max_retries or not is_retryable_error(e):
+                        raise
+                    delay = get_retry_delay(attempt, e)
+                    if deadline and not deadline.allows(delay):
+                        raise
+                    await asyncio.sleep(delay)
+
+            result = await run_blocking(
+                finish_downloaded_content, url, custom_filename, spooled_file, resume_state, size_limiter,
+                cache_key, cache_entry, expected_checksums=expected_checksums, on_cancelled=release_content_result)
+            if result:
+                return idx, *finish_download_trace(trace, result)
+            # the revalidated body is gone, e.g. evicted by a concurrent download, so download it as not cached
+            cache_entry = None
+            trace.cached = False
+    except BaseException as e:
+        # also cleaning up when the task is cancelled
+        size_limiter.reset()
+        spooled_file.discard()
+        metrics_registry.record_download(trace, "failed" if isinstance(e, Exception) else "cancelled")
+        raise
+    finally:
+        current_download_trace.reset(trace_token)
+        client_holder.release(pooled_client)
+
+
+async def async_download_attempt_to_file(client: AsyncClient,
+                                         method: str,
+                                         url: str,
+                                         timeout: Timeout,
+                                         request_headers: Mapping[str, str],
+                                         request_content: Optional[Union[bytes, AsyncIterable[bytes]]],
+                                         custom_filename: Optional[str],
+                                         file: SpooledContentFile,
+                                         resume_state: ResumeState,
+                                         cache_entry: Optional[CacheEntry] = None,
+                                         size_limiter: Optional[DownloadSizeLimiter] = None,
+                                         ):
+    """
+    Coroutine version of download_attempt_to_file.
+    """
+    size_limiter = size_limiter or DownloadSizeLimiter(url, None)
+    resume_offset = file.tell() if resume_state.validator else 0
+    headers = get_attempt_headers(request_headers, resume_state, resume_offset, cache_entry)
+    trace = resume_state.trace
+    trace.start_attempt()
+
+    async with client.stream(
+            method=method,
+            url=url,
+            headers=headers,
+            timeout=timeout,
+            content=request_content,
+            extensions={"download_trace": trace.on_http_event},
+    ) as response:
+        trace.on_response(response.http_version)
+        try:
+            if cache_entry and response.status_code == 304:
+                resume_state.response_headers = response.headers
+                resume_state.is_not_modified = True
+                trace.cached = True
+                return
+
+            check_response_status(url, response)
+            # may create and preallocate the spooled file
+            await run_blocking(prepare_file_for_response, method, url, response, custom_filename, file,
+                               resume_state, resume_offset, size_limiter)
+
+            # Stream the response content to the temporary file
+            throughput_guard = ThroughputGuard(url)
+            trace.time_decoding(response)
+            async for chunk in response.aiter_bytes(chunk_size=ASYNC_WRITE_CHUNK_SIZE):
+                throughput_guard.feed(len(chunk))
+                started_at = time.perf_counter()
+                if file.is_rolled_over or file.tell() + len(chunk) > file.max_memory_size:
+                    # written to the disk
+                    is_continued = await run_blocking(
+                        write_chunk_to_file, chunk, file, size_limiter, resume_state.text_extractor)
+                else:
+                    is_continued = write_chunk_to_file(chunk, file, size_limiter, resume_state.text_extractor)
+                trace.add_time("write", time.perf_counter() - started_at)
+                if not is_continued:
+                    break
+        finally:
+            trace.finish_attempt(response.num_bytes_downloaded)
+
+
+async_download_engine = AsyncDownloadEngine(
+    max_concurrency=get_env_int("DOWNLOAD_ASYNC_MAX_CONCURRENCY", DEFAULT_ASYNC_MAX_CONCURRENCY),
+    max_concurrency_per_host=get_env_int("DOWNLOAD_MAX_CONCURRENCY_PER_HOST", DEFAULT_MAX_CONCURRENCY_PER_HOST),
+    max_requests_per_second_per_host=get_env_float("DOWNLOAD_MAX_REQUESTS_PER_SECOND_PER_HOST", 0),
+)
+
+metrics_registry.register_collector("async_engine", async_download_engine.stats)
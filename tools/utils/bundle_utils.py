@@ -0,0 +1,115 @@
+import io
+import os
+import tarfile
+import time
+import zipfile
+from typing import Optional, BinaryIO, Union
+
+from tools.utils.content_utils import DownloadedContent
+from tools.utils.spool_manager import spool_manager
+
+# "files" outputs a file per download, while the others bundle all the downloads into a single archive
+OUTPUT_FORMATS = ["files", "zip", "tar.gz"]
+
+BUNDLE_MIME_TYPES = {
+    "zip": "application/zip",
+    "tar.gz": "application/gzip",
+}
+
+# same as the default level of gzip, trading a little compression ratio for much less CPU time
+BUNDLE_COMPRESS_LEVEL = 6
+
+
+class DownloadBundle:
+    """
+    A ZIP or tar.gz archive on disk, compressing each downloaded content as soon as it is added,
+    so that the archive is built while the other downloads are still running.
+    """
+
+    def __init__(self, output_format: str, filename: Optional[str] = None):
+        if output_format not in BUNDLE_MIME_TYPES:
+            raise ValueError(f"Invalid bundle format: {output_format}, expected one of {list(BUNDLE_MIME_TYPES)}")
+        self.output_format = output_format
+        self.filename = filename or f"downloads.{output_format}"
+        self.mime_type = BUNDLE_MIME_TYPES[output_format]
+        # names of the entries in the archive
+        self.entry_names: list[str] = []
+        self._entry_name_set: set[str] = set()
+        spool_file = spool_manager.create()
+        spool_file.file.close()
+        self.file_path = spool_file.path
+        self._archive: Optional[Union[zipfile.ZipFile, tarfile.TarFile]]
+        if output_format == "zip":
+            self._archive = zipfile.ZipFile(
+                self.file_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=BUNDLE_COMPRESS_LEVEL)
+        else:
+            self._archive = tarfile.open(self.file_path, "w:gz", compresslevel=BUNDLE_COMPRESS_LEVEL)
+
+    @staticmethod
+    def create(output_format: Optional[str], filename: Optional[str] = None) -> Optional["DownloadBundle"]:
+        """
+        :return: None if outputting a file per download
+        """
+        output_format = output_format or "files"
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Invalid output format: {output_format}, expected one of {OUTPUT_FORMATS}")
+        if output_format == "files":
+            return None
+        return DownloadBundle(output_format, filename)
+
+    def add(self, filename: Optional[str], content: DownloadedContent, idx: int = 0):
+        """
+        Compress the content into the archive, with a unique entry name derived from the file name.
+        """
+        name = self._get_entry_name(filename, idx)
+        if isinstance(self._archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with self._archive.open(info, "w", force_zip64=content.size >= zipfile.ZIP64_LIMIT) as entry:
+                for chunk in content.iter_chunks(1024 * 1024):
+                    entry.write(chunk)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = content.size
+            info.mtime = int(time.time())
+            with _open_content(content) as f:
+                self._archive.addfile(info, f)
+        self.entry_names.append(name)
+
+    def _get_entry_name(self, filename: Optional[str], idx: int) -> str:
+        # keep the base name only, so that no entry is extracted outside the target directory
+        name = os.path.basename((filename or "").replace("\\", "/")).strip() or f"file_{idx}"
+        if name in (".", ".."):
+            name = f"file_{idx}"
+        stem, ext = os.path.splitext(name)
+        unique_name = name
+        counter = 1
+        while unique_name in self._entry_name_set:
+            unique_name = f"{stem}_{counter}{ext}"
+            counter += 1
+        self._entry_name_set.add(unique_name)
+        return unique_name
+
+    def finish(self) -> DownloadedContent:
+        """
+        Close the archive and return it as the content of a temporary file.
+        """
+        self._archive.close()
+        self._archive = None
+        spool_manager.track(self.file_path, os.path.getsize(self.file_path))
+        return DownloadedContent(file_path=self.file_path)
+
+    def discard(self):
+        if self._archive is not None:
+            try:
+                self._archive.close()
+            except Exception:
+                pass
+            self._archive = None
+            spool_manager.delete(self.file_path)
+
+
+def _open_content(content: DownloadedContent) -> BinaryIO:
+    if content.is_in_memory:
+        return io.BytesIO(content.data or b"")
+    return open(content.file_path, "rb")
@@ -0,0 +1,284 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional, Any, Union, Callable
+
+from httpx import Client, AsyncClient, Limits, Request, Timeout, URL
+
+from tools.utils.dns_cache import dns_cache
+from tools.utils.download_metrics import metrics_registry
+from tools.utils.env_utils import get_env_int, get_env_float
+
+if TYPE_CHECKING:
+    from tools.utils.http_transport import AsyncCachingDnsTransport, CachingDnsTransport
+
+DEFAULT_CLIENT_POOL_MAX_SIZE = 16
+DEFAULT_CLIENT_IDLE_TIMEOUT = 300.0
+
+# upper bounds of the timeout profiles in seconds, so that similar timeouts share the same client
+TIMEOUT_PROFILES = (5.0, 30.0, 120.0, 600.0)
+
+
+@dataclass(frozen=True)
+class ClientKey:
+    proxy_url: Optional[str]
+    ssl_certificate_verify: bool
+    http2: bool
+    # timeout profile of the client, None for no timeout
+    timeout: Optional[float]
+    # whether the client is an AsyncClient used by the asyncio download engine
+    is_async: bool = False
+
+
+def get_timeout_profile(timeout: Optional[float]) -> Optional[float]:
+    if timeout is None or timeout <= 0:
+        return None
+    for profile in TIMEOUT_PROFILES:
+        if timeout <= profile:
+            return profile
+    return None
+
+
+class PooledClient:
+    """
+    A shared httpx client with its usage and connection reuse stats.
+    """
+
+    def __init__(self, key: ClientKey, limits: Limits):
+        self.key = key
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self._lock = threading.Lock()
+        # async clients are bound to the event loop creating them
+        self._loop = asyncio.get_running_loop() if key.is_async else None
+        # httpcore and h2 are loaded with the first client instead of with the plugin
+        from tools.utils.http_transport import get_env_proxy_urls
+
+        # resolve each host once for all the connections of the client, including the ones through the proxies
+        self.transport = self._create_transport(key.proxy_url, limits)
+        # the proxies of the environment variables apply if no proxy is given, as for the default transport
+        self.proxy_mounts = {pattern: self._create_transport(proxy_url, limits) if proxy_url else None
+                             for pattern, proxy_url in get_env_proxy_urls().items()} if not key.proxy_url else {}
+        client_class = AsyncClient if key.is_async else Client
+        self.client: Union[Client, AsyncClient] = client_class(
+            transport=self.transport,
+            mounts=self.proxy_mounts,
+            follow_redirects=True,
+            default_encoding="utf-8",
+            timeout=Timeout(key.timeout),
+            event_hooks={"request": [self._on_async_request if key.is_async else self._on_request]},
+        )
+
+    def _create_transport(self, proxy_url: Optional[str], limits: Limits
+                          ) -> Union["CachingDnsTransport", "AsyncCachingDnsTransport"]:
+        from tools.utils.http_transport import create_transport
+
+        return create_transport(dns_cache, self.key.ssl_certificate_verify, self.key.http2, limits,
+                                proxy_url=proxy_url, is_async=self.key.is_async)
+
+    def _on_request(self, request: Request):
+        with self._lock:
+            self.requests += 1
+        # chain the synchronous trace of the download given in the request extensions,
+        # kept under its own key as the extensions are carried over to the redirect requests
+        download_trace = request.extensions.get("download_trace")
+        request.extensions["trace"] = lambda event_name, info: self._on_trace(event_name, info, download_trace)
+
+    async def _on_async_request(self, request: Request):
+        with self._lock:
+            self.requests += 1
+        download_trace = request.extensions.get("download_trace")
+
+        async def on_async_trace(event_name: str, info: dict[str, Any]):
+            self._on_trace(event_name, info, download_trace)
+
+        request.extensions["trace"] = on_async_trace
+
+    def _on_trace(self, event_name: str, info: dict[str, Any],
+                  download_trace: Optional[Callable[[str, dict[str, Any]], None]] = None):
+        if download_trace:
+            download_trace(event_name, info)
+        # e.g. "connection.connect_tcp.complete" or "socks_proxy.start_tls.complete"
+        if event_name.endswith(".connect_tcp.complete"):
+            with self._lock:
+                self.new_connections += 1
+        elif event_name.endswith(".start_tls.complete"):
+            with self._lock:
+                self.tls_handshakes += 1
+
+    def close(self):
+        if isinstance(self.client, AsyncClient):
+            # may be evicted from another thread, so close it on its own event loop
+            asyncio.run_coroutine_threadsafe(self.client.aclose(), self._loop)
+        else:
+            self.client.close()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                # the profile of the client, labeling its series in the metrics
+                "labels": {
+                    "proxy_url": redact_url(self.key.proxy_url) if self.key.proxy_url else "",
+                    "ssl_certificate_verify": str(self.key.ssl_certificate_verify).lower(),
+                    "http2": str(self.key.http2).lower(),
+                    "timeout": f"{self.key.timeout:g}" if self.key.timeout else "none",
+                    "is_async": str(self.key.is_async).lower(),
+                },
+                "in_use": self.in_use,
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(0, self.requests - self.new_connections),
+                "tls_handshakes": self.tls_handshakes,
+                "idle_time": time.monotonic() - self.last_used,
+            }
+
+
+def redact_url(url: str) -> str:
+    """
+    Remove the credentials from the URL, e.g. of a proxy, before exposing it in the metrics.
+    """
+    return str(URL(url).copy_with(userinfo=b""))
+
+
+class ClientHolder:
+    """
+    Pool of shared httpx clients keyed by the proxy, SSL verification, HTTP/2 and timeout profile,
+    so that downloads with the same configuration reuse the keep-alive connections.
+    The least recently used clients are closed when exceeding the max pool size or staying idle for too long.
+    """
+    default_connection_limits: Limits
+
+    def __init__(self, max_size: int = DEFAULT_CLIENT_POOL_MAX_SIZE, idle_timeout: float = DEFAULT_CLIENT_IDLE_TIMEOUT):
+        self.default_connection_limits = Limits(
+            max_connections=200,
+            max_keepalive_connections=50,
+            keepalive_expiry=180)
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # in order of least recently used first
+        self._clients: OrderedDict[ClientKey, PooledClient] = OrderedDict()
+        # evicted clients still in use, closed once released
+        self._evicted_clients: list[PooledClient] = []
+        self._created_clients = 0
+        self._closed_clients = 0
+
+    def acquire(self,
+                proxy_url: Optional[str],
+                ssl_certificate_verify: bool,
+                timeout: Optional[float] = None,
+                http2: bool = True,
+                is_async: bool = False,
+                ) -> PooledClient:
+        """
+        Borrow the shared client for the configuration,
+        which should be given back by `release` after use instead of being closed.
+        """
+        key = ClientKey(
+            proxy_url=proxy_url or None,
+            ssl_certificate_verify=ssl_certificate_verify,
+            http2=http2,
+            timeout=get_timeout_profile(timeout),
+            is_async=is_async,
+        )
+        pooled_client = self._acquire_existing(key)
+        if pooled_client:
+            return pooled_client
+
+        # build the client, e.g. loading the SSL context, without blocking the other configurations
+        new_client = PooledClient(key, self.default_connection_limits)
+        with self._lock:
+            closing_clients = self._evict_idle_clients()
+            pooled_client = self._clients.get(key)
+            if pooled_client:
+                # created meanwhile by another caller
+                self._clients.move_to_end(key)
+            else:
+                pooled_client = new_client
+                self._clients[key] = pooled_client
+                self._created_clients += 1
+                while len(self._clients) > self.max_size:
+                    _, evicted_client = self._clients.popitem(last=False)
+                    closing_clients.append(evicted_client)
+            pooled_client.in_use += 1
+            pooled_client.last_used = time.monotonic()
+            closing_clients = self._defer_clients_in_use(closing_clients)
+        if pooled_client is not new_client:
+            closing_clients.append(new_client)
+        self._close_clients(closing_clients)
+        return pooled_client
+
+    def _acquire_existing(self, key: ClientKey) -> Optional[PooledClient]:
+        with self._lock:
+            closing_clients = self._evict_idle_clients()
+            pooled_client = self._clients.get(key)
+            if pooled_client:
+                self._clients.move_to_end(key)
+                pooled_client.in_use += 1
+                pooled_client.last_used = time.monotonic()
+            closing_clients = self._defer_clients_in_use(closing_clients)
+        self._close_clients(closing_clients)
+        return pooled_client
+
+    def release(self, pooled_client: PooledClient):
+        with self._lock:
+            pooled_client.in_use -= 1
+            pooled_client.last_used = time.monotonic()
+            closing_clients = []
+            if pooled_client.in_use <= 0 and pooled_client in self._evicted_clients:
+                self._evicted_clients.remove(pooled_client)
+                self._closed_clients += 1
+                closing_clients.append(pooled_client)
+        self._close_clients(closing_clients)
+
+    def _evict_idle_clients(self) -> list[PooledClient]:
+        # must be called with the lock held
+        if self.idle_timeout <= 0:
+            return []
+        now = time.monotonic()
+        idle_keys = [key for key, pooled_client in self._clients.items()
+                     if pooled_client.in_use <= 0 and now - pooled_client.last_used > self.idle_timeout]
+        return [self._clients.pop(key) for key in idle_keys]
+
+    def _defer_clients_in_use(self, clients: list[PooledClient]) -> list[PooledClient]:
+        # must be called with the lock held
+        closing_clients = []
+        for pooled_client in clients:
+            if pooled_client.in_use > 0:
+                self._evicted_clients.append(pooled_client)
+            else:
+                closing_clients.append(pooled_client)
+        self._closed_clients += len(closing_clients)
+        return closing_clients
+
+    @staticmethod
+    def _close_clients(clients: list[PooledClient]):
+        for pooled_client in clients:
+            pooled_client.close()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            pooled_clients = list(self._clients.values())
+            return {
+                "max_size": self.max_size,
+                "idle_timeout": self.idle_timeout,
+                "clients": len(self._clients),
+                "evicted_clients_in_use": len(self._evicted_clients),
+                "created_clients": self._created_clients,
+                "closed_clients": self._closed_clients,
+                "dns_cache": dns_cache.stats(),
+                "pools": [pooled_client.stats() for pooled_client in pooled_clients],
+            }
+
+
+client_holder = ClientHolder(
+    max_size=get_env_int("DOWNLOAD_CLIENT_POOL_MAX_SIZE", DEFAULT_CLIENT_POOL_MAX_SIZE),
+    idle_timeout=get_env_float("DOWNLOAD_CLIENT_IDLE_TIMEOUT", DEFAULT_CLIENT_IDLE_TIMEOUT),
+)
+
+metrics_registry.register_collector("client_pool", client_holder.stats)
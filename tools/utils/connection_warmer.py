@@ -0,0 +1,133 @@
+import threading
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from httpx import URL
+
+from tools.utils.client_pool import client_holder, PooledClient
+from tools.utils.download_metrics import metrics_registry
+from tools.utils.env_utils import get_env_int
+
+DEFAULT_PREWARM_MAX_CONNECTIONS = 8
+DEFAULT_PREWARM_MAX_WORKERS = 4
+# warm-ups queued or in progress per worker, beyond which the new ones are skipped as the downloads connect by themselves
+PREWARM_MAX_PENDING_PER_WORKER = 4
+
+# max number of HTTP/1.1 connections opened ahead to an origin, 0 to disable pre-warming
+prewarm_max_connections = get_env_int("DOWNLOAD_PREWARM_MAX_CONNECTIONS", DEFAULT_PREWARM_MAX_CONNECTIONS)
+prewarm_max_workers = max(1, get_env_int("DOWNLOAD_PREWARM_MAX_WORKERS", DEFAULT_PREWARM_MAX_WORKERS))
+
+# shared by all invocations of the thread engine, so that warming many origins does not start a thread for each
+prewarm_executor = ThreadPoolExecutor(max_workers=prewarm_max_workers, thread_name_prefix="download-prewarm")
+# bounds the warm-ups of both engines queued or in progress
+_prewarm_slots = threading.BoundedSemaphore(prewarm_max_workers * PREWARM_MAX_PENDING_PER_WORKER)
+
+DEFAULT_PORTS = {"http": 80, "https": 443, "socks5": 1080, "socks5h": 1080}
+
+
+def plan_origins(urls: Iterable[Optional[URL]]) -> dict[str, int]:
+    """
+    Group the URLs of a batch by their origins.
+    :return: the number of URLs of each origin with more than one URL, in the order of first appearance,
+        as a single download does not gain from a connection opened ahead
+    """
+    url_counts: dict[str, int] = {}
+    for url in urls:
+        if not url or url.scheme not in ["http", "https"]:
+            continue
+        origin = str(url.origin())
+        url_counts[origin] = url_counts.get(origin, 0) + 1
+    return {origin: count for origin, count in url_counts.items() if count > 1}
+
+
+def get_warm_connection_count(origin: str, url_count: int, max_concurrency_per_host: int) -> int:
+    """
+    :return: the number of connections to open ahead to the origin, a single one for HTTPS
+        which may negotiate HTTP/2 multiplexing all the downloads, otherwise bounded by the number of its URLs
+        and the per-host concurrency cap
+    """
+    count = min(url_count, prewarm_max_connections)
+    if origin.startswith("https:"):
+        count = min(count, 1)
+    if max_concurrency_per_host > 0:
+        count = min(count, max_concurrency_per_host)
+    return max(0, count)
+
+
+def get_warm_address(pooled_client: PooledClient, origin: str) -> Optional[tuple[str, int]]:
+    """
+    :return: the host and port the connections of the client to the origin are opened to,
+        i.e. the proxy if given, otherwise the origin itself,
+        or None if a proxy of the environment variables may apply to the origin
+    """
+    if pooled_client.key.proxy_url:
+        url = URL(pooled_client.key.proxy_url)
+    elif pooled_client.proxy_mounts:
+        return None
+    else:
+        url = URL(origin)
+    return url.host, url.port or DEFAULT_PORTS.get(url.scheme, 80)
+
+
+def submit_warm_connection(spawn: Callable[..., Future], fn: Callable[..., Any], *args) -> Optional[Future]:
+    """
+    Run the warm-up in the background with the spawn function, e.g. prewarm_executor.submit,
+    unless too many warm-ups are already queued or in progress.
+    :return: the future of the warm-up, or None if skipped
+    """
+    if not _prewarm_slots.acquire(blocking=False):
+        metrics_registry.inc("prewarmed_connections_total", status="skipped")
+        return None
+    try:
+        future = spawn(fn, *args)
+    except BaseException:
+        _prewarm_slots.release()
+        raise
+    future.add_done_callback(lambda _: _prewarm_slots.release())
+    return future
+
+
+def warm_connection(origin: str,
+                    proxy_url: Optional[str],
+                    ssl_certificate_verify: bool,
+                    timeout: float,
+                    connect_timeout: Optional[float],
+                    index: int = 0,
+                    ) -> bool:
+    """
+    Open a TCP connection to the origin with the network backend of the shared client of the download configuration,
+    parked until the first download connecting to the same address takes it over.
+    Nothing is sent over the connection, and the TLS handshake is left to the download.
+    :param index: index of the connection among the ones opened to the origin by the invocation,
+        skipped if the client already keeps more idle connections to the origin
+    :return: False if not opened, which is left to the downloads to report
+    """
+    pooled_client = client_holder.acquire(proxy_url, ssl_certificate_verify, timeout)
+    try:
+        address = get_warm_address(pooled_client, origin)
+        if address is None or pooled_client.transport.count_idle_connections(origin) > index:
+            return False
+        return pooled_client.transport.network_backend.warm_tcp(*address, timeout=connect_timeout)
+    finally:
+        client_holder.release(pooled_client)
+
+
+async def async_warm_connection(origin: str,
+                                proxy_url: Optional[str],
+                                ssl_certificate_verify: bool,
+                                timeout: float,
+                                connect_timeout: Optional[float],
+                                index: int = 0,
+                                ) -> bool:
+    """
+    Coroutine version of warm_connection.
+    """
+    pooled_client = client_holder.acquire(proxy_url, ssl_certificate_verify, timeout, is_async=True)
+    try:
+        address = get_warm_address(pooled_client, origin)
+        if address is None or pooled_client.transport.count_idle_connections(origin) > index:
+            return False
+        return await pooled_client.transport.network_backend.warm_tcp(*address, timeout=connect_timeout)
+    finally:
+        client_holder.release(pooled_client)
@@ -0,0 +1,340 @@
+import io
+import mmap
+import threading
+from collections.abc import Generator
+from pathlib import Path
+from collections.abc import Iterable
+from typing import Optional, BinaryIO, Any
+
+from tools.utils.env_utils import get_env_int
+from tools.utils.file_utils import link_to_path
+from tools.utils.hash_utils import ContentHasher
+from tools.utils.spool_manager import SpoolFile, spool_manager
+
+DEFAULT_IN_MEMORY_MAX_SIZE = 1024 * 1024
+
+# same chunk size as the plugin SDK splitting blob messages into chunks
+BLOB_CHUNK_SIZE = 8192
+
+in_memory_max_size = get_env_int("DOWNLOAD_IN_MEMORY_MAX_SIZE", DEFAULT_IN_MEMORY_MAX_SIZE)
+
+
+class _ContentRefs:
+    """
+    Number of the alive handles sharing the same downloaded body.
+    """
+
+    def __init__(self):
+        self.count = 1
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """
+        :return: False if all the handles are already released
+        """
+        with self._lock:
+            if self.count <= 0:
+                return False
+            self.count += 1
+            return True
+
+    def release(self) -> int:
+        """
+        :return: the number of the remaining handles
+        """
+        with self._lock:
+            self.count -= 1
+            return self.count
+
+
+class DownloadedContent:
+    """
+    Body of a downloaded response, either kept in memory or in a temporary file.
+    The body may be shared by multiple handles, and is only deleted when all of them are released.
+    """
+
+    def __init__(self,
+                 data: Optional[bytes] = None,
+                 file_path: Optional[str] = None,
+                 digest: Optional[str] = None,
+                 checksums: Optional[dict[str, str]] = None):
+        self.data = data
+        self.file_path = file_path
+        # SHA-256 hex digest of the body
+        self.digest = digest
+        # hex digests of the body by the algorithm, e.g. "sha256", "md5" or "crc32"
+        self.checksums = checksums or ({"sha256": digest} if digest else {})
+        # whether the content is truncated by the size limit, or its text is cut off at the max number of characters
+        self.is_truncated = False
+        # text extracted from the content, None if not extracted
+        self.text: Optional[str] = None
+        # timings and transfer details of the download producing the handle, None if not tracked
+        self.metrics: Optional[dict[str, Any]] = None
+        self._refs = _ContentRefs()
+        self._is_released = False
+
+    @property
+    def is_in_memory(self) -> bool:
+        return self.file_path is None
+
+    @property
+    def size(self) -> int:
+        if self.is_in_memory:
+            return len(self.data or b"")
+        return Path(self.file_path).stat().st_size
+
+    def read_bytes(self) -> bytes:
+        if self.is_in_memory:
+            return self.data or b""
+        return Path(self.file_path).read_bytes()
+
+    def read_text(self, encoding: str = "utf-8") -> str:
+        return self.read_bytes().decode(encoding)
+
+    def iter_chunks(self, chunk_size: int = BLOB_CHUNK_SIZE) -> Generator[bytes, None, None]:
+        """
+        Iterate over the content in chunks without loading the whole file into memory.
+        """
+        if self.is_in_memory:
+            data = self.data or b""
+            for start in range(0, len(data), chunk_size):
+                yield data[start:start + chunk_size]
+            return
+
+        with open(self.file_path, "rb") as f:
+            if self.size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for start in range(0, len(mm), chunk_size):
+                    yield mm[start:start + chunk_size]
+
+    def share(self) -> Optional["DownloadedContent"]:
+        """
+        Create another handle of the same body, which should be released separately.
+        :return: None if the body is already released
+        """
+        if not self._refs.acquire():
+            return None
+        shared = DownloadedContent(data=self.data, file_path=self.file_path, digest=self.digest,
+                                   checksums=dict(self.checksums))
+        shared._refs = self._refs
+        shared.is_truncated = self.is_truncated
+        shared.text = self.text
+        shared.metrics = self.metrics
+        return shared
+
+    def release(self):
+        """
+        Release the memory or delete the temporary file, once all the handles of the body are released.
+        """
+        if self._is_released:
+            return
+        self._is_released = True
+        if self._refs.release() > 0:
+            # the body is still shared by other handles, and may be shared again by the content store
+            return
+        self.data = None
+        if self.digest:
+            content_store.forget(self.digest, self._refs)
+        if self.file_path:
+            spool_manager.delete(self.file_path)
+
+
+class SpooledContentFile:
+    """
+    A writable file keeping the content in memory until exceeding the max size,
+    and then rolling over to a file of the spool manager on disk.
+    """
+
+    def __init__(self, max_memory_size: int = in_memory_max_size, hash_algorithms: Iterable[str] = ("sha256",)):
+        self.max_memory_size = max_memory_size
+        self._buffer: Optional[io.BytesIO] = io.BytesIO()
+        self._file: Optional[BinaryIO] = None
+        self._spool_file: Optional[SpoolFile] = None
+        self.file_path: Optional[str] = None
+        # end of the written content, as the file may be preallocated beyond it
+        self._end = 0
+        self.hash_algorithms = tuple(hash_algorithms)
+        # checksums of the bytes written sequentially from the beginning,
+        # None if the content is written out of order and has to be hashed after downloading
+        self._hasher: Optional[ContentHasher] = ContentHasher(self.hash_algorithms)
+        # known digest of the content replaced with a file
+        self._digest: Optional[str] = None
+
+    @property
+    def _active(self) -> BinaryIO:
+        return self._file if self._file else self._buffer
+
+    @property
+    def is_rolled_over(self) -> bool:
+        return self._file is not None
+
+    def rollover(self, expected_size: int = -1):
+        """
+        :param expected_size: expected size in bytes of the whole content, or -1 if unknown,
+            to spool the file in the directory for its size and preallocate its disk space
+        """
+        if self._file:
+            return
+        self._spool_file = spool_manager.create(expected_size)
+        self._file = self._spool_file.file
+        self.file_path = self._spool_file.path
+        position = self._buffer.tell()
+        self._end = len(self._buffer.getbuffer())
+        self._file.write(self._buffer.getbuffer())
+        self._file.seek(position)
+        self._buffer = None
+
+    def replace_with_file(self, source_path: str, size: int, digest: Optional[str] = None):
+        """
+        Replace the content with the file at the source path,
+        by reading it into memory if small, or by linking it to the temporary file otherwise.
+        :raises OSError: if the source file is not readable, leaving the content unchanged
+        """
+        if size <= self.max_memory_size and not self._file:
+            self._buffer = io.BytesIO(Path(source_path).read_bytes())
+            self._buffer.seek(0, io.SEEK_END)
+            self._hasher = None
+            self._digest = digest
+            return
+        self.rollover(size)
+        link_to_path(Path(source_path), Path(self.file_path))
+        self._hasher = None
+        self._digest = digest
+        # reopen as the temporary file is replaced
+        self._file.close()
+        self._file = open(self.file_path, "r+b")
+        self._end = self._file.seek(0, io.SEEK_END)
+        spool_manager.reserve(self._spool_file, self._end)
+
+    def write(self, data: bytes) -> int:
+        if not self._file and self._buffer.tell() + len(data) > self.max_memory_size:
+            self.rollover()
+        if self._hasher is not None:
+            if self._active.tell() == self._hasher.size:
+                # hash while streaming
+                self._hasher.update(data)
+            else:
+                self._hasher = None
+        written = self._active.write(data)
+        self._end = max(self._end, self._active.tell())
+        if self._file:
+            spool_manager.reserve(self._spool_file, self._end)
+        return written
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._active.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._active.tell()
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        if size is not None and size > self.max_memory_size:
+            self.rollover(size)
+        new_size = self._active.tell() if size is None else size
+        if new_size == 0:
+            # restart hashing from the beginning
+            self._hasher = ContentHasher(self.hash_algorithms)
+        elif self._hasher is not None and new_size < self._hasher.size:
+            self._hasher = None
+        self._end = self._active.truncate(size)
+        if self._file:
+            spool_manager.reserve(self._spool_file, self._end)
+        return self._end
+
+    def flush(self):
+        self._active.flush()
+
+    def fileno(self) -> int:
+        self.rollover()
+        # the content may be written at any offset with the file descriptor
+        self._hasher = None
+        return self._file.fileno()
+
+    def to_content(self) -> DownloadedContent:
+        """
+        Close the file and return the downloaded content with its checksums.
+        """
+        if self._file:
+            size = self._end
+            if self._file.seek(0, io.SEEK_END) > size:
+                # drop the preallocated space beyond the written content
+                self._file.truncate(size)
+            self._file.close()
+            spool_manager.track(self.file_path, size)
+            content = DownloadedContent(file_path=self.file_path)
+        else:
+            size = len(self._buffer.getbuffer())
+            content = DownloadedContent(data=self._buffer.getvalue())
+        if self._hasher is not None and self._hasher.size == size:
+            content.checksums = self._hasher.hexdigests()
+        elif self._digest and self.hash_algorithms == ("sha256",):
+            content.checksums = {"sha256": self._digest}
+        else:
+            # hash the content written out of order, e.g. by segments, or replaced with a file
+            hasher = ContentHasher(self.hash_algorithms)
+            for chunk in content.iter_chunks(1024 * 1024):
+                hasher.update(chunk)
+            content.checksums = hasher.hexdigests()
+        content.digest = content.checksums["sha256"]
+        return content
+
+    def discard(self):
+        if self._file:
+            self._file.close()
+            spool_manager.delete(self.file_path)
+        self._buffer = None
+
+
+class ContentStore:
+    """
+    Content-addressed registry of the alive downloaded bodies,
+    so that byte-identical bodies downloaded from different URLs are kept only once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # digest -> handle of the alive body
+        self._contents: dict[str, DownloadedContent] = {}
+        # stats
+        self._deduplicated_contents = 0
+        self._deduplicated_bytes = 0
+
+    def deduplicate(self, content: DownloadedContent) -> DownloadedContent:
+        """
+        :return: a shared handle of the byte-identical body already kept if any,
+            in which case the given content is released, otherwise the given content itself
+        """
+        if not content.digest:
+            return content
+        with self._lock:
+            existing = self._contents.get(content.digest)
+            shared = existing.share() if existing is not None else None
+            if shared is None:
+                self._contents[content.digest] = content
+                return content
+            self._deduplicated_contents += 1
+            self._deduplicated_bytes += shared.size
+        shared.is_truncated = content.is_truncated
+        shared.text = content.text
+        # the checksums of more algorithms may be computed for the given content
+        shared.checksums = dict(content.checksums)
+        content.release()
+        return shared
+
+    def forget(self, digest: str, refs: _ContentRefs):
+        with self._lock:
+            existing = self._contents.get(digest)
+            if existing is not None and existing._refs is refs:
+                del self._contents[digest]
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "contents": len(self._contents),
+                "deduplicated_contents": self._deduplicated_contents,
+                "deduplicated_bytes": self._deduplicated_bytes,
+            }
+
+
+content_store = ContentStore()
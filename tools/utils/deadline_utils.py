@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from httpx import Timeout, TimeoutException
+
+from tools.utils.env_utils import get_env_int, get_env_float
+
+# the MAX_REQUEST_TIMEOUT of the plugin in main.py
+DEFAULT_INVOCATION_TIMEOUT = 120.0
+# seconds kept from the invocation timeout for sending the downloaded results
+DEFAULT_DEADLINE_MARGIN = 10.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_MIN_THROUGHPUT = 1024
+DEFAULT_THROUGHPUT_WINDOW = 15.0
+DEFAULT_SIZE_HINTS_MAX_SIZE = 4096
+
+invocation_timeout = get_env_float("DOWNLOAD_INVOCATION_TIMEOUT", DEFAULT_INVOCATION_TIMEOUT)
+deadline_margin = get_env_float("DOWNLOAD_DEADLINE_MARGIN", DEFAULT_DEADLINE_MARGIN)
+connect_timeout = get_env_float("DOWNLOAD_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)
+min_throughput = get_env_int("DOWNLOAD_MIN_THROUGHPUT", DEFAULT_MIN_THROUGHPUT)
+throughput_window = get_env_float("DOWNLOAD_THROUGHPUT_WINDOW", DEFAULT_THROUGHPUT_WINDOW)
+
+
+class DeadlineExceededError(TimeoutError):
+    """
+    Raised when a download can not complete before the deadline of the tool invocation.
+    """
+    pass
+
+
+class TransferStalledError(TimeoutException):
+    """
+    Raised when the content of a response is received slower than the min throughput,
+    which is retried as a transient error like the other timeouts.
+    """
+    pass
+
+
+class Deadline:
+    """
+    Point in time by which all the downloads of a tool invocation have to complete.
+    """
+
+    def __init__(self, timeout: Optional[float]):
+        """
+        :param timeout: seconds from now, None or non-positive for no deadline
+        """
+        self.timeout = timeout if timeout and timeout > 0 else None
+        self.expires_at = time.monotonic() + self.timeout if self.timeout else None
+
+    @staticmethod
+    def for_invocation() -> "Deadline":
+        """
+        The deadline of a tool invocation, leaving the margin for sending the results before the plugin times out.
+        """
+        return Deadline(max(1.0, invocation_timeout - deadline_margin) if invocation_timeout > 0 else None)
+
+    def remaining(self) -> Optional[float]:
+        """
+        :return: seconds until the deadline, 0 if expired, None if no deadline
+        """
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def is_expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def allows(self, seconds: float) -> bool:
+        """
+        :return: whether waiting for the given seconds still ends before the deadline
+        """
+        remaining = self.remaining()
+        return remaining is None or seconds < remaining
+
+    def check(self, url: str):
+        """
+        :raises DeadlineExceededError: if the deadline is expired
+        """
+        if self.is_expired():
+            raise DeadlineExceededError(f"Deadline of {self} exceeded before downloading {url}")
+
+    def __str__(self) -> str:
+        return f"{self.timeout:g} seconds" if self.timeout else "unlimited time"
+
+
+def get_request_timeout(timeout: float, deadline: Optional[Deadline] = None) -> Timeout:
+    """
+    Separate timeouts of a request from the request timeout of the tool,
+    each cut down to the time remaining until the deadline:
+    connecting is limited by DOWNLOAD_CONNECT_TIMEOUT, while the read timeout applies to both waiting
+    for the response and the idle time between two chunks of the content.
+    """
+    read_timeout = timeout if timeout and timeout > 0 else None
+    remaining = deadline.remaining() if deadline else None
+    if remaining is not None:
+        read_timeout = min(read_timeout, remaining) if read_timeout else remaining
+    connect = min(read_timeout, connect_timeout) if read_timeout and connect_timeout > 0 else read_timeout
+    return Timeout(read_timeout, connect=connect)
+
+
+class ThroughputGuard:
+    """
+    Aborts a transfer receiving less than the min throughput over a window of time,
+    e.g. a server trickling a few bytes just before each read timeout.
+    """
+
+    def __init__(self, url: str, min_bytes_per_second: int = min_throughput, window: float = throughput_window):
+        self.url = url
+        self.min_bytes_per_second = min_bytes_per_second
+        self.window = window
+        self._window_started_at = time.monotonic()
+        self._window_bytes = 0
+
+    def feed(self, size: int):
+        """
+        :raises TransferStalledError: if the throughput of the last window is below the min throughput
+        """
+        if self.min_bytes_per_second <= 0 or self.window <= 0:
+            return
+        self._window_bytes += size
+        elapsed = time.monotonic() - self._window_started_at
+        if elapsed < self.window:
+            return
+        throughput = self._window_bytes / elapsed
+        if throughput < self.min_bytes_per_second:
+            raise TransferStalledError(f"Transfer of {self.url} stalled at {throughput:.0f} bytes/s, "
+                                       f"below the min throughput of {self.min_bytes_per_second} bytes/s")
+        self._window_started_at += elapsed
+        self._window_bytes = 0
+
+
+class SizeHints:
+    """
+    Sizes of the recently downloaded URLs, to start the downloads expected to be the smallest first,
+    so that as many downloads as possible complete before the deadline.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_SIZE_HINTS_MAX_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._sizes: OrderedDict[str, int] = OrderedDict()
+
+    def record(self, url: str, size: int):
+        with self._lock:
+            self._sizes[url] = size
+            self._sizes.move_to_end(url)
+            while len(self._sizes) > self.max_size:
+                self._sizes.popitem(last=False)
+
+    def get(self, url: str) -> int:
+        """
+        :return: the last known size of the URL, 0 if unknown, assuming most of the URLs are small
+        """
+        with self._lock:
+            return self._sizes.get(url, 0)
+
+
+size_hints = SizeHints()
@@ -0,0 +1,222 @@
+import asyncio
+import ipaddress
+import socket
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from tools.utils.download_metrics import metrics_registry
+from tools.utils.env_utils import get_env_int, get_env_float
+
+DEFAULT_DNS_CACHE_TTL = 60.0
+DEFAULT_DNS_CACHE_MAX_SIZE = 1024
+# seconds a connection opened ahead is kept for the requests, shorter than the idle timeout of most servers
+DEFAULT_PREWARM_IDLE_TIMEOUT = 10.0
+
+
+@dataclass
+class _DnsEntry:
+    addresses: list[str]
+    expires_at: float
+
+
+class DnsCache:
+    """
+    In-process cache of the resolved addresses of the host names,
+    so that concurrent downloads from the same host resolve it only once.
+    The system resolver does not tell the TTL of the records, so the entries expire after DOWNLOAD_DNS_CACHE_TTL.
+    With a TTL of 0, every lookup goes to the system resolver.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_DNS_CACHE_TTL, max_size: int = DEFAULT_DNS_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, int], _DnsEntry] = OrderedDict()
+        # locks of the host names being resolved, coalescing the concurrent lookups of the same host
+        self._resolving: dict[tuple[str, int], threading.Lock] = {}
+        # lookups in progress on the event loop of the asyncio download engine
+        self._async_resolving: dict[tuple[str, int], asyncio.Future] = {}
+        # stats
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.ttl > 0
+
+    def resolve(self, host: str, port: int) -> list[str]:
+        """
+        :return: the IP addresses of the host, in the order given by the resolver
+        :raises OSError: if the host name can not be resolved
+        """
+        if _is_ip_address(host):
+            return [host]
+        if not self.is_enabled:
+            return _get_addresses(socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+        key = (host, port)
+        addresses = self._lookup(key)
+        if addresses is not None:
+            return addresses
+        with self._lock:
+            resolving_lock = self._resolving.setdefault(key, threading.Lock())
+        with resolving_lock:
+            # resolved by another thread while waiting
+            addresses = self._lookup(key, is_counted=False)
+            if addresses is not None:
+                return addresses
+            with self._lock:
+                self._misses += 1
+            try:
+                addresses = _get_addresses(socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+                self._store(key, addresses)
+                return addresses
+            finally:
+                with self._lock:
+                    self._resolving.pop(key, None)
+
+    async def async_resolve(self, host: str, port: int) -> list[str]:
+        """
+        Coroutine version of resolve, resolving on the executor of the running event loop.
+        """
+        if _is_ip_address(host):
+            return [host]
+        if not self.is_enabled:
+            return _get_addresses(await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM))
+        key = (host, port)
+        addresses = self._lookup(key)
+        if addresses is not None:
+            return addresses
+        task = self._async_resolving.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._async_getaddrinfo(key))
+            self._async_resolving[key] = task
+            task.add_done_callback(lambda _: self._async_resolving.pop(key, None))
+        # a cancelled caller does not cancel the lookup shared with the others
+        return await asyncio.shield(task)
+
+    async def _async_getaddrinfo(self, key: tuple[str, int]) -> list[str]:
+        with self._lock:
+            self._misses += 1
+        host, port = key
+        addresses = _get_addresses(await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM))
+        self._store(key, addresses)
+        return addresses
+
+    def _lookup(self, key: tuple[str, int], is_counted: bool = True) -> Optional[list[str]]:
+        """
+        :param is_counted: whether to count a hit, misses are counted by resolving
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                if is_counted:
+                    self._hits += 1
+                return entry.addresses
+            if entry:
+                del self._entries[key]
+            return None
+
+    def _store(self, key: tuple[str, int], addresses: list[str]):
+        with self._lock:
+            self._entries[key] = _DnsEntry(addresses=addresses, expires_at=time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "ttl": self.ttl,
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+
+def _is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host.strip("[]"))
+        return True
+    except ValueError:
+        return False
+
+
+def _get_addresses(infos: list[tuple]) -> list[str]:
+    addresses = []
+    for _, _, _, _, sockaddr in infos:
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    if not addresses:
+        raise socket.gaierror(socket.EAI_NONAME, "No address associated with the host name")
+    return addresses
+
+
+class WarmStreams:
+    """
+    TCP connections opened ahead by warming, parked until a connection to the same address is opened by a request.
+    The parked connections are closed once expired or closed by the server.
+    """
+
+    def __init__(self, expiry: float = DEFAULT_PREWARM_IDLE_TIMEOUT):
+        self.expiry = expiry
+        self._lock = threading.Lock()
+        self._streams: dict[tuple[str, int], list[tuple[Any, float]]] = {}
+
+    def put(self, host: str, port: int, stream: Any):
+        with self._lock:
+            self._streams.setdefault((host, port), []).append((stream, time.monotonic() + self.expiry))
+        metrics_registry.inc("prewarmed_connections_total", status="opened")
+
+    def take(self, host: str, port: int) -> tuple[Optional[Any], list[Any]]:
+        """
+        :return: a parked connection to the address if any, and the connections to close,
+            i.e. the expired ones of any address and the ones closed by the server
+        """
+        now = time.monotonic()
+        stream = None
+        stale_streams = []
+        with self._lock:
+            for key in list(self._streams):
+                alive = []
+                for parked, expires_at in self._streams[key]:
+                    if expires_at <= now or parked.get_extra_info("is_readable"):
+                        # an idle connection is readable only once closed by the server
+                        stale_streams.append(parked)
+                    elif stream is None and key == (host, port):
+                        stream = parked
+                    else:
+                        alive.append((parked, expires_at))
+                if alive:
+                    self._streams[key] = alive
+                else:
+                    del self._streams[key]
+        if stream is not None:
+            metrics_registry.inc("prewarmed_connections_total", status="used")
+        if stale_streams:
+            metrics_registry.inc("prewarmed_connections_total", len(stale_streams), status="closed")
+        return stream, stale_streams
+
+    def pop_all(self) -> list[Any]:
+        """
+        :return: all the parked connections to close, e.g. when closing the connection pool
+        """
+        with self._lock:
+            streams = [stream for parked_streams in self._streams.values() for stream, _ in parked_streams]
+            self._streams.clear()
+        return streams
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(streams) for streams in self._streams.values())
+
+
+prewarm_idle_timeout = get_env_float("DOWNLOAD_PREWARM_IDLE_TIMEOUT", DEFAULT_PREWARM_IDLE_TIMEOUT)
+
+dns_cache = DnsCache(
+    ttl=get_env_float("DOWNLOAD_DNS_CACHE_TTL", DEFAULT_DNS_CACHE_TTL),
+    max_size=get_env_int("DOWNLOAD_DNS_CACHE_MAX_SIZE", DEFAULT_DNS_CACHE_MAX_SIZE),
+)
@@ -0,0 +1,116 @@
+import functools
+import inspect
+from collections.abc import Iterable
+from concurrent.futures import Future
+from typing import Optional
+
+from httpx import URL
+
+from tools.utils.async_download import async_download_engine, async_download_to_temp
+from tools.utils.connection_warmer import plan_origins, get_warm_connection_count, warm_connection, \
+    async_warm_connection, prewarm_max_connections, prewarm_executor, submit_warm_connection
+from tools.utils.deadline_utils import Deadline, size_hints, get_request_timeout
+from tools.utils.download_utils import download_to_temp
+from tools.utils.env_utils import get_env_str
+from tools.utils.scheduler import download_scheduler
+from tools.utils.single_flight import download_single_flight
+from tools.utils.spool_manager import OutputOrder
+
+# "thread" runs each download on a worker thread of the download scheduler,
+# "asyncio" runs all downloads as tasks on a single event loop
+DOWNLOAD_ENGINES = ["thread", "asyncio"]
+
+download_engine = (get_env_str("DOWNLOAD_ENGINE", "thread") or "thread").lower()
+if download_engine not in DOWNLOAD_ENGINES:
+    raise ValueError(f"Invalid download engine: {download_engine}, expected one of {DOWNLOAD_ENGINES}")
+
+download_signature = inspect.signature(download_to_temp)
+
+
+class DownloadSession:
+    """
+    Session of the configured download engine for a tool invocation.
+    """
+
+    def __init__(self, engine: Optional[str] = None, is_ordered: bool = False):
+        """
+        :param is_ordered: whether the results are yielded in the order of submission,
+            so the downloads are started in that order, and the ones next in the order do not wait for the spool space
+        """
+        self.engine = engine or download_engine
+        self.output_order = OutputOrder() if is_ordered else None
+        if self.engine == "asyncio":
+            self._session = async_download_engine.session()
+            self._download_fn = async_download_to_temp
+            self._max_concurrency_per_host = async_download_engine.max_concurrency_per_host
+        else:
+            self._session = download_scheduler.session()
+            self._download_fn = download_to_temp
+            self._max_concurrency_per_host = download_scheduler.max_concurrency_per_host
+
+    def prewarm(self,
+                urls: Iterable[Optional[URL]],
+                proxy_url: Optional[str],
+                ssl_certificate_verify: bool,
+                timeout: float,
+                deadline: Optional[Deadline] = None):
+        """
+        Open TCP connections in the background to the origins with several URLs in the batch,
+        taken over by the first downloads connecting to them instead of each resolving the host and connecting:
+        a single connection to an HTTPS origin, which may negotiate HTTP/2, or up to DOWNLOAD_PREWARM_MAX_CONNECTIONS.
+        No request is sent, and the downloads are dispatched right away without waiting for the connections,
+        while the connections are opened by a small pool of workers shared by all invocations.
+        The origins with idle pooled connections only get the connections missing.
+        """
+        origins = plan_origins(urls)
+        if not origins or prewarm_max_connections <= 0:
+            return
+        connect_timeout = get_request_timeout(timeout, deadline).connect
+        if self.engine == "asyncio":
+            spawn, warm_fn = async_download_engine.spawn, async_warm_connection
+        else:
+            spawn, warm_fn = prewarm_executor.submit, warm_connection
+        for origin, url_count in origins.items():
+            for index in range(get_warm_connection_count(origin, url_count, self._max_concurrency_per_host)):
+                submit_warm_connection(spawn, warm_fn, origin, proxy_url, ssl_certificate_verify, timeout,
+                                       connect_timeout, index)
+
+    def submit_download(self, host: Optional[str], *args, **kwargs) -> Future:
+        """
+        Submit a download with the arguments of download_to_temp, subject to the limits of the host.
+        Identical downloads in flight are coalesced into a single transfer.
+        Pending downloads are started from the smallest known size, so that more of them complete before the deadline,
+        unless ordered, where a result is not yielded before the ones submitted earlier anyway.
+        :return: the future of the download_to_temp result
+        """
+        arguments = download_signature.bind(*args, **kwargs).arguments
+        url = arguments.get("url")
+        if self.output_order:
+            arguments["is_spool_exempt"] = functools.partial(
+                self.output_order.is_unblocked, self.output_order.next_position())
+        priority = 0.0 if self.output_order else size_hints.get(url)
+        future = download_single_flight.submit(
+            arguments,
+            lambda shared_arguments: self._session.submit_to_host(
+                host, self._download_fn, priority=priority, **shared_arguments))
+        future.add_done_callback(lambda f: record_size_hint(url, f))
+        if self.output_order:
+            self.output_order.add(future)
+        return future
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self) -> "DownloadSession":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def record_size_hint(url: str, future: Future):
+    if future.cancelled() or future.exception():
+        return
+    content = future.result()[1]
+    if content and not content.is_truncated:
+        size_hints.record(url, content.size)
@@ -0,0 +1,375 @@
+import bisect
+import json
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Any, Callable
+
+from tools.utils.env_utils import get_env_int, get_env_str
+
+# phases timed for each download, in seconds
+DOWNLOAD_PHASES = ["dns", "connect", "tls", "ttfb", "transfer", "decode", "write", "read", "total"]
+
+# upper bounds of the histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+
+@dataclass
+class DownloadTrace:
+    """
+    Timings and transfer details of a single download, collected from the trace events of httpcore
+    and the stages of writing the content, summed over all the attempts.
+    """
+    started_at: float = field(default_factory=time.perf_counter)
+    # seconds of each phase, where dns is resolving the host names and connect excludes it,
+    # and decode is decompressing the content-encoded body, a part of the transfer like write
+    timings: dict[str, float] = field(default_factory=dict)
+    attempts: int = 0
+    # bytes received from the network before decompression, None if not tracked (e.g. segmented downloads)
+    wire_bytes: Optional[int] = 0
+    # bytes of the decoded content
+    decoded_bytes: int = 0
+    http_version: Optional[str] = None
+    # whether the last request is sent over a kept-alive connection, None if no request is sent
+    connection_reused: Optional[bool] = None
+    # whether the content is served from the response cache, either fresh or revalidated
+    cached: bool = False
+    segmented: bool = False
+    _connect_started_at: Optional[float] = None
+    # seconds of resolving the host name during the connection being opened
+    _connect_dns_seconds: float = 0.0
+    _tls_started_at: Optional[float] = None
+    _request_started_at: Optional[float] = None
+    _response_started_at: Optional[float] = None
+
+    def add_time(self, phase: str, seconds: float):
+        self.timings[phase] = self.timings.get(phase, 0.0) + max(0.0, seconds)
+
+    def start_attempt(self):
+        self.attempts += 1
+        self.connection_reused = None
+        self._request_started_at = None
+        self._response_started_at = None
+
+    def on_http_event(self, event_name: str, info: dict[str, Any]):
+        """
+        Trace extension of httpcore, e.g. "connection.connect_tcp.started" or "http2.receive_response_headers.complete".
+        """
+        now = time.perf_counter()
+        if event_name.endswith(".connect_tcp.started"):
+            self._connect_started_at = now
+            self._connect_dns_seconds = 0.0
+            self.connection_reused = False
+        elif event_name.endswith(".connect_tcp.complete") and self._connect_started_at is not None:
+            self.add_time("connect", now - self._connect_started_at - self._connect_dns_seconds)
+        elif event_name.endswith(".start_tls.started"):
+            self._tls_started_at = now
+        elif event_name.endswith(".start_tls.complete") and self._tls_started_at is not None:
+            self.add_time("tls", now - self._tls_started_at)
+        elif event_name.endswith(".send_request_headers.started"):
+            if self.connection_reused is None:
+                self.connection_reused = True
+            self._request_started_at = now
+        elif event_name.endswith(".receive_response_headers.complete") and self._request_started_at is not None:
+            self.add_time("ttfb", now - self._request_started_at)
+            self._response_started_at = now
+
+    def on_dns_resolved(self, seconds: float):
+        """
+        Called by the network backend after resolving the host name of a connection being opened,
+        which is timed as the dns phase instead of the connect phase.
+        """
+        self.add_time("dns", seconds)
+        self._connect_dns_seconds += seconds
+
+    def time_decoding(self, response: Any):
+        """
+        Time the decompression of the content-encoded body of the httpx response as the decode phase,
+        by wrapping its content decoder before the body is read, since httpx does not expose a hook for it.
+        """
+        get_content_decoder = getattr(response, "_get_content_decoder", None)
+        if get_content_decoder is None or "content-encoding" not in response.headers:
+            return
+        response._decoder = _TimedContentDecoder(get_content_decoder(), self)
+
+    def on_response(self, http_version: Optional[str]):
+        self.http_version = http_version
+        if self._response_started_at is None:
+            self._response_started_at = time.perf_counter()
+
+    def finish_attempt(self, wire_bytes: Optional[int]):
+        """
+        :param wire_bytes: bytes received of the response body before decompression, None if unknown
+        """
+        if self._response_started_at is not None:
+            self.add_time("transfer", time.perf_counter() - self._response_started_at)
+            self._response_started_at = None
+        if wire_bytes is None or self.wire_bytes is None:
+            self.wire_bytes = None
+        else:
+            self.wire_bytes += wire_bytes
+
+    def finish(self, decoded_bytes: int):
+        self.decoded_bytes = decoded_bytes
+        self.timings["total"] = time.perf_counter() - self.started_at
+
+    def to_meta(self) -> dict[str, Any]:
+        """
+        :return: the JSON serializable metrics attached to the meta of the download messages
+        """
+        meta = {
+            "http_version": self.http_version,
+            "connection_reused": self.connection_reused,
+            "cached": self.cached,
+            "segmented": self.segmented,
+            "retries": max(0, self.attempts - 1),
+            "wire_bytes": self.wire_bytes,
+            "decoded_bytes": self.decoded_bytes,
+            "timings_ms": {phase: round(self.timings[phase] * 1000, 3)
+                           for phase in DOWNLOAD_PHASES if phase in self.timings},
+        }
+        return meta
+
+
+class _TimedContentDecoder:
+    def __init__(self, decoder: Any, trace: DownloadTrace):
+        self._decoder = decoder
+        self._trace = trace
+
+    def decode(self, data: bytes) -> bytes:
+        started_at = time.perf_counter()
+        try:
+            return self._decoder.decode(data)
+        finally:
+            self._trace.add_time("decode", time.perf_counter() - started_at)
+
+    def flush(self) -> bytes:
+        started_at = time.perf_counter()
+        try:
+            return self._decoder.flush()
+        finally:
+            self._trace.add_time("decode", time.perf_counter() - started_at)
+
+
+# trace of the download running in the current thread or task, timing the resolving of the host names
+current_download_trace: ContextVar[Optional[DownloadTrace]] = ContextVar("current_download_trace", default=None)
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # the last count is of the values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _label_key(labels: dict[str, str]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted(labels.items()))
+
+
+def _escape_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_key: tuple[tuple[str, str], ...], **extra: str) -> str:
+    items = [*label_key, *extra.items()]
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in items) + "}"
+
+
+def _collect_gauges(metric: str, stats: dict[str, Any], gauges: dict[str, dict[tuple, float]],
+                    label_key: tuple[tuple[str, str], ...] = ()):
+    """
+    Flatten the numbers of the stats of a component into gauges, e.g. {"pools": [{"labels": {...}, "requests": 1}]}
+    into the gauge "<metric>_pools_requests" labeled by the labels of the item.
+    """
+    for key, value in stats.items():
+        name = f"{metric}_{key}"
+        if isinstance(value, dict):
+            _collect_gauges(name, value, gauges, label_key)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    item_label_key = _label_key({**dict(label_key), **item.get("labels", {})})
+                    _collect_gauges(name, {k: v for k, v in item.items() if k != "labels"}, gauges, item_label_key)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            gauges.setdefault(name, {})[label_key] = value
+
+
+class MetricsRegistry:
+    """
+    Process-level counters and histograms of the downloads of all tool invocations,
+    which can be dumped as JSON or scraped in the Prometheus text format.
+    """
+
+    def __init__(self, prefix: str = "download"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, _Histogram]] = {}
+        self._histogram_buckets: dict[str, tuple[float, ...]] = {}
+        self._collectors: dict[str, Callable[[], dict[str, Any]]] = {}
+
+    def register_collector(self, name: str, collect: Callable[[], dict[str, Any]]):
+        """
+        Report the current stats of a component, e.g. the scheduler or the response cache, on each snapshot or scrape.
+        The stats are included as is in the snapshot, and their numbers are exported as gauges named after the component.
+        :param collect: returns the JSON serializable stats, where the items of a list are labeled by their "labels"
+        """
+        with self._lock:
+            self._collectors[name] = collect
+
+    def collect(self) -> dict[str, dict[str, Any]]:
+        """
+        :return: the current stats of the registered components by their names
+        """
+        with self._lock:
+            collectors = list(self._collectors.items())
+        # collected without the lock, as the components take their own locks
+        return {name: collect() for name, collect in collectors}
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = DURATION_BUCKETS, **labels: str):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(self._histogram_buckets.setdefault(name, buckets))
+            histogram.observe(value)
+
+    def record_download(self, trace: DownloadTrace, status: str):
+        """
+        Aggregate the metrics of a finished download.
+        :param status: "succeeded", "failed" or "cancelled"
+        """
+        self.inc("downloads_total", status=status)
+        if trace.attempts > 1:
+            self.inc("retries_total", trace.attempts - 1)
+        if status != "succeeded":
+            return
+        if trace.cached:
+            self.inc("cache_hits_total")
+        if trace.connection_reused is not None:
+            self.inc("requests_total", connection="reused" if trace.connection_reused else "new",
+                     http_version=trace.http_version or "unknown")
+        self.inc("decoded_bytes_total", trace.decoded_bytes)
+        if trace.wire_bytes is not None:
+            self.inc("wire_bytes_total", trace.wire_bytes)
+        self.observe("size_bytes", trace.decoded_bytes, buckets=SIZE_BUCKETS)
+        for phase, seconds in trace.timings.items():
+            self.observe("phase_seconds", seconds, phase=phase)
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        :return: all the metrics as a JSON serializable dict
+        """
+        stats = self.collect()
+        with self._lock:
+            return {
+                "stats": stats,
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self._counters.items()
+                },
+                "histograms": {
+                    name: [{
+                        "labels": dict(key),
+                        "buckets": dict(zip([*map(str, h.buckets), "+Inf"], h.counts)),
+                        "count": h.count,
+                        "sum": h.sum,
+                    } for key, h in series.items()]
+                    for name, series in self._histograms.items()
+                },
+            }
+
+    def dump(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def render_prometheus(self) -> str:
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        gauges: dict[str, dict[tuple, float]] = {}
+        for name, stats in self.collect().items():
+            _collect_gauges(f"{self.prefix}_{name}", stats, gauges)
+        for metric, series in gauges.items():
+            lines.append(f"# TYPE {metric} gauge")
+            lines.extend(f"{metric}{_format_labels(key)} {value}" for key, value in series.items())
+        with self._lock:
+            for name, series in self._counters.items():
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                lines.extend(f"{metric}{_format_labels(key)} {value}" for key, value in series.items())
+            for name, series in self._histograms.items():
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for key, h in series.items():
+                    cumulative = 0
+                    for bound, count in zip([*map(str, h.buckets), "+Inf"], h.counts):
+                        cumulative += count
+                        lines.append(f"{metric}_bucket{_format_labels(key, le=bound)} {cumulative}")
+                    lines.append(f"{metric}_sum{_format_labels(key)} {h.sum}")
+                    lines.append(f"{metric}_count{_format_labels(key)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body = metrics_registry.render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path.split("?")[0] == "/metrics.json":
+            body = json.dumps(metrics_registry.snapshot()).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serve the metrics at /metrics in the Prometheus text format and at /metrics.json on a daemon thread.
+    :param host: address to listen on, only the loopback interface by default
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="download-metrics", daemon=True).start()
+    return server
+
+
+metrics_registry = MetricsRegistry()
+
+metrics_port = get_env_int("DOWNLOAD_METRICS_PORT", 0)
+if metrics_port > 0:
+    start_metrics_server(metrics_port, get_env_str("DOWNLOAD_METRICS_HOST", "127.0.0.1"))
@@ -1,79 +1,35 @@
 import os
 import re
-import tempfile
 import threading
+import time
+import uuid
 import mimetypes
-from collections.abc import Generator
-from concurrent.futures import Future
-from functools import cached_property
-from pathlib import Path
-from typing import Optional, Mapping, Any
+from collections.abc import Generator, Iterable
+from concurrent.futures import Future, as_completed, TimeoutError as FuturesTimeoutError
+from dataclasses import dataclass, field, asdict
+from typing import Optional, Mapping, Any, Union, Callable
 from urllib.parse import urlparse, unquote
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
-from httpx import Response, Client, Limits
+from httpx import Response, Client, Headers, Timeout
 from yarl import URL
 
-from tools.utils.file_utils import force_delete_path
-
-
-class ClientHolder:
-    default_connection_limits: Limits
-
-    def __init__(self):
-        self.default_connection_limits = Limits(
-            max_connections=200,
-            max_keepalive_connections=50,
-            keepalive_expiry=180)
-        pass
-
-    @cached_property
-    def default_client(self) -> Client:
-        return Client(
-            http2=True,
-            follow_redirects=True,
-            verify=True,
-            default_encoding="utf-8",
-            proxy=None,
-            limits=self.default_connection_limits,
-        )
-
-    @cached_property
-    def default_client_without_ssl_verify(self) -> Client:
-        return Client(
-            http2=True,
-            follow_redirects=True,
-            verify=True,
-            default_encoding="utf-8",
-            proxy=None,
-            limits=self.default_connection_limits,
-        )
-
-    def get_client(self, proxy_url: Optional[str], ssl_certificate_verify: bool) -> tuple[Client, bool]:
-        """
-        :param proxy_url:
-        :param ssl_certificate_verify:
-        :return:
-            Client: httpx client
-            bool: whether should be manually closed after use
-        """
-        if proxy_url:
-            return Client(
-                http2=True,
-                follow_redirects=True,
-                verify=ssl_certificate_verify,
-                default_encoding="utf-8",
-                proxy=proxy_url,
-            ), True
-        elif not ssl_certificate_verify:
-            return self.default_client_without_ssl_verify, False
-        else:
-            # should not be closed manually after use as its shared default client
-            return self.default_client, False
-
-
-client_holder = ClientHolder()
+from tools.utils.bundle_utils import DownloadBundle
+from tools.utils.client_pool import client_holder
+from tools.utils.content_utils import DownloadedContent, SpooledContentFile, BLOB_CHUNK_SIZE, content_store
+from tools.utils.deadline_utils import Deadline, DeadlineExceededError, ThroughputGuard, get_request_timeout
+from tools.utils.download_metrics import DownloadTrace, metrics_registry, current_download_trace
+from tools.utils.hash_utils import normalize_hash_algorithms, verify_checksums
+from tools.utils.http_cache import response_cache, CacheEntry
+from tools.utils.quota_utils import SizeLimit, DownloadSizeLimiter
+from tools.utils.request_body import RequestBody, as_request_body
+from tools.utils.retry_utils import max_retries, is_retryable_error, wait_before_retry, check_response_status, \
+    get_resume_validator
+from tools.utils.spool_manager import spool_manager
+from tools.utils.segmented_download import get_segmented_content_length, download_in_segments, \
+    RangeNotSupportedError
+from tools.utils.text_extraction import TextExtractOptions, TextExtractor, extract_text
 
 
 def patch_request_headers(http_headers: Optional[Mapping[str, str]]) -> Mapping[str, str]:
@@ -90,67 +46,487 @@ def patch_request_headers(http_headers: Optional[Mapping[str, str]]) -> Mapping[
     return headers
 
 
+@dataclass
+class ResumeState:
+    """
+    State of a download kept across retry attempts.
+    """
+    # validator (ETag or Last-Modified) for resuming with If-Range, None if the download is not resumable
+    validator: Optional[str] = None
+    # metadata from the first full response
+    mime_type: Optional[str] = None
+    filename: Optional[str] = None
+    encoding: Optional[str] = None
+    # headers of the first full response
+    response_headers: Optional[Headers] = None
+    # whether the content is not modified since the cached response
+    is_not_modified: bool = False
+    # options of extracting the text while downloading, None for downloading the raw content only
+    text_options: Optional[TextExtractOptions] = None
+    # text extractor fed with the content written sequentially since the first full response
+    text_extractor: Optional[TextExtractor] = None
+    # timings and transfer details summed over the attempts
+    trace: DownloadTrace = field(default_factory=DownloadTrace)
+
+
 def download_to_temp(method: str, url: str,
                      timeout: float = 5.0,
                      ssl_certificate_verify: bool = True,
                      request_headers: Mapping[str, str] = None,
-                     request_body: Optional[str] = None,
+                     request_body: Optional[Union[str, RequestBody]] = None,
                      proxy_url: Optional[str] = None,
                      cancel_event: threading.Event = None,
                      custom_filename: Optional[str] = None,
                      idx: int = 0,
-                     ) -> tuple[int, Optional[str], Optional[str], Optional[str], Optional[str]]:
+                     size_limit: Optional[SizeLimit] = None,
+                     text_options: Optional[TextExtractOptions] = None,
+                     checksum_algorithms: Optional[Iterable[str]] = None,
+                     expected_checksums: Optional[Mapping[str, str]] = None,
+                     deadline: Optional[Deadline] = None,
+                     is_spool_exempt: Optional[Callable[[], bool]] = None,
+                     ) -> tuple[int, Optional[DownloadedContent], Optional[str], Optional[str], Optional[str]]:
     """
-    Download a file to a temporary file,
-    and return the file path, MIME type, and file name.
-    """""
-    client, should_close_client = client_holder.get_client(proxy_url, ssl_certificate_verify)
+    Download a file into memory if small, or to a temporary file otherwise,
+    and return the downloaded content, MIME type, file name and encoding.
+    Transient errors are retried, resuming from the bytes already downloaded if the server supports Range requests.
+    :param size_limit: limit of the decoded content, either aborted or truncated when exceeded
+    :param text_options: extract the text while downloading, stopping at the max number of characters
+    :param expected_checksums: verified before handing out the content, which fails on any mismatch
+    :param deadline: each attempt is limited by the time remaining until the deadline
+    :param is_spool_exempt: whether the download may start while the spool files are over the budget
+    """
+    trace = DownloadTrace()
+    # reject the unknown checksum algorithms before waiting or sending any request
+    hash_algorithms = get_hash_algorithms(checksum_algorithms, expected_checksums)
+    if not spool_manager.wait_for_space(cancel_event, deadline, is_spool_exempt):
+        metrics_registry.record_download(trace, "cancelled")
+        return idx, None, None, None, None
     request_headers = patch_request_headers(request_headers)
+    request_body = as_request_body(request_body)
+    if request_body:
+        request_headers = request_body.patch_headers(request_headers)
+    size_limiter = DownloadSizeLimiter(url, size_limit)
+    cache_key, cache_entry = lookup_cache_entry(method, url, request_headers, request_body, size_limiter)
+    spooled_file = SpooledContentFile(hash_algorithms=hash_algorithms)
+    pooled_client = client_holder.acquire(proxy_url, ssl_certificate_verify, timeout)
+    client = pooled_client.client
+    # the network backends time the resolving of the host names into the trace
+    trace_token = current_download_trace.set(trace)
     try:
-        with client.stream(
-                method=method,
-                url=url,
-                headers=request_headers,
-                timeout=timeout,
-                content=request_body.encode("utf-8") if request_body else None,
-        ) as response:
-            try:
-                response.raise_for_status()
-            except Exception as e:
-                raise ValueError(
-                    f"Failed to download file from {url}, HTTP status code: {response.status_code}, error: {e}")
+        if cache_entry and cache_entry.is_fresh(request_headers):
+            # serve the fresh cached content without any request
+            result = serve_cached_content(url, cache_entry, custom_filename, spooled_file, size_limiter,
+                                          text_options=text_options, expected_checksums=expected_checksums)
+            if result:
+                trace.cached = True
+                return idx, *finish_download_trace(trace, result)
+            # the cached body is gone, e.g. evicted by a concurrent download, so download it as not cached
+            cache_entry = None
+
+        while True:
+            resume_state = ResumeState(text_options=text_options, trace=trace)
+            attempt = 0
+            while True:
+                if deadline:
+                    deadline.check(url)
+                try:
+                    completed = download_attempt_to_file(
+                        client,
+                        method,
+                        url,
+                        timeout=get_request_timeout(timeout, deadline),
+                        request_headers=request_headers,
+                        request_content=request_body.get_content(
+                            timeout, proxy_url, ssl_certificate_verify) if request_body else None,
+                        cancel_event=cancel_event,
+                        custom_filename=custom_filename,
+                        file=spooled_file,
+                        resume_state=resume_state,
+                        cache_entry=cache_entry,
+                        size_limiter=size_limiter,
+                        deadline=deadline,
+                    )
+                    break
+                except Exception as e:
+                    attempt += 1
+                    if attempt > max_retries or not is_retryable_error(e):
+                        raise
+                    if not wait_before_retry(attempt, e, cancel_event, deadline):
+                        completed = False
+                        break
+
+            if not completed:
+                size_limiter.reset()
+                spooled_file.discard()
+                metrics_registry.record_download(trace, "cancelled")
+                return idx, None, None, None, None
+
+            result = finish_downloaded_content(
+                url, custom_filename, spooled_file, resume_state, size_limiter, cache_key, cache_entry,
+                expected_checksums=expected_checksums)
+            if result:
+                return idx, *finish_download_trace(trace, result)
+            # the revalidated body is gone, e.g. evicted by a concurrent download, so download it as not cached
+            cache_entry = None
+            trace.cached = False
+    except BaseException as e:
+        size_limiter.reset()
+        spooled_file.discard()
+        metrics_registry.record_download(trace, "failed" if isinstance(e, Exception) else "cancelled")
+        raise
+    finally:
+        current_download_trace.reset(trace_token)
+        client_holder.release(pooled_client)
+
+
+def finish_download_trace(trace: DownloadTrace,
+                          result: tuple[DownloadedContent, Optional[str], Optional[str], Optional[str]],
+                          ) -> tuple[DownloadedContent, Optional[str], Optional[str], Optional[str]]:
+    """
+    Keep the metrics of the finished download in the content, and aggregate them into the metrics registry.
+    """
+    content = result[0]
+    trace.finish(content.size)
+    content.metrics = trace.to_meta()
+    metrics_registry.record_download(trace, "succeeded")
+    return result
+
+
+def get_hash_algorithms(checksum_algorithms: Optional[Iterable[str]],
+                        expected_checksums: Optional[Mapping[str, str]]) -> tuple[str, ...]:
+    """
+    :return: the algorithms of the requested and the expected checksums, always including SHA-256
+    """
+    return normalize_hash_algorithms([*(checksum_algorithms or []), *(expected_checksums or {})])
+
+
+def lookup_cache_entry(method: str,
+                       url: str,
+                       request_headers: Mapping[str, str],
+                       request_body: Optional[RequestBody],
+                       size_limiter: DownloadSizeLimiter,
+                       ) -> tuple[Optional[str], Optional[CacheEntry]]:
+    """
+    :return: the cache key of the request if cacheable, and the cached entry fitting in the size limit if any
+    """
+    cache_key = response_cache.get_cache_key(method, url, request_headers, request_body is not None) \
+        if response_cache else None
+    cache_entry = response_cache.lookup(cache_key) if cache_key else None
+    if cache_entry and not size_limiter.fits(cache_entry.size):
+        # leave the size limit to be enforced by downloading
+        cache_entry = None
+    return cache_key, cache_entry
+
+
+def serve_cached_content(url: str,
+                         cache_entry: CacheEntry,
+                         custom_filename: Optional[str],
+                         file: SpooledContentFile,
+                         size_limiter: DownloadSizeLimiter,
+                         revalidated: bool = False,
+                         text_options: Optional[TextExtractOptions] = None,
+                         expected_checksums: Optional[Mapping[str, str]] = None,
+                         ) -> Optional[tuple[DownloadedContent, Optional[str], Optional[str], Optional[str]]]:
+    """
+    :return: the cached content, MIME type, file name and encoding,
+        or None if the cached body is gone, e.g. evicted by a concurrent download, leaving the file unchanged
+    :raises ChecksumMismatchError: if the cached content differs from the expected checksums
+    """
+    if not response_cache.serve(cache_entry, file, revalidated=revalidated):
+        return None
+    size_limiter.accept(cache_entry.size)
+    content = file.to_content()
+    verify_checksums(url, content.checksums, expected_checksums)
+    content = content_store.deduplicate(content)
+    mime_type, filename, encoding = get_cached_metadata(url, cache_entry, custom_filename)
+    if text_options:
+        declared_charset = Response(200, headers=cache_entry.headers).charset_encoding
+        content.text, is_cut_off = extract_text(content.iter_chunks(), text_options, mime_type, declared_charset)
+        content.is_truncated = content.is_truncated or is_cut_off
+    return content, mime_type, filename, encoding
+
+
+def finish_downloaded_content(url: str,
+                              custom_filename: Optional[str],
+                              file: SpooledContentFile,
+                              resume_state: ResumeState,
+                              size_limiter: DownloadSizeLimiter,
+                              cache_key: Optional[str] = None,
+                              cache_entry: Optional[CacheEntry] = None,
+                              expected_checksums: Optional[Mapping[str, str]] = None,
+                              ) -> Optional[tuple[DownloadedContent, Optional[str], Optional[str], Optional[str]]]:
+    """
+    Close the downloaded file, verify its checksums and store the content into the response cache if cacheable.
+    :return: the downloaded content, MIME type, file name and encoding,
+        or None if the content is not modified but the cached body is gone
+    :raises ChecksumMismatchError: if the downloaded content differs from the expected checksums
+    """
+    if resume_state.is_not_modified:
+        # the cached content is revalidated by a 304 Not Modified response
+        response_cache.refresh(cache_entry, resume_state.response_headers)
+        return serve_cached_content(url, cache_entry, custom_filename, file, size_limiter, revalidated=True,
+                                    text_options=resume_state.text_options, expected_checksums=expected_checksums)
+
+    content = file.to_content()
+    # never hand out nor cache the content differing from the expected checksums
+    verify_checksums(url, content.checksums, expected_checksums)
+    content.is_truncated = size_limiter.is_truncated
+    # the rest of the response is skipped once enough text is extracted
+    is_skipped = resume_state.text_extractor is not None and resume_state.text_extractor.is_complete
+    if cache_key and not content.is_truncated and not is_skipped \
+            and response_cache.is_cacheable_response(200, resume_state.response_headers):
+        response_cache.store(cache_key, url, resume_state.response_headers, resume_state.encoding, content)
+    if resume_state.text_extractor:
+        content.text = resume_state.text_extractor.finish()
+        content.is_truncated = content.is_truncated or resume_state.text_extractor.is_cut_off
+
+    # keep byte-identical bodies downloaded from different URLs only once
+    content = content_store.deduplicate(content)
+    return content, resume_state.mime_type, resume_state.filename, resume_state.encoding
+
+
+def download_attempt_to_file(client: Client,
+                             method: str,
+                             url: str,
+                             timeout: Timeout,
+                             request_headers: Mapping[str, str],
+                             request_content: Optional[Union[bytes, Iterable[bytes]]],
+                             cancel_event: Optional[threading.Event],
+                             custom_filename: Optional[str],
+                             file: SpooledContentFile,
+                             resume_state: ResumeState,
+                             cache_entry: Optional[CacheEntry] = None,
+                             size_limiter: Optional[DownloadSizeLimiter] = None,
+                             deadline: Optional[Deadline] = None,
+                             ) -> bool:
+    """
+    Make a single download attempt into the file,
+    resuming from the current position of the file if the previous attempt is resumable,
+    or revalidating the cached entry with a conditional request.
+    :param deadline: the deadline of the invocation, limiting the retries of the segments
+    :return: False if the download is cancelled, otherwise True
+    """
+    size_limiter = size_limiter or DownloadSizeLimiter(url, None)
+    resume_offset = file.tell() if resume_state.validator else 0
+    headers = get_attempt_headers(request_headers, resume_state, resume_offset, cache_entry)
+    trace = resume_state.trace
+    trace.start_attempt()
+
+    with client.stream(
+            method=method,
+            url=url,
+            headers=headers,
+            timeout=timeout,
+            content=request_content,
+            extensions={"download_trace": trace.on_http_event},
+    ) as response:
+        trace.on_response(response.http_version)
+        try:
+            if cache_entry and response.status_code == 304:
+                resume_state.response_headers = response.headers
+                resume_state.is_not_modified = True
+                trace.cached = True
+                return True
+
+            check_response_status(url, response)
 
             # check if the download is cancelled
             if cancel_event and cancel_event.is_set():
-                return idx, None, None, None, None
+                return False
+
+            is_fitting = prepare_file_for_response(
+                method, url, response, custom_filename, file, resume_state, resume_offset, size_limiter)
+            if resume_offset <= 0 or not is_resumed_response(response, resume_offset):
+                # the text is extracted from the content written in order, so not in segments
+                segmented_content_length = get_segmented_content_length(method, response) \
+                    if is_fitting and not resume_state.text_extractor else None
+                if segmented_content_length:
+                    # the bytes received by the segment requests are not tracked
+                    trace.segmented = True
+                    try:
+                        size_limiter.accept(segmented_content_length)
+                        # Download large files in concurrent segments with HTTP Range requests
+                        completed = download_in_segments(
+                            client, url, request_headers, timeout,
+                            response, segmented_content_length, file, cancel_event, deadline)
+                        # segments are written at their offsets, move to the end for consistency
+                        file.seek(0, os.SEEK_END)
+                        return completed
+                    except RangeNotSupportedError:
+                        # Fall back to single stream downloading from the beginning
+                        resume_state.validator = None
+                        file.seek(0)
+                        file.truncate()
+                        size_limiter.reset()
+                        with client.stream(method=method, url=url, headers=request_headers, timeout=timeout,
+                                           extensions={"download_trace": trace.on_http_event}) as fallback_response:
+                            check_response_status(url, fallback_response)
+                            return write_response_to_file(fallback_response, file, cancel_event, size_limiter,
+                                                          trace=trace, throughput_guard=ThroughputGuard(url))
+
+            # Stream the response content to the temporary file
+            return write_response_to_file(response, file, cancel_event, size_limiter, resume_state.text_extractor,
+                                          trace=trace, throughput_guard=ThroughputGuard(url))
+        finally:
+            trace.finish_attempt(None if trace.segmented else response.num_bytes_downloaded)
 
-            content_type = response.headers.get('content-type')
-            encoding = response.encoding
-            filename = custom_filename or guess_file_name(url, response)
-            
-            # 使用文件名推测更准确的 MIME 类型，如果无法推测则使用 HTTP 头中的类型
-            mime_type = guess_mime_type_from_filename(filename, content_type)
 
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                file_path = temp_file.name
-                try:
-                    # Stream the response content to the temporary file
-                    for chunk in response.iter_bytes(chunk_size=8192):
-                        # check if the download is cancelled
-                        if cancel_event and cancel_event.is_set():
-                            return idx, None, None, None, None
-
-                        temp_file.write(chunk)
-                except:
-                    force_delete_path(file_path)
-                    file_path = None
-                finally:
-                    temp_file.close()
-
-        return idx, file_path, mime_type, filename, encoding
-    finally:
-        if should_close_client:
-            client.close()
+def get_attempt_headers(request_headers: Mapping[str, str],
+                        resume_state: ResumeState,
+                        resume_offset: int,
+                        cache_entry: Optional[CacheEntry] = None,
+                        ) -> dict[str, str]:
+    """
+    Get the request headers of a download attempt,
+    with the conditional headers for revalidating the cached entry and the Range headers for resuming.
+    """
+    headers = dict(request_headers)
+    if cache_entry:
+        headers.update(cache_entry.conditional_headers())
+    if resume_offset > 0:
+        headers["Range"] = f"bytes={resume_offset}-"
+        headers["If-Range"] = resume_state.validator
+    return headers
+
+
+def prepare_file_for_response(method: str,
+                              url: str,
+                              response: Response,
+                              custom_filename: Optional[str],
+                              file: SpooledContentFile,
+                              resume_state: ResumeState,
+                              resume_offset: int,
+                              size_limiter: DownloadSizeLimiter,
+                              ) -> bool:
+    """
+    Position the file for writing the content of the successful response,
+    either continuing after the bytes already downloaded or restarting from the beginning,
+    and keep the metadata of a full response in the resume state.
+    :return: True if the expected content length fits in the size limit, False if it is going to be truncated
+    :raises DownloadSizeExceededError: if the expected content length exceeds the size limit
+    """
+    if resume_offset > 0 and is_resumed_response(response, resume_offset):
+        # continue writing after the bytes already downloaded
+        file.seek(resume_offset)
+        file.truncate()
+        size_limiter.reset(resume_offset)
+        return size_limiter.check_content_length(get_content_length(response))
+
+    # (re)start from the beginning with a full response
+    file.seek(0)
+    file.truncate()
+    size_limiter.reset()
+    # fail fast if the expected content length exceeds the size limit
+    is_fitting = size_limiter.check_content_length(get_content_length(response))
+    resume_state.validator = get_resume_validator(method, response)
+    resume_state.response_headers = response.headers
+
+    content_type = response.headers.get('content-type')
+    resume_state.encoding = response.encoding
+    resume_state.filename = custom_filename or guess_file_name(url, response)
+
+    # 使用文件名推测更准确的 MIME 类型，如果无法推测则使用 HTTP 头中的类型
+    resume_state.mime_type = guess_mime_type_from_filename(resume_state.filename, content_type)
+    if resume_state.text_options:
+        resume_state.text_extractor = TextExtractor(
+            resume_state.text_options, resume_state.mime_type, response.charset_encoding)
+
+    content_length = get_content_length(response)
+    if content_length > file.max_memory_size:
+        # write large content to disk directly instead of buffering in memory first
+        file.rollover(content_length)
+    return is_fitting
+
+
+def get_content_length(response: Response) -> int:
+    """
+    :return: the decoded content length from the response headers, or -1 if unknown
+    """
+    if response.headers.get("content-encoding", "identity").lower() != "identity":
+        return -1
+    try:
+        return int(response.headers.get("content-length", ""))
+    except ValueError:
+        return -1
+
+
+def get_cached_metadata(url: str,
+                        cache_entry: CacheEntry,
+                        custom_filename: Optional[str]) -> tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    :return: MIME type, file name and encoding of the cached response
+    """
+    cached_response = Response(200, headers=cache_entry.headers)
+    filename = custom_filename or guess_file_name(url, cached_response)
+    mime_type = guess_mime_type_from_filename(filename, cache_entry.headers.get("content-type"))
+    return mime_type, filename, cache_entry.encoding
+
+
+def is_resumed_response(response: Response, resume_offset: int) -> bool:
+    if response.status_code != 206:
+        return False
+    match = re.match(r"bytes\s+(\d+)-", response.headers.get("content-range", ""))
+    return match is not None and int(match.group(1)) == resume_offset
+
+
+def write_response_to_file(response: Response,
+                           file: SpooledContentFile,
+                           cancel_event: threading.Event = None,
+                           size_limiter: Optional[DownloadSizeLimiter] = None,
+                           text_extractor: Optional[TextExtractor] = None,
+                           trace: Optional[DownloadTrace] = None,
+                           throughput_guard: Optional[ThroughputGuard] = None,
+                           ) -> bool:
+    """
+    Stream the decoded response content to the file.
+    The size limit is enforced on the decoded bytes, guarding against decompression bombs.
+    :return: False if the download is cancelled, otherwise True
+    :raises TransferStalledError: if the content is received slower than the min throughput of the guard
+    """
+    if trace:
+        trace.time_decoding(response)
+    for chunk in response.iter_bytes(chunk_size=8192):
+        # check if the download is cancelled
+        if cancel_event and cancel_event.is_set():
+            return False
+        if throughput_guard:
+            throughput_guard.feed(len(chunk))
+
+        started_at = time.perf_counter()
+        is_continued = write_chunk_to_file(chunk, file, size_limiter, text_extractor)
+        if trace:
+            trace.add_time("write", time.perf_counter() - started_at)
+        if not is_continued:
+            break
+    return True
+
+
+def write_chunk_to_file(chunk: bytes,
+                        file: SpooledContentFile,
+                        size_limiter: Optional[DownloadSizeLimiter],
+                        text_extractor: Optional[TextExtractor] = None,
+                        ) -> bool:
+    """
+    Write the chunk within the size limit, and feed it to the text extractor if any.
+    :return: False if the content is truncated or enough text is extracted,
+        and the rest of the response should be skipped
+    """
+    if size_limiter:
+        allowed_size = size_limiter.accept(len(chunk))
+        if allowed_size < len(chunk):
+            # truncate the content and stop downloading
+            chunk = chunk[:allowed_size]
+            file.write(chunk)
+            if text_extractor:
+                text_extractor.feed(chunk)
+            return False
+
+    file.write(chunk)
+    if text_extractor:
+        text_extractor.feed(chunk)
+        # stop downloading once enough text is extracted
+        return not text_extractor.is_complete
+    return True
 
 
 def guess_file_name(url: str, response: Response) -> Optional[str]:
@@ -224,35 +600,310 @@ def handle_partial_done(cancel_event: threading.Event,
     done_with_exception = [f for f in done if f.exception()]
     # Clean up the downloaded temporary files for those that completed without exceptions
     for future in done_without_exception:
-        file_path, _, _, _ = future.result()
-        force_delete_path(file_path)
+        release_download_result(future)
     # Raise the first exception encountered in the futures
     for future in done_with_exception:
         if future.exception():
             raise future.exception()
 
 
-def handle_all_done(tool: Tool,
-                    done: set[Future[Any]],
-                    is_to_file: bool = True,
-                    ) -> Generator[ToolInvokeMessage, None, None]:
-    # all completed without exceptions
-    sorted_done = sorted(done, key=lambda f: f.result()[0])  # sort by index
-    for future in sorted_done:
-        idx, file_path, mime_type, filename, encoding = future.result()
+def release_result_value(result: Any):
+    """
+    Release the downloaded content of a download result, the (filename, content, ...) tuple of the download functions.
+    """
+    if isinstance(result, tuple) and len(result) > 1 and isinstance(result[1], DownloadedContent):
+        result[1].release()
+
+
+def release_download_result(future: Future[Any]):
+    """
+    Release the downloaded content of the future if completed successfully.
+    """
+    if future.cancelled() or future.exception():
+        return
+    release_result_value(future.result())
+
+
+@dataclass
+class DownloadOutcome:
+    """
+    Outcome of a single download reported in the summary of the partial success mode.
+    """
+    index: int
+    url: Optional[str]
+    # "succeeded", "failed" or "timeout", including the downloads not completed before the deadline
+    status: str
+    # seconds from submitting the download to its completion
+    elapsed: float
+    filename: Optional[str] = None
+    mime_type: Optional[str] = None
+    size: Optional[int] = None
+    truncated: Optional[bool] = None
+    error: Optional[str] = None
+    error_type: Optional[str] = None
+    http_status_code: Optional[int] = None
+
+    @staticmethod
+    def of_future(future: Future[Any], index: int, url: Optional[str], elapsed: float) -> "DownloadOutcome":
+        error = future.exception()
+        if error:
+            return DownloadOutcome(
+                index=index,
+                url=url,
+                status="timeout" if isinstance(error, DeadlineExceededError) else "failed",
+                elapsed=elapsed,
+                error=str(error) or repr(error),
+                error_type=type(error).__name__,
+                http_status_code=getattr(error, "status_code", None),
+            )
+        _, content, mime_type, filename, _ = future.result()
+        return DownloadOutcome(
+            index=index,
+            url=url,
+            status="succeeded",
+            elapsed=elapsed,
+            filename=filename,
+            mime_type=mime_type,
+            size=content.size if content else None,
+            truncated=content.is_truncated if content else None,
+        )
+
+
+def handle_futures_as_completed(tool: Tool,
+                                futures: list[Future[Any]],
+                                cancel_event: threading.Event,
+                                deadline: Optional[Deadline] = None,
+                                is_to_file: bool = True,
+                                is_ordered: bool = True,
+                                is_partial_success: bool = False,
+                                download_inputs: Optional[list[tuple[int, str]]] = None,
+                                bundle: Optional[DownloadBundle] = None,
+                                ) -> Generator[ToolInvokeMessage, None, None]:
+    """
+    Yield the message of each download as soon as it completes,
+    instead of waiting for all the downloads to complete.
+    :param futures: futures of download_to_temp in the order of input
+    :param deadline: deadline of the invocation, after which the downloads not completed are stopped
+    :param is_ordered: if True, yield messages in the order of input, as soon as the download
+        and all its preceding ones complete; otherwise yield in the order of completion,
+        with the index of input in the meta of each message
+    :param is_partial_success: if True, keep the other downloads going when some fail or time out,
+        and yield a JSON summary message of the outcome of each download at the end;
+        otherwise fail fast on the first exception or timeout
+    :param download_inputs: index and URL of the input of each future, reported in the summary
+    :param bundle: if given, compress each downloaded file into the archive as soon as it completes,
+        and yield the archive as a single blob message at the end instead of a message per file
+    """
+    positions = {future: position for position, future in enumerate(futures)}
+    started_at = time.monotonic()
+    timeout = deadline.remaining() if deadline else None
+    completed_at: dict[Future[Any], float] = {}
+    for future in futures:
+        future.add_done_callback(lambda f: completed_at.setdefault(f, time.monotonic()))
+    outcomes: dict[Future[Any], DownloadOutcome] = {}
+
+    def get_input(f: Future[Any]) -> tuple[int, Optional[str]]:
+        return download_inputs[positions[f]] if download_inputs else (positions[f], None)
+
+    def record_outcome(f: Future[Any]):
+        outcomes[f] = DownloadOutcome.of_future(
+            f, *get_input(f), elapsed=completed_at.get(f, time.monotonic()) - started_at)
+
+    def create_messages(f: Future[Any], with_index: bool = False) -> Iterable[ToolInvokeMessage]:
+        yielded_futures.add(f)
+        if bundle:
+            add_download_to_bundle(bundle, f.result())
+            return []
+        return create_download_messages(tool, f.result(), is_to_file, with_index)
+
+    is_completed = [False] * len(futures)
+    next_position = 0
+    yielded_futures: set[Future[Any]] = set()
+    try:
         try:
-            if is_to_file:
-                downloaded_file_bytes = Path(file_path).read_bytes()
+            for future in as_completed(futures, timeout=timeout):
+                if future.exception() and not is_partial_success:
+                    break
+                if is_partial_success:
+                    record_outcome(future)
+
+                if not is_ordered:
+                    if not future.exception():
+                        yield from create_messages(future, with_index=True)
+                    continue
+
+                is_completed[positions[future]] = True
+                while next_position < len(futures) and is_completed[next_position]:
+                    if not futures[next_position].exception():
+                        yield from create_messages(futures[next_position])
+                    next_position += 1
+        except FuturesTimeoutError:
+            pass
+
+        if is_partial_success:
+            not_done = [f for f in futures if f not in outcomes]
+            if not_done:
+                # stop the downloads not completed in time, and report them as timed out
+                cancel_event.set()
+                for f in not_done:
+                    f.cancel()
+                    index, url = get_input(f)
+                    outcomes[f] = DownloadOutcome(index=index, url=url, status="timeout",
+                                                  elapsed=time.monotonic() - started_at,
+                                                  error=f"Deadline of {deadline} exceeded")
+            if is_ordered:
+                # the completed downloads waiting behind a timed out one
+                for f in futures[next_position:]:
+                    if outcomes[f].status == "succeeded":
+                        yield from create_messages(f)
+            if bundle:
+                yield from create_bundle_messages(tool, bundle)
+            yield tool.create_json_message(create_download_summary([outcomes[f] for f in futures]))
+        elif len(yielded_futures) < len(futures):
+            # failed fast with the first exception or timeout
+            done = {f for f in futures if f.done() and f not in yielded_futures}
+            not_done = {f for f in futures if not f.done()}
+            handle_partial_done(cancel_event, done, not_done)
+            raise DeadlineExceededError(f"Deadline of {deadline} exceeded, "
+                                        f"{len(not_done)} of {len(futures)} downloads are not completed")
+        elif bundle:
+            yield from create_bundle_messages(tool, bundle)
+    finally:
+        if bundle:
+            bundle.discard()
+        # Clean up the downloaded temporary files not yielded, e.g. when the generator is closed early,
+        # including those completing after being cancelled
+        for future in futures:
+            if future not in yielded_futures:
+                future.add_done_callback(release_download_result)
+
+
+def add_download_to_bundle(bundle: DownloadBundle,
+                           result: tuple[int, Optional[DownloadedContent], Optional[str], Optional[str], Optional[str]],
+                           ):
+    idx, content, _, filename, _ = result
+    try:
+        bundle.add(filename, content, idx)
+    finally:
+        # Release the downloaded content once compressed into the archive
+        content.release()
+
+
+def create_bundle_messages(tool: Tool, bundle: DownloadBundle) -> Generator[ToolInvokeMessage, None, None]:
+    content = bundle.finish()
+    try:
+        meta = {
+            "mime_type": bundle.mime_type,
+            "filename": bundle.filename,
+            "files": len(bundle.entry_names),
+        }
+        yield from create_blob_chunk_messages(content, meta)
+    finally:
+        content.release()
+
+
+def create_download_summary(outcomes: list[DownloadOutcome]) -> dict[str, Any]:
+    return {
+        "total": len(outcomes),
+        "succeeded": sum(1 for o in outcomes if o.status == "succeeded"),
+        "failed": sum(1 for o in outcomes if o.status == "failed"),
+        "timeout": sum(1 for o in outcomes if o.status == "timeout"),
+        "results": [{k: round(v, 3) if k == "elapsed" else v for k, v in asdict(o).items() if v is not None}
+                    for o in outcomes],
+    }
+
+
+def create_download_messages(tool: Tool,
+                             result: tuple[int, Optional[DownloadedContent], Optional[str], Optional[str], Optional[str]],
+                             is_to_file: bool = True,
+                             with_index: bool = False,
+                             ) -> Generator[ToolInvokeMessage, None, None]:
+    idx, content, mime_type, filename, encoding = result
+    try:
+        if is_to_file:
+            meta = {
+                "mime_type": mime_type,
+                "filename": filename,
+            }
+            if with_index:
+                meta["index"] = idx
+            if content.is_truncated:
+                meta["truncated"] = True
+            meta["size"] = content.size
+            meta.update(content.checksums)
+            if content.is_in_memory:
+                started_at = time.perf_counter()
+                blob = content.read_bytes()
+                meta["metrics"] = get_message_metrics(content, time.perf_counter() - started_at)
                 yield tool.create_blob_message(
-                    blob=downloaded_file_bytes,
-                    meta={
-                        "mime_type": mime_type,
-                        "filename": filename,
-                    }
+                    blob=blob,
+                    meta=meta,
                 )
             else:
-                downloaded_file_text = Path(file_path).read_text(encoding=encoding or "utf-8")
-                yield tool.create_text_message(text=downloaded_file_text)
-        finally:
-            # Clean up the downloaded temporary files
-            force_delete_path(file_path)
+                # stream large files from disk in chunks instead of loading into memory
+                meta["metrics"] = get_message_metrics(content)
+                yield from create_blob_chunk_messages(content, meta)
+        else:
+            started_at = time.perf_counter()
+            downloaded_file_text = content.text if content.text is not None \
+                else content.read_text(encoding=encoding or "utf-8")
+            message = tool.create_text_message(text=downloaded_file_text)
+            message.meta = {"index": idx} if with_index else {}
+            if content.is_truncated:
+                message.meta["truncated"] = True
+            message.meta["metrics"] = get_message_metrics(content, time.perf_counter() - started_at)
+            yield message
+    finally:
+        # Release the downloaded content
+        content.release()
+
+
+def get_message_metrics(content: DownloadedContent, read_time: Optional[float] = None) -> Optional[dict[str, Any]]:
+    """
+    :param read_time: seconds of reading the content into the message, None if streamed in chunks
+    :return: the metrics of the download with the read time of the result handler
+    """
+    if read_time is not None:
+        metrics_registry.observe("phase_seconds", read_time, phase="read")
+    if content.metrics is None:
+        return None
+    metrics = dict(content.metrics)
+    if read_time is not None:
+        metrics["timings_ms"] = {**metrics["timings_ms"], "read": round(read_time * 1000, 3)}
+    return metrics
+
+
+def create_blob_chunk_messages(content: DownloadedContent, meta: dict) -> Generator[ToolInvokeMessage, None, None]:
+    """
+    Create the blob chunk messages of the content, the same as how the plugin SDK sends a blob message in chunks,
+    without materializing the whole content as a single bytes object.
+    """
+    blob_id = uuid.uuid4().hex
+    total_length = content.size
+    sequence = 0
+    for chunk in content.iter_chunks(BLOB_CHUNK_SIZE):
+        yield ToolInvokeMessage(
+            type=ToolInvokeMessage.MessageType.BLOB_CHUNK,
+            message=ToolInvokeMessage.BlobChunkMessage(
+                id=blob_id,
+                sequence=sequence,
+                total_length=total_length,
+                blob=chunk,
+                end=False,
+            ),
+            meta=meta,
+        )
+        sequence += 1
+
+    # end the file stream
+    yield ToolInvokeMessage(
+        type=ToolInvokeMessage.MessageType.BLOB_CHUNK,
+        message=ToolInvokeMessage.BlobChunkMessage(
+            id=blob_id,
+            sequence=sequence,
+            total_length=total_length,
+            blob=b"",
+            end=True,
+        ),
+        meta=meta,
+    )
@@ -0,0 +1,36 @@
+import os
+from typing import Optional
+
+
+def get_env_str(name: str, default: Optional[str] = None) -> Optional[str]:
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip()
+
+
+def get_env_int(name: str, default: int) -> int:
+    value = get_env_str(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"Invalid integer value for environment variable {name}: {value}")
+
+
+def get_env_float(name: str, default: float) -> float:
+    value = get_env_str(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"Invalid float value for environment variable {name}: {value}")
+
+
+def get_env_bool(name: str, default: bool) -> bool:
+    value = get_env_str(name)
+    if value is None:
+        return default
+    return value.lower() in ["1", "true", "yes", "on"]
@@ -1,3 +1,6 @@
+import os
+import shutil
+import uuid
 from pathlib import Path
 
 
@@ -5,4 +8,21 @@ def force_delete_path(path:str):
     try:
         Path(path).unlink(missing_ok=True)
     except:
-        pass
\ No newline at end of file
+        pass
+
+
+def link_to_path(source: Path, target: Path):
+    """
+    Atomically replace the target with the content of the source,
+    by hard linking if possible and falling back to copying.
+    """
+    tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+    except:
+        force_delete_path(str(tmp_path))
+        raise
@@ -0,0 +1,111 @@
+import hashlib
+import re
+import zlib
+from collections.abc import Iterable
+from typing import Optional, Mapping, Any
+
+# SHA-256 is always computed, as the digest identifying the content
+HASH_ALGORITHMS = ["sha256", "md5", "crc32"]
+
+# hex digest lengths for guessing the algorithm of an expected checksum without the algorithm prefix
+_HEX_DIGEST_LENGTHS = {64: "sha256", 32: "md5", 8: "crc32"}
+
+
+class ChecksumMismatchError(ValueError):
+    """
+    Raised when the checksum of the downloaded content differs from the expected one.
+    """
+
+    def __init__(self, message: str, algorithm: str, expected: str, actual: Optional[str]):
+        super().__init__(message)
+        self.algorithm = algorithm
+        self.expected = expected
+        self.actual = actual
+
+
+class _Crc32:
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data: bytes):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self) -> str:
+        return f"{self._value & 0xFFFFFFFF:08x}"
+
+
+def _new_hash(algorithm: str) -> Any:
+    if algorithm == "crc32":
+        return _Crc32()
+    return hashlib.new(algorithm)
+
+
+def normalize_hash_algorithms(algorithms: Optional[Iterable[str]]) -> tuple[str, ...]:
+    """
+    :return: the distinct algorithms in the order of HASH_ALGORITHMS, always including SHA-256
+    """
+    requested = {"sha256", *(a.strip().lower() for a in algorithms or [] if a and a.strip())}
+    unknown = requested - set(HASH_ALGORITHMS)
+    if unknown:
+        raise ValueError(f"Invalid checksum algorithms: {sorted(unknown)}, expected some of {HASH_ALGORITHMS}")
+    return tuple(a for a in HASH_ALGORITHMS if a in requested)
+
+
+class ContentHasher:
+    """
+    Computes the checksums of multiple algorithms in a single pass over the content.
+    """
+
+    def __init__(self, algorithms: Iterable[str] = ("sha256",)):
+        self.algorithms = normalize_hash_algorithms(algorithms)
+        self._hashes = {algorithm: _new_hash(algorithm) for algorithm in self.algorithms}
+        # number of bytes hashed
+        self.size = 0
+
+    def update(self, data: bytes):
+        for h in self._hashes.values():
+            h.update(data)
+        self.size += len(data)
+
+    def hexdigests(self) -> dict[str, str]:
+        return {algorithm: h.hexdigest() for algorithm, h in self._hashes.items()}
+
+
+def parse_expected_checksums(value: Optional[str]) -> dict[str, str]:
+    """
+    Parse the expected checksums separated by commas or spaces, each in the format of `algorithm:hex_digest`,
+    or a bare hex digest of which the algorithm is guessed by its length, e.g. `sha256:9f86...` or `d41d8cd9...`.
+    """
+    checksums = {}
+    for item in re.split(r"[\s,;]+", (value or "").strip()):
+        if not item:
+            continue
+        algorithm, _, digest = item.rpartition(":")
+        algorithm = algorithm.lower().replace("-", "") or _HEX_DIGEST_LENGTHS.get(len(digest))
+        digest = digest.lower()
+        if algorithm not in HASH_ALGORITHMS or not re.fullmatch(r"[0-9a-f]+", digest):
+            raise ValueError(f"Invalid expected checksum: {item}, "
+                             f"expected `algorithm:hex_digest` with algorithm in {HASH_ALGORITHMS}")
+        checksums[algorithm] = digest
+    return checksums
+
+
+def verify_checksums(url: str, checksums: Mapping[str, str], expected_checksums: Optional[Mapping[str, str]]):
+    """
+    :raises ValueError: if any of the expected checksums is of an unknown algorithm
+    :raises ChecksumMismatchError: if any of the checksums differs from the expected one or is not computed
+    """
+    expected_checksums = {a.strip().lower(): e for a, e in (expected_checksums or {}).items()}
+    normalize_hash_algorithms(expected_checksums)
+    for algorithm, expected in expected_checksums.items():
+        actual = checksums.get(algorithm)
+        if actual is None:
+            raise ChecksumMismatchError(
+                f"Checksum {algorithm} of the file downloaded from {url} is not computed, "
+                f"so it can not be verified against the expected {expected}",
+                algorithm, expected, actual)
+        if actual != expected.lower():
+            raise ChecksumMismatchError(
+                f"Checksum mismatch of the file downloaded from {url}, "
+                f"expected {algorithm} {expected}, but got {actual}",
+                algorithm, expected, actual)
@@ -0,0 +1,333 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Optional, Mapping, Any
+
+from tools.utils.content_utils import DownloadedContent, SpooledContentFile
+from tools.utils.download_metrics import metrics_registry
+from tools.utils.env_utils import get_env_str, get_env_int
+from tools.utils.file_utils import force_delete_path, link_to_path
+
+DEFAULT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+# request headers not affecting the cached (decoded) content
+IGNORED_REQUEST_HEADERS = {
+    "accept-encoding",
+    "connection",
+    "keep-alive",
+    "if-none-match",
+    "if-modified-since",
+    "if-range",
+    "range",
+    "cache-control",
+    "pragma",
+}
+
+# response headers kept in cache entries
+STORED_RESPONSE_HEADERS = {
+    "content-type",
+    "content-disposition",
+    "etag",
+    "last-modified",
+    "cache-control",
+    "expires",
+    "date",
+    "age",
+}
+
+
+def parse_cache_control(value: Optional[str]) -> dict[str, Optional[str]]:
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class CacheEntry:
+    key: str
+    url: str
+    headers: dict[str, str]
+    encoding: Optional[str]
+    size: int
+    stored_at: float
+    # SHA-256 hex digest of the body
+    digest: Optional[str] = None
+
+    def freshness_lifetime(self) -> float:
+        cache_control = parse_cache_control(self.headers.get("cache-control"))
+        if "no-cache" in cache_control:
+            return 0
+        max_age = cache_control.get("max-age")
+        if max_age and max_age.isdigit():
+            return float(max_age)
+        expires = parse_http_date(self.headers.get("expires"))
+        if expires is not None:
+            date = parse_http_date(self.headers.get("date")) or self.stored_at
+            return max(0.0, expires - date)
+        return 0
+
+    def is_fresh(self, request_headers: Mapping[str, str]) -> bool:
+        request_cache_control = parse_cache_control(_get_header(request_headers, "cache-control"))
+        if "no-cache" in request_cache_control or "max-age" in request_cache_control:
+            return False
+        age = time.time() - self.stored_at
+        initial_age = self.headers.get("age", "")
+        if initial_age.isdigit():
+            age += int(initial_age)
+        return age < self.freshness_lifetime()
+
+    def conditional_headers(self) -> dict[str, str]:
+        headers = {}
+        if self.headers.get("etag"):
+            headers["If-None-Match"] = self.headers["etag"]
+        if self.headers.get("last-modified"):
+            headers["If-Modified-Since"] = self.headers["last-modified"]
+        return headers
+
+
+class ResponseCache:
+    """
+    On-disk cache of downloaded response bodies with LRU eviction under a size budget.
+    Entries are revalidated with If-None-Match / If-Modified-Since once they are no longer fresh.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # key -> body size, in order of least recently used first
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._total_size = 0
+        # stats
+        self._hits = 0
+        self._revalidated_hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+        self._bytes_saved = 0
+        self._is_index_loaded = False
+
+    def _ensure_index(self):
+        """
+        Load the index of the cached entries on first use, instead of scanning the cache directory on startup.
+        """
+        if self._is_index_loaded:
+            return
+        with self._lock:
+            if self._is_index_loaded:
+                return
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._load_index()
+            self._is_index_loaded = True
+
+    def _load_index(self):
+        entries = []
+        for meta_path in self.directory.glob("*.json"):
+            body_path = meta_path.with_suffix(".body")
+            try:
+                entries.append((meta_path.stat().st_mtime, meta_path.stem, body_path.stat().st_size))
+            except OSError:
+                force_delete_path(str(meta_path))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_size += size
+
+    def _meta_path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _body_path(self, key: str) -> Path:
+        return self.directory / f"{key}.body"
+
+    @staticmethod
+    def get_cache_key(method: str,
+                      url: str,
+                      request_headers: Optional[Mapping[str, str]],
+                      has_request_body: bool = False) -> Optional[str]:
+        """
+        :return: the cache key of the request, or None if the request is not cacheable
+        """
+        if method.upper() != "GET" or has_request_body:
+            return None
+        if "no-store" in parse_cache_control(_get_header(request_headers, "cache-control")):
+            return None
+        relevant_headers = sorted(
+            (k.lower(), v) for k, v in (request_headers or {}).items()
+            if k.lower() not in IGNORED_REQUEST_HEADERS)
+        raw_key = json.dumps([method.upper(), url, relevant_headers], ensure_ascii=False)
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_cacheable_response(status_code: int, response_headers: Mapping[str, str]) -> bool:
+        if status_code != 200:
+            return False
+        if "no-store" in parse_cache_control(response_headers.get("cache-control")):
+            return False
+        if response_headers.get("vary", "").strip() == "*":
+            return False
+        return True
+
+    def lookup(self, key: str) -> Optional[CacheEntry]:
+        self._ensure_index()
+        with self._lock:
+            if key not in self._index:
+                self._misses += 1
+                return None
+            self._index.move_to_end(key)
+        try:
+            data = json.loads(self._meta_path(key).read_text(encoding="utf-8"))
+            entry = CacheEntry(**data)
+            os.utime(self._meta_path(key))
+            return entry
+        except (OSError, ValueError, TypeError):
+            self._remove(key)
+            with self._lock:
+                self._misses += 1
+            return None
+
+    def serve(self, entry: CacheEntry, spooled_file: SpooledContentFile, revalidated: bool = False) -> bool:
+        """
+        Replace the content of the spooled file with the cached body.
+        :return: False if the cached body is gone since the lookup, e.g. evicted by a concurrent store,
+            in which case the entry is removed and the spooled file is left unchanged
+        """
+        try:
+            spooled_file.replace_with_file(str(self._body_path(entry.key)), entry.size, entry.digest)
+        except OSError:
+            self._remove(entry.key)
+            with self._lock:
+                self._misses += 1
+            return False
+        with self._lock:
+            if revalidated:
+                self._revalidated_hits += 1
+            else:
+                self._hits += 1
+            self._bytes_saved += entry.size
+        return True
+
+    def refresh(self, entry: CacheEntry, response_headers: Mapping[str, str]):
+        """
+        Update the stored headers and the storing time of the entry after a 304 Not Modified response.
+        """
+        for name in STORED_RESPONSE_HEADERS:
+            value = response_headers.get(name)
+            if value is not None:
+                entry.headers[name] = value
+        entry.stored_at = time.time()
+        self._write_meta(entry)
+
+    def store(self,
+              key: str,
+              url: str,
+              response_headers: Mapping[str, str],
+              encoding: Optional[str],
+              content: DownloadedContent):
+        size = content.size
+        if size > self.max_size:
+            return
+        self._ensure_index()
+        entry = CacheEntry(
+            key=key,
+            url=url,
+            headers={k: v for k, v in ((name, response_headers.get(name)) for name in STORED_RESPONSE_HEADERS) if v},
+            encoding=encoding,
+            size=size,
+            stored_at=time.time(),
+            digest=content.digest,
+        )
+        body_path = self._body_path(key)
+        if content.is_in_memory:
+            tmp_path = body_path.with_name(f"{body_path.name}.{uuid.uuid4().hex}.tmp")
+            try:
+                tmp_path.write_bytes(content.read_bytes())
+                os.replace(tmp_path, body_path)
+            except:
+                force_delete_path(str(tmp_path))
+                raise
+        else:
+            link_to_path(Path(content.file_path), body_path)
+        self._write_meta(entry)
+        with self._lock:
+            self._total_size += size - self._index.get(key, 0)
+            self._index[key] = size
+            self._index.move_to_end(key)
+            self._stores += 1
+            evicted_keys = []
+            while self._total_size > self.max_size and self._index:
+                evicted_key, evicted_size = self._index.popitem(last=False)
+                self._total_size -= evicted_size
+                self._evictions += 1
+                evicted_keys.append(evicted_key)
+        for evicted_key in evicted_keys:
+            self._delete_files(evicted_key)
+
+    def _write_meta(self, entry: CacheEntry):
+        meta_path = self._meta_path(entry.key)
+        tmp_path = meta_path.with_name(f"{meta_path.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_text(json.dumps(asdict(entry), ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, meta_path)
+
+    def _remove(self, key: str):
+        self._ensure_index()
+        with self._lock:
+            size = self._index.pop(key, None)
+            if size is not None:
+                self._total_size -= size
+        self._delete_files(key)
+
+    def _delete_files(self, key: str):
+        force_delete_path(str(self._meta_path(key)))
+        force_delete_path(str(self._body_path(key)))
+
+    def stats(self) -> dict[str, Any]:
+        self._ensure_index()
+        with self._lock:
+            return {
+                "entries": len(self._index),
+                "total_size": self._total_size,
+                "max_size": self.max_size,
+                "hits": self._hits,
+                "revalidated_hits": self._revalidated_hits,
+                "misses": self._misses,
+                "stores": self._stores,
+                "evictions": self._evictions,
+                "bytes_saved": self._bytes_saved,
+            }
+
+
+def _get_header(headers: Optional[Mapping[str, str]], name: str) -> Optional[str]:
+    for k, v in (headers or {}).items():
+        if k.lower() == name:
+            return v
+    return None
+
+
+def create_response_cache() -> Optional[ResponseCache]:
+    cache_dir = get_env_str("DOWNLOAD_CACHE_DIR")
+    if not cache_dir:
+        return None
+    return ResponseCache(cache_dir, get_env_int("DOWNLOAD_CACHE_MAX_SIZE", DEFAULT_CACHE_MAX_SIZE))
+
+
+response_cache = create_response_cache()
+if response_cache:
+    metrics_registry.register_collector("response_cache", response_cache.stats)
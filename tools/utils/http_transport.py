@@ -0,0 +1,368 @@
+import contextlib
+import ipaddress
+import time
+import urllib.request
+from collections.abc import AsyncIterator, Iterable, Iterator
+from typing import Optional, Union
+
+import httpcore
+import httpx
+from httpcore import (AsyncNetworkBackend, AsyncNetworkStream, ConnectError, NetworkBackend, NetworkError,
+                      NetworkStream, TimeoutException)
+from httpx import (AsyncBaseTransport, AsyncByteStream, BaseTransport, Limits, Proxy, Request, Response,
+                   SyncByteStream, create_ssl_context)
+
+from tools.utils.dns_cache import DnsCache, WarmStreams, prewarm_idle_timeout
+from tools.utils.download_metrics import current_download_trace
+
+# the most specific public httpx exception of each httpcore exception, as httpx raises for its own transports
+_HTTPCORE_EXCEPTIONS: dict[type[Exception], type[httpx.HTTPError]] = {
+    httpcore.TimeoutException: httpx.TimeoutException,
+    httpcore.ConnectTimeout: httpx.ConnectTimeout,
+    httpcore.ReadTimeout: httpx.ReadTimeout,
+    httpcore.WriteTimeout: httpx.WriteTimeout,
+    httpcore.PoolTimeout: httpx.PoolTimeout,
+    httpcore.NetworkError: httpx.NetworkError,
+    httpcore.ConnectError: httpx.ConnectError,
+    httpcore.ReadError: httpx.ReadError,
+    httpcore.WriteError: httpx.WriteError,
+    httpcore.ProxyError: httpx.ProxyError,
+    httpcore.UnsupportedProtocol: httpx.UnsupportedProtocol,
+    httpcore.ProtocolError: httpx.ProtocolError,
+    httpcore.LocalProtocolError: httpx.LocalProtocolError,
+    httpcore.RemoteProtocolError: httpx.RemoteProtocolError,
+}
+
+
+@contextlib.contextmanager
+def map_httpcore_exceptions() -> Iterator[None]:
+    try:
+        yield
+    except Exception as e:
+        mapped = None
+        for httpcore_class, httpx_class in _HTTPCORE_EXCEPTIONS.items():
+            if isinstance(e, httpcore_class) and (mapped is None or issubclass(httpx_class, mapped)):
+                mapped = httpx_class
+        if mapped is None:
+            raise
+        raise mapped(str(e)) from e
+
+
+class _ResponseStream(SyncByteStream):
+    def __init__(self, stream: Iterator[bytes]):
+        self._stream = stream
+
+    def __iter__(self) -> Iterator[bytes]:
+        with map_httpcore_exceptions():
+            yield from self._stream
+
+    def close(self):
+        if hasattr(self._stream, "close"):
+            self._stream.close()
+
+
+class _AsyncResponseStream(AsyncByteStream):
+    def __init__(self, stream: AsyncIterator[bytes]):
+        self._stream = stream
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        with map_httpcore_exceptions():
+            async for chunk in self._stream:
+                yield chunk
+
+    async def aclose(self):
+        if hasattr(self._stream, "aclose"):
+            await self._stream.aclose()
+
+
+def _to_httpcore_request(request: Request) -> httpcore.Request:
+    return httpcore.Request(
+        method=request.method,
+        url=httpcore.URL(
+            scheme=request.url.raw_scheme,
+            host=request.url.raw_host,
+            port=request.url.port,
+            target=request.url.raw_path,
+        ),
+        headers=request.headers.raw,
+        content=request.stream,
+        extensions=request.extensions,
+    )
+
+
+def _on_dns_resolved(seconds: float):
+    trace = current_download_trace.get()
+    if trace is not None:
+        trace.on_dns_resolved(seconds)
+
+
+class CachingNetworkBackend(NetworkBackend):
+    """
+    Network backend of httpcore connecting to the addresses resolved by the DNS cache,
+    while the TLS handshake still verifies the host name of the origin.
+    The time of resolving is reported to the trace of the current download as its dns phase.
+    A connection opened ahead by warm_tcp is handed out to the first request connecting to the same address.
+    """
+
+    def __init__(self, backend: NetworkBackend, dns_cache: DnsCache):
+        self._backend = backend
+        self._dns_cache = dns_cache
+        self.warm_streams = WarmStreams(prewarm_idle_timeout)
+
+    def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                    local_address: Optional[str] = None, socket_options: Optional[Iterable] = None,
+                    ) -> NetworkStream:
+        stream, stale_streams = self.warm_streams.take(host, port)
+        for stale_stream in stale_streams:
+            stale_stream.close()
+        if stream is not None and local_address is None and socket_options is None:
+            return stream
+        if stream is not None:
+            stream.close()
+        return self._connect_tcp(host, port, timeout, local_address, socket_options)
+
+    def _connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                     local_address: Optional[str] = None, socket_options: Optional[Iterable] = None,
+                     ) -> NetworkStream:
+        started_at = time.perf_counter()
+        try:
+            addresses = self._dns_cache.resolve(host, port)
+        except OSError as e:
+            raise ConnectError(e) from e
+        finally:
+            _on_dns_resolved(time.perf_counter() - started_at)
+        error = None
+        for address in addresses:
+            try:
+                return self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except ConnectError as e:
+                # try the next address of the host
+                error = e
+        raise error
+
+    def warm_tcp(self, host: str, port: int, timeout: Optional[float] = None) -> bool:
+        """
+        Open a TCP connection to the address ahead of the requests, without sending anything over it.
+        :return: False if failed to connect, which is left to the requests to report
+        """
+        try:
+            self.warm_streams.put(host, port, self._connect_tcp(host, port, timeout))
+            return True
+        except (NetworkError, TimeoutException):
+            return False
+
+    def connect_unix_socket(self, path: str, timeout: Optional[float] = None,
+                            socket_options: Optional[Iterable] = None) -> NetworkStream:
+        return self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    def sleep(self, seconds: float):
+        self._backend.sleep(seconds)
+
+
+class AsyncCachingNetworkBackend(AsyncNetworkBackend):
+    """
+    Coroutine version of CachingNetworkBackend.
+    """
+
+    def __init__(self, backend: AsyncNetworkBackend, dns_cache: DnsCache):
+        self._backend = backend
+        self._dns_cache = dns_cache
+        self.warm_streams = WarmStreams(prewarm_idle_timeout)
+
+    async def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                          local_address: Optional[str] = None, socket_options: Optional[Iterable] = None,
+                          ) -> AsyncNetworkStream:
+        stream, stale_streams = self.warm_streams.take(host, port)
+        for stale_stream in stale_streams:
+            await stale_stream.aclose()
+        if stream is not None and local_address is None and socket_options is None:
+            return stream
+        if stream is not None:
+            await stream.aclose()
+        return await self._connect_tcp(host, port, timeout, local_address, socket_options)
+
+    async def _connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                           local_address: Optional[str] = None, socket_options: Optional[Iterable] = None,
+                           ) -> AsyncNetworkStream:
+        started_at = time.perf_counter()
+        try:
+            addresses = await self._dns_cache.async_resolve(host, port)
+        except OSError as e:
+            raise ConnectError(e) from e
+        finally:
+            _on_dns_resolved(time.perf_counter() - started_at)
+        error = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except ConnectError as e:
+                # try the next address of the host
+                error = e
+        raise error
+
+    async def warm_tcp(self, host: str, port: int, timeout: Optional[float] = None) -> bool:
+        """
+        Coroutine version of CachingNetworkBackend.warm_tcp.
+        """
+        try:
+            self.warm_streams.put(host, port, await self._connect_tcp(host, port, timeout))
+            return True
+        except (NetworkError, TimeoutException):
+            return False
+
+    async def connect_unix_socket(self, path: str, timeout: Optional[float] = None,
+                                  socket_options: Optional[Iterable] = None) -> AsyncNetworkStream:
+        return await self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds: float):
+        await self._backend.sleep(seconds)
+
+
+def _count_idle_connections(pool: Union[httpcore.ConnectionPool, httpcore.AsyncConnectionPool], origin: str) -> int:
+    url = httpx.URL(origin)
+    request_origin = httpcore.Origin(scheme=url.raw_scheme, host=url.raw_host,
+                                     port=url.port or (443 if url.scheme == "https" else 80))
+    return sum(1 for connection in pool.connections
+               if connection.is_idle() and connection.can_handle_request(request_origin))
+
+
+class CachingDnsTransport(BaseTransport):
+    """
+    Transport of httpx over a connection pool of httpcore, opening its connections with the caching network backend,
+    in place of the default transport which does not take a network backend.
+    """
+
+    def __init__(self, pool: httpcore.ConnectionPool, network_backend: CachingNetworkBackend):
+        self.pool = pool
+        self.network_backend = network_backend
+
+    def handle_request(self, request: Request) -> Response:
+        with map_httpcore_exceptions():
+            response = self.pool.handle_request(_to_httpcore_request(request))
+        return Response(status_code=response.status, headers=response.headers,
+                        stream=_ResponseStream(response.stream), extensions=response.extensions)
+
+    def count_idle_connections(self, origin: str) -> int:
+        """
+        :return: the number of the idle keep-alive connections of the pool serving the requests to the origin
+        """
+        return _count_idle_connections(self.pool, origin)
+
+    def close(self):
+        self.pool.close()
+        for stream in self.network_backend.warm_streams.pop_all():
+            stream.close()
+
+
+class AsyncCachingDnsTransport(AsyncBaseTransport):
+    """
+    Coroutine version of CachingDnsTransport.
+    """
+
+    def __init__(self, pool: httpcore.AsyncConnectionPool, network_backend: AsyncCachingNetworkBackend):
+        self.pool = pool
+        self.network_backend = network_backend
+
+    async def handle_async_request(self, request: Request) -> Response:
+        with map_httpcore_exceptions():
+            response = await self.pool.handle_async_request(_to_httpcore_request(request))
+        return Response(status_code=response.status, headers=response.headers,
+                        stream=_AsyncResponseStream(response.stream), extensions=response.extensions)
+
+    def count_idle_connections(self, origin: str) -> int:
+        return _count_idle_connections(self.pool, origin)
+
+    async def aclose(self):
+        await self.pool.aclose()
+        for stream in self.network_backend.warm_streams.pop_all():
+            await stream.aclose()
+
+
+def create_transport(dns_cache: DnsCache,
+                     verify: bool,
+                     http2: bool,
+                     limits: Limits,
+                     proxy_url: Optional[str] = None,
+                     is_async: bool = False,
+                     ) -> Union[CachingDnsTransport, AsyncCachingDnsTransport]:
+    """
+    Create the transport of the configuration, connecting either directly or through the HTTP or SOCKS proxy,
+    with the connections opened by the caching network backend, including the connections to the proxy.
+    """
+    if is_async:
+        network_backend = AsyncCachingNetworkBackend(httpcore.AnyIOBackend(), dns_cache)
+        pool_classes = (httpcore.AsyncConnectionPool, httpcore.AsyncHTTPProxy, httpcore.AsyncSOCKSProxy)
+    else:
+        network_backend = CachingNetworkBackend(httpcore.SyncBackend(), dns_cache)
+        pool_classes = (httpcore.ConnectionPool, httpcore.HTTPProxy, httpcore.SOCKSProxy)
+    pool_class, http_proxy_class, socks_proxy_class = pool_classes
+    options = dict(
+        ssl_context=create_ssl_context(verify=verify),
+        max_connections=limits.max_connections,
+        max_keepalive_connections=limits.max_keepalive_connections,
+        keepalive_expiry=limits.keepalive_expiry,
+        http1=True,
+        http2=http2,
+        network_backend=network_backend,
+    )
+    proxy = Proxy(url=proxy_url) if proxy_url else None
+    if proxy is None:
+        pool = pool_class(**options)
+    else:
+        proxy_origin = httpcore.URL(
+            scheme=proxy.url.raw_scheme,
+            host=proxy.url.raw_host,
+            port=proxy.url.port,
+            target=proxy.url.raw_path,
+        )
+        if proxy.url.scheme in ("http", "https"):
+            pool = http_proxy_class(proxy_url=proxy_origin, proxy_auth=proxy.raw_auth,
+                                    proxy_headers=proxy.headers.raw, proxy_ssl_context=proxy.ssl_context, **options)
+        else:
+            # httpx.Proxy raises ValueError for the schemes other than http, https, socks5 and socks5h
+            pool = socks_proxy_class(proxy_url=proxy_origin, proxy_auth=proxy.raw_auth, **options)
+    transport_class = AsyncCachingDnsTransport if is_async else CachingDnsTransport
+    return transport_class(pool, network_backend)
+
+
+def get_env_proxy_urls() -> dict[str, Optional[str]]:
+    """
+    The proxies of the environment variables, e.g. HTTPS_PROXY, ALL_PROXY and NO_PROXY,
+    which httpx only applies by itself to the clients without a transport given.
+    :return: the URL pattern of the mounts of httpx, and the proxy URL of the matching requests,
+        None for the requests not going through any proxy
+    """
+    env_proxies = urllib.request.getproxies()
+    proxy_urls: dict[str, Optional[str]] = {}
+    for scheme in ("http", "https", "all"):
+        url = env_proxies.get(scheme)
+        if url:
+            proxy_urls[f"{scheme}://"] = url if "://" in url else f"http://{url}"
+    for host in (h.strip() for h in env_proxies.get("no", "").split(",")):
+        if host == "*":
+            return {}
+        if not host:
+            continue
+        if "://" in host:
+            proxy_urls[host] = None
+        elif _is_ipv6_address(host):
+            proxy_urls[f"all://[{host}]"] = None
+        elif _is_ipv4_address(host) or host.lower() == "localhost":
+            proxy_urls[f"all://{host}"] = None
+        else:
+            proxy_urls[f"all://*{host}"] = None
+    return proxy_urls
+
+
+def _is_ipv4_address(host: str) -> bool:
+    try:
+        return isinstance(ipaddress.ip_address(host.split("/")[0]), ipaddress.IPv4Address)
+    except ValueError:
+        return False
+
+
+def _is_ipv6_address(host: str) -> bool:
+    try:
+        return isinstance(ipaddress.ip_address(host.split("/")[0]), ipaddress.IPv6Address)
+    except ValueError:
+        return False
@@ -5,6 +5,10 @@ from typing import Mapping, Optional, Any
 from httpx import URL
 
 from tools.utils.download_utils import parse_url
+from tools.utils.hash_utils import normalize_hash_algorithms, parse_expected_checksums
+from tools.utils.quota_utils import default_max_file_size, default_max_total_size, SizeLimit
+from tools.utils.request_body import RequestBody, RequestFilePart
+from tools.utils.text_extraction import TextExtractOptions
 
 
 @dataclass
@@ -14,9 +18,20 @@ class CommonPrams(object):
     request_timeout: float
     request_headers: Optional[Mapping[str, str]]
     request_body_str: Optional[str]
+    request_body_type: str
+    request_body_encoding: str
+    request_files: list[RequestFilePart]
     ssl_certificate_verify: bool
     proxy_url: Optional[str]
     custom_output_filenames: list[str]
+    max_file_size: int
+    max_total_size: int
+    is_truncating_oversize: bool
+    text_extraction_mode: str
+    max_chars: int
+    checksum_algorithms: tuple[str, ...]
+    # expected checksums of each URL in the order of input
+    expected_checksums: list[dict[str, str]]
 
     def __init__(self):
         self.urls = []
@@ -24,8 +39,32 @@ class CommonPrams(object):
         self.request_timeout = 5.0
         self.request_headers = None
         self.request_body_str = None
+        self.request_body_type = "raw"
+        self.request_body_encoding = "identity"
+        self.request_files = []
         self.ssl_certificate_verify = True
         self.proxy_url = None
+        self.max_file_size = default_max_file_size
+        self.max_total_size = default_max_total_size
+        self.is_truncating_oversize = False
+        self.text_extraction_mode = "auto"
+        self.max_chars = 0
+        self.checksum_algorithms = ("sha256",)
+        self.expected_checksums = []
+
+    def create_size_limit(self) -> Optional[SizeLimit]:
+        return SizeLimit.create(self.max_file_size, self.max_total_size, self.is_truncating_oversize)
+
+    def create_request_body(self) -> Optional[RequestBody]:
+        return RequestBody.create(
+            self.request_body_type, self.request_body_str, self.request_files, self.request_body_encoding)
+
+    def create_text_options(self) -> TextExtractOptions:
+        return TextExtractOptions.create(self.text_extraction_mode, self.max_chars)
+
+    def get_expected_checksums(self, idx: int) -> Optional[dict[str, str]]:
+        return self.expected_checksums[idx] if idx < len(self.expected_checksums) and self.expected_checksums[idx] \
+            else None
 
 
 def parse_common_params(tool_parameters: dict[str, Any]) -> CommonPrams:
@@ -34,13 +73,70 @@ def parse_common_params(tool_parameters: dict[str, Any]) -> CommonPrams:
     parsed_params.request_method = tool_parameters.get("request_method", "GET")
     parsed_params.request_timeout = float(tool_parameters.get("request_timeout", "5"))
     parsed_params.request_headers = parse_json_string_dict(tool_parameters.get("request_headers"))
+    parsed_params.request_body_str = tool_parameters.get("request_body_str") or None
+    parsed_params.request_body_type = tool_parameters.get("request_body_type") or "raw"
+    parsed_params.request_body_encoding = tool_parameters.get("request_body_encoding") or "identity"
+    parsed_params.request_files = parse_request_files(
+        tool_parameters.get("request_files"), tool_parameters.get("request_files_field") or "file")
     parsed_params.ssl_certificate_verify = tool_parameters.get("ssl_certificate_verify", "false") == "true"
     parsed_params.proxy_url = tool_parameters.get("proxy_url")
     parsed_params.custom_output_filenames = tool_parameters.get("output_filename", "").split("\n")
+    parsed_params.max_file_size = parse_size_mb(tool_parameters.get("max_file_size_mb"), default_max_file_size)
+    parsed_params.max_total_size = parse_size_mb(tool_parameters.get("max_total_size_mb"), default_max_total_size)
+    parsed_params.is_truncating_oversize = tool_parameters.get("oversize_action", "abort") == "truncate"
+    parsed_params.text_extraction_mode = tool_parameters.get("text_extraction") or "auto"
+    parsed_params.max_chars = parse_max_chars(tool_parameters.get("max_chars"))
+    parsed_params.checksum_algorithms = normalize_hash_algorithms(
+        (tool_parameters.get("checksum_algorithms") or "").replace(",", " ").split())
+    parsed_params.expected_checksums = [parse_expected_checksums(s)
+                                        for s in (tool_parameters.get("expected_checksums") or "").split("\n")]
 
     return parsed_params
 
 
+def parse_request_files(files: Any, field: str) -> list[RequestFilePart]:
+    """
+    Parse the files of a multipart request body, e.g. the files output by the earlier workflow steps
+    """
+    if not files:
+        return []
+    parts = []
+    for file in files if isinstance(files, list) else [files]:
+        if isinstance(file, Mapping):
+            url, filename, mime_type = file.get("url"), file.get("filename"), file.get("mime_type")
+        else:
+            url, filename, mime_type = getattr(file, "url", None), getattr(file, "filename", None), \
+                getattr(file, "mime_type", None)
+        if not url:
+            raise ValueError("Missing URL of the request file.")
+        parts.append(RequestFilePart(field=field, url=url, filename=filename, mime_type=mime_type))
+    return parts
+
+
+def parse_size_mb(size_mb: Any, default_size: int) -> int:
+    """
+    Parse the size in MB into bytes, 0 for unlimited
+    """
+    if size_mb is None or size_mb == "":
+        return default_size
+    try:
+        return max(0, int(float(size_mb) * 1024 * 1024))
+    except ValueError:
+        raise ValueError(f"Invalid size in MB: {size_mb}")
+
+
+def parse_max_chars(max_chars: Any) -> int:
+    """
+    Parse the max number of characters, 0 for unlimited
+    """
+    if max_chars is None or max_chars == "":
+        return 0
+    try:
+        return max(0, int(float(max_chars)))
+    except ValueError:
+        raise ValueError(f"Invalid max number of characters: {max_chars}")
+
+
 def parse_json_string_dict(json_str: str) -> Mapping[str, str]:
     if not json_str:
         return {}
@@ -0,0 +1,146 @@
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from tools.utils.env_utils import get_env_int
+
+default_max_file_size = get_env_int("DOWNLOAD_MAX_FILE_SIZE", 0)
+default_max_total_size = get_env_int("DOWNLOAD_MAX_TOTAL_SIZE", 0)
+
+
+class DownloadSizeExceededError(ValueError):
+    """
+    Raised when a download exceeds the size limit of a single file or the total size budget of the invocation.
+    """
+    pass
+
+
+class InvocationQuota:
+    """
+    Total size budget in bytes shared by all the downloads of a tool invocation.
+    """
+
+    def __init__(self, max_total_size: int):
+        self.max_total_size = max_total_size
+        self._used_size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def used_size(self) -> int:
+        return self._used_size
+
+    @property
+    def remaining_size(self) -> int:
+        with self._lock:
+            return max(0, self.max_total_size - self._used_size)
+
+    def acquire(self, size: int) -> int:
+        """
+        :return: the granted size, less than the requested size if the budget is exhausted
+        """
+        with self._lock:
+            granted = max(0, min(size, self.max_total_size - self._used_size))
+            self._used_size += granted
+            return granted
+
+    def release(self, size: int):
+        with self._lock:
+            self._used_size = max(0, self._used_size - size)
+
+
+@dataclass
+class SizeLimit:
+    # max size in bytes of a single downloaded file, 0 for unlimited
+    max_file_size: int = 0
+    # total size budget of the invocation, None for unlimited
+    invocation_quota: Optional[InvocationQuota] = None
+    # truncate the oversize content instead of aborting the download
+    is_truncating: bool = False
+
+    @staticmethod
+    def create(max_file_size: int, max_total_size: int, is_truncating: bool) -> Optional["SizeLimit"]:
+        if max_file_size <= 0 and max_total_size <= 0:
+            return None
+        return SizeLimit(
+            max_file_size=max(0, max_file_size),
+            invocation_quota=InvocationQuota(max_total_size) if max_total_size > 0 else None,
+            is_truncating=is_truncating,
+        )
+
+
+class DownloadSizeLimiter:
+    """
+    Enforces the size limit on the decoded bytes of a single download, across its retry attempts.
+    """
+
+    def __init__(self, url: str, size_limit: Optional[SizeLimit]):
+        self.url = url
+        self.size_limit = size_limit or SizeLimit()
+        # number of bytes accepted for the file
+        self.accepted_size = 0
+        self.is_truncated = False
+
+    def _available_size(self) -> Optional[int]:
+        """
+        :return: max number of bytes still acceptable, or None if unlimited
+        """
+        available = None
+        if self.size_limit.max_file_size > 0:
+            available = max(0, self.size_limit.max_file_size - self.accepted_size)
+        quota = self.size_limit.invocation_quota
+        if quota is not None:
+            available = quota.remaining_size if available is None else min(available, quota.remaining_size)
+        return available
+
+    def fits(self, size: int) -> bool:
+        available = self._available_size()
+        return available is None or size <= available
+
+    def check_content_length(self, content_length: int) -> bool:
+        """
+        Check the expected content length before streaming the content.
+        :return: True if the content fits in the limit, False if it is going to be truncated
+        :raises DownloadSizeExceededError: if the content exceeds the limit and truncating is not enabled
+        """
+        if content_length < 0 or self.fits(content_length):
+            return True
+        if self.size_limit.is_truncating:
+            return False
+        raise self._exceeded_error(f"Content-Length of {content_length} bytes")
+
+    def accept(self, size: int) -> int:
+        """
+        Account the bytes to be written.
+        :return: number of bytes allowed to be written, less than the size if the content is truncated
+        :raises DownloadSizeExceededError: if the bytes exceed the limit and truncating is not enabled
+        """
+        available = self._available_size()
+        allowed = size if available is None else min(size, available)
+        quota = self.size_limit.invocation_quota
+        if quota is not None:
+            allowed = quota.acquire(allowed)
+        self.accepted_size += allowed
+        if allowed < size:
+            if not self.size_limit.is_truncating:
+                raise self._exceeded_error(f"more than {self.accepted_size} bytes")
+            self.is_truncated = True
+        return allowed
+
+    def reset(self, accepted_size: int = 0):
+        """
+        Reset the accepted bytes when the download restarts or resumes from the given offset.
+        """
+        released_size = self.accepted_size - accepted_size
+        if released_size > 0 and self.size_limit.invocation_quota is not None:
+            self.size_limit.invocation_quota.release(released_size)
+        self.accepted_size = min(self.accepted_size, accepted_size)
+        self.is_truncated = False
+
+    def _exceeded_error(self, actual: str) -> DownloadSizeExceededError:
+        limits = []
+        if self.size_limit.max_file_size > 0:
+            limits.append(f"max file size of {self.size_limit.max_file_size} bytes")
+        if self.size_limit.invocation_quota is not None:
+            limits.append(f"max total size of {self.size_limit.invocation_quota.max_total_size} bytes")
+        return DownloadSizeExceededError(
+            f"Failed to download file from {self.url}, {actual} exceeds the {' or '.join(limits)}")
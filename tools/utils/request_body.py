@@ -0,0 +1,285 @@
+import hashlib
+import json
+import uuid
+import zlib
+from collections.abc import AsyncIterator, Iterator, Mapping
+from dataclasses import dataclass
+from typing import Any, Optional, Union
+from urllib.parse import urlencode, quote
+
+from tools.utils.client_pool import client_holder
+
+# "raw" sends the body text as is, while the others encode the body text by its type
+REQUEST_BODY_TYPES = ["raw", "json", "form", "multipart"]
+REQUEST_BODY_ENCODINGS = ["identity", "gzip", "zstd"]
+
+REQUEST_BODY_CONTENT_TYPES = {
+    "json": "application/json",
+    "form": "application/x-www-form-urlencoded",
+}
+
+# bodies up to this size are sent in full with Content-Length, larger ones are streamed chunked
+REQUEST_BODY_CHUNK_SIZE = 64 * 1024
+
+# same as the default level of gzip
+REQUEST_BODY_GZIP_LEVEL = 6
+
+
+@dataclass(frozen=True)
+class RequestFilePart:
+    """
+    File of a multipart request body, streamed from its URL, e.g. a file output by an earlier workflow step.
+    """
+    field: str
+    url: str
+    filename: Optional[str] = None
+    mime_type: Optional[str] = None
+
+
+class RequestBody:
+    """
+    Body of a download request, streamed in chunks by each attempt instead of being encoded in full ahead,
+    so that the memory used by a large request body stays flat.
+    """
+
+    def __init__(self,
+                 body_type: str = "raw",
+                 text: Optional[str] = None,
+                 fields: Optional[list[tuple[str, str]]] = None,
+                 files: Optional[list[RequestFilePart]] = None,
+                 content_encoding: str = "identity",
+                 ):
+        if body_type not in REQUEST_BODY_TYPES:
+            raise ValueError(f"Invalid request body type: {body_type}, expected one of {REQUEST_BODY_TYPES}")
+        if content_encoding not in REQUEST_BODY_ENCODINGS:
+            raise ValueError(f"Invalid request body encoding: {content_encoding}, "
+                             f"expected one of {REQUEST_BODY_ENCODINGS}")
+        self.body_type = body_type
+        self.text = text or ""
+        self.fields = fields or []
+        self.files = files or []
+        self.content_encoding = content_encoding
+        # the same boundary is used by all the attempts
+        self.boundary = uuid.uuid4().hex if body_type == "multipart" else None
+        if body_type == "form":
+            self.text = urlencode(self.fields)
+        if content_encoding == "zstd":
+            # fail before downloading if the compressor is not available
+            _create_compressor(content_encoding)
+
+    @staticmethod
+    def create(body_type: Optional[str],
+               text: Optional[str],
+               files: Optional[list[RequestFilePart]] = None,
+               content_encoding: Optional[str] = None,
+               ) -> Optional["RequestBody"]:
+        """
+        Create the request body from the tool parameters,
+        with the form and multipart fields parsed from the body text as a JSON object.
+        :return: None if there is no request body
+        """
+        body_type = body_type or "raw"
+        content_encoding = content_encoding or "identity"
+        if not text and not files:
+            return None
+        if body_type == "json":
+            try:
+                json.loads(text or "")
+            except ValueError:
+                raise ValueError("Invalid JSON request body")
+            return RequestBody(body_type, text=text, content_encoding=content_encoding)
+        if body_type in ["form", "multipart"]:
+            fields = parse_body_fields(text)
+            return RequestBody(body_type, fields=fields, files=files if body_type == "multipart" else None,
+                               content_encoding=content_encoding)
+        return RequestBody(body_type, text=text, content_encoding=content_encoding)
+
+    @property
+    def content_type(self) -> Optional[str]:
+        if self.body_type == "multipart":
+            return f"multipart/form-data; boundary={self.boundary}"
+        return REQUEST_BODY_CONTENT_TYPES.get(self.body_type)
+
+    @property
+    def is_streamed(self) -> bool:
+        return bool(self.files) or len(self.text) > REQUEST_BODY_CHUNK_SIZE
+
+    def get_key(self) -> str:
+        """
+        Identity of the request body, for coalescing the identical downloads.
+        """
+        raw_key = json.dumps([
+            self.body_type,
+            hashlib.sha256(self.text.encode("utf-8")).hexdigest(),
+            self.fields,
+            [[f.field, f.url, f.filename, f.mime_type] for f in self.files],
+            self.content_encoding,
+        ], ensure_ascii=False)
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def patch_headers(self, headers: Mapping[str, str]) -> dict[str, str]:
+        """
+        :return: the request headers with the Content-Type and Content-Encoding of the body,
+            unless already set in the request headers
+        """
+        patched = dict(headers)
+        names = {k.lower() for k in patched}
+        if self.content_type and "content-type" not in names:
+            patched["Content-Type"] = self.content_type
+        if self.content_encoding != "identity" and "content-encoding" not in names:
+            patched["Content-Encoding"] = self.content_encoding
+        return patched
+
+    def get_content(self,
+                    timeout: float,
+                    proxy_url: Optional[str] = None,
+                    ssl_certificate_verify: bool = True,
+                    ) -> Union[bytes, Iterator[bytes]]:
+        """
+        :param timeout: request timeout of reading the files of the multipart body
+        :param proxy_url: proxy of reading the files, the same as of the download
+        :param ssl_certificate_verify: whether to verify the certificates of the file URLs, the same as of the download
+        :return: the content of a small body, or a new stream of the body for each attempt
+        """
+        content = self._encode(self._iter_parts(timeout, proxy_url, ssl_certificate_verify))
+        return content if self.is_streamed else b"".join(content)
+
+    def aget_content(self,
+                     timeout: float,
+                     proxy_url: Optional[str] = None,
+                     ssl_certificate_verify: bool = True,
+                     ) -> Union[bytes, AsyncIterator[bytes]]:
+        """
+        Coroutine version of get_content.
+        """
+        if not self.is_streamed:
+            # no file is read from a small body
+            return self.get_content(timeout, proxy_url, ssl_certificate_verify)
+        return self._aencode(self._aiter_parts(timeout, proxy_url, ssl_certificate_verify))
+
+    def _iter_text(self) -> Iterator[bytes]:
+        for start in range(0, len(self.text), REQUEST_BODY_CHUNK_SIZE):
+            yield self.text[start:start + REQUEST_BODY_CHUNK_SIZE].encode("utf-8")
+
+    def _iter_parts(self, timeout: float, proxy_url: Optional[str], ssl_certificate_verify: bool) -> Iterator[bytes]:
+        if self.body_type != "multipart":
+            yield from self._iter_text()
+            return
+        yield from self._iter_fields()
+        for file_part in self.files:
+            yield self._get_file_part_header(file_part)
+            pooled_client = client_holder.acquire(proxy_url, ssl_certificate_verify, timeout)
+            try:
+                with pooled_client.client.stream("GET", file_part.url) as response:
+                    response.raise_for_status()
+                    yield from response.iter_bytes(REQUEST_BODY_CHUNK_SIZE)
+            finally:
+                client_holder.release(pooled_client)
+            yield b"\r\n"
+        yield f"--{self.boundary}--\r\n".encode("utf-8")
+
+    async def _aiter_parts(self,
+                           timeout: float,
+                           proxy_url: Optional[str],
+                           ssl_certificate_verify: bool,
+                           ) -> AsyncIterator[bytes]:
+        if self.body_type != "multipart":
+            for chunk in self._iter_text():
+                yield chunk
+            return
+        for chunk in self._iter_fields():
+            yield chunk
+        for file_part in self.files:
+            yield self._get_file_part_header(file_part)
+            pooled_client = client_holder.acquire(proxy_url, ssl_certificate_verify, timeout, is_async=True)
+            try:
+                async with pooled_client.client.stream("GET", file_part.url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(REQUEST_BODY_CHUNK_SIZE):
+                        yield chunk
+            finally:
+                client_holder.release(pooled_client)
+            yield b"\r\n"
+        yield f"--{self.boundary}--\r\n".encode("utf-8")
+
+    def _iter_fields(self) -> Iterator[bytes]:
+        for name, value in self.fields:
+            yield (f"--{self.boundary}\r\n"
+                   f"Content-Disposition: form-data; name=\"{_quote_header_value(name)}\"\r\n\r\n"
+                   f"{value}\r\n").encode("utf-8")
+
+    def _get_file_part_header(self, file_part: RequestFilePart) -> bytes:
+        filename = file_part.filename or file_part.url.rsplit("/", 1)[-1].split("?", 1)[0] or "file"
+        return (f"--{self.boundary}\r\n"
+                f"Content-Disposition: form-data; name=\"{_quote_header_value(file_part.field)}\"; "
+                f"filename=\"{_quote_header_value(filename)}\"; filename*=UTF-8''{quote(filename)}\r\n"
+                f"Content-Type: {file_part.mime_type or 'application/octet-stream'}\r\n\r\n").encode("utf-8")
+
+    def _encode(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        if self.content_encoding == "identity":
+            yield from chunks
+            return
+        compressor = _create_compressor(self.content_encoding)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    async def _aencode(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        compressor = _create_compressor(self.content_encoding) if self.content_encoding != "identity" else None
+        async for chunk in chunks:
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+        if compressor:
+            yield compressor.flush()
+
+
+def parse_body_fields(text: Optional[str]) -> list[tuple[str, str]]:
+    """
+    Parse the fields of a form or multipart body from a JSON object,
+    where a list value is sent as repeated fields of the same name.
+    """
+    if not text:
+        return []
+    try:
+        data = json.loads(text)
+    except ValueError:
+        raise ValueError("Invalid JSON request body fields")
+    if not isinstance(data, dict):
+        raise ValueError("Request body fields must be a JSON object.")
+    fields = []
+    for name, value in data.items():
+        for item in value if isinstance(value, list) else [value]:
+            fields.append((str(name), item if isinstance(item, str) else json.dumps(item, ensure_ascii=False)))
+    return fields
+
+
+def get_request_body_key(request_body: Optional[Union[str, RequestBody]]) -> Optional[str]:
+    if isinstance(request_body, RequestBody):
+        return request_body.get_key()
+    return request_body
+
+
+def as_request_body(request_body: Optional[Union[str, RequestBody]]) -> Optional[RequestBody]:
+    """
+    :return: the request body, with a text body sent as is
+    """
+    if isinstance(request_body, str):
+        return RequestBody.create("raw", request_body)
+    return request_body
+
+
+def _quote_header_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\r", " ").replace("\n", " ")
+
+
+def _create_compressor(content_encoding: str) -> Any:
+    if content_encoding == "gzip":
+        return zlib.compressobj(REQUEST_BODY_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("The zstd request body encoding requires the zstandard package")
+    return zstandard.ZstdCompressor().compressobj()
@@ -0,0 +1,118 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from httpx import Response, TimeoutException, NetworkError, RemoteProtocolError
+
+from tools.utils.deadline_utils import Deadline
+from tools.utils.env_utils import get_env_int, get_env_float
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+max_retries = get_env_int("DOWNLOAD_MAX_RETRIES", 3)
+retry_backoff_base = get_env_float("DOWNLOAD_RETRY_BACKOFF_BASE", 0.5)
+retry_backoff_max = get_env_float("DOWNLOAD_RETRY_BACKOFF_MAX", 10.0)
+retry_after_max = get_env_float("DOWNLOAD_RETRY_AFTER_MAX", 60.0)
+
+
+class HttpStatusError(ValueError):
+    """
+    Raised for HTTP responses with an error status code.
+    """
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RetryableStatusError(HttpStatusError):
+    """
+    Raised for HTTP responses with a transient error status code, e.g. 429 or 503.
+    """
+
+    def __init__(self, message: str, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(message, status_code)
+        self.retry_after = retry_after
+
+
+def check_response_status(url: str, response: Response):
+    """
+    Raise an error if the response is not successful.
+    :raises RetryableStatusError: for transient error status codes
+    :raises HttpStatusError: for other error status codes
+    """
+    if response.is_success:
+        return
+    message = f"Failed to download file from {url}, HTTP status code: {response.status_code}"
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        raise RetryableStatusError(message, response.status_code,
+                                   parse_retry_after(response.headers.get("retry-after")))
+    raise HttpStatusError(message, response.status_code)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse the Retry-After header value in either delay seconds or HTTP-date format.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_resume_validator(method: str, response: Response) -> Optional[str]:
+    """
+    Get the validator for resuming the download with If-Range, or None if the response is not resumable.
+    """
+    if method.upper() != "GET" or response.status_code != 200:
+        return None
+    if "bytes" not in response.headers.get("accept-ranges", "").lower():
+        return None
+    # byte ranges apply to the encoded representation, while the decoded content is written to the file
+    if response.headers.get("content-encoding", "identity").lower() != "identity":
+        return None
+    etag = response.headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("last-modified")
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    return isinstance(error, (RetryableStatusError, TimeoutException, NetworkError, RemoteProtocolError))
+
+
+def get_retry_delay(attempt: int, error: BaseException) -> float:
+    """
+    Exponential backoff with jitter for the given attempt (starting from 1),
+    or the server requested delay from the Retry-After header.
+    """
+    if isinstance(error, RetryableStatusError) and error.retry_after is not None:
+        return min(error.retry_after, retry_after_max)
+    delay = min(retry_backoff_max, retry_backoff_base * (2 ** (attempt - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def wait_before_retry(attempt: int,
+                      error: BaseException,
+                      cancel_event: threading.Event = None,
+                      deadline: Optional[Deadline] = None,
+                      ) -> bool:
+    """
+    Sleep before the next retry attempt.
+    :return: False if cancelled during waiting, otherwise True
+    :raises BaseException: the error itself if the deadline would pass before the retry
+    """
+    delay = get_retry_delay(attempt, error)
+    if deadline and not deadline.allows(delay):
+        raise error
+    if cancel_event:
+        return not cancel_event.wait(delay)
+    time.sleep(delay)
+    return True
@@ -0,0 +1,320 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from tools.utils.download_metrics import metrics_registry
+from tools.utils.env_utils import get_env_int, get_env_float
+
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_CONCURRENCY_PER_HOST = 8
+
+
+@dataclass
+class _Job:
+    future: Future
+    fn: Callable[..., Any]
+    args: tuple
+    kwargs: dict
+    host: Optional[str] = None
+    # jobs of a host with a lower priority are started first
+    priority: float = 0.0
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class _HostState:
+    """
+    Running job count and request rate budget (token bucket) of a single host.
+    """
+
+    def __init__(self, rate_limit: float):
+        self.rate_limit = rate_limit
+        self.running = 0
+        self.tokens = max(1.0, rate_limit)
+        self.last_refill = time.monotonic()
+
+    def refill(self, now: float):
+        if self.rate_limit <= 0:
+            return
+        self.tokens = min(max(1.0, self.rate_limit),
+                          self.tokens + (now - self.last_refill) * self.rate_limit)
+        self.last_refill = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        Seconds to wait before the next request to the host is allowed by the rate budget.
+        """
+        if self.rate_limit <= 0:
+            return 0.0
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate_limit
+
+
+class SchedulerSession:
+    """
+    A group of jobs submitted by one tool invocation.
+    Pending jobs of the session are cancelled when the session is closed.
+    """
+
+    def __init__(self, scheduler: "DownloadScheduler", session_id: int):
+        self.scheduler = scheduler
+        self.session_id = session_id
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        return self.scheduler.submit(self.session_id, None, fn, *args, **kwargs)
+
+    def submit_to_host(self, host: Optional[str], fn: Callable[..., Any], *args,
+                       priority: float = 0.0, **kwargs) -> Future:
+        """
+        Submit a job bound to a host, which is subject to the per-host concurrency and rate limits.
+        :param priority: pending jobs of the host with a lower priority are started first
+        """
+        return self.scheduler.submit(self.session_id, host, fn, *args, priority=priority, **kwargs)
+
+    def close(self):
+        self.scheduler.close_session(self.session_id)
+
+    def __enter__(self) -> "SchedulerSession":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DownloadScheduler:
+    """
+    Process-wide scheduler running download jobs on a bounded set of worker threads.
+    Jobs are queued per session and dispatched round-robin between sessions,
+    so that a large batch from one invocation can not starve the small ones.
+    Within a session, jobs of different hosts are interleaved,
+    and each host is limited by its own concurrency cap and optional request rate budget.
+    Jobs of the same host are started in the order of their priority, then in the order of submission.
+    """
+
+    def __init__(self,
+                 max_concurrency: int,
+                 max_concurrency_per_host: int = 0,
+                 max_requests_per_second_per_host: float = 0,
+                 ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_concurrency_per_host = max(0, max_concurrency_per_host)
+        self.max_requests_per_second_per_host = max(0.0, max_requests_per_second_per_host)
+        self._condition = threading.Condition()
+        # session id -> host -> pending jobs
+        self._queues: OrderedDict[int, OrderedDict[Optional[str], deque[_Job]]] = OrderedDict()
+        self._hosts: dict[str, _HostState] = {}
+        self._session_ids = itertools.count(1)
+        self._workers: list[threading.Thread] = []
+        self._idle_workers = 0
+        # jobs queued and not yet picked by a worker
+        self._pending_jobs = 0
+        self._running_jobs = 0
+        # stats
+        self._submitted_jobs = 0
+        self._started_jobs = 0
+        self._cancelled_jobs = 0
+        self._host_throttled_times = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def session(self) -> SchedulerSession:
+        with self._condition:
+            session_id = next(self._session_ids)
+            self._queues[session_id] = OrderedDict()
+        return SchedulerSession(self, session_id)
+
+    def submit(self, session_id: int, host: Optional[str], fn: Callable[..., Any], *args,
+               priority: float = 0.0, **kwargs) -> Future:
+        future = Future()
+        job = _Job(future=future, fn=fn, args=args, kwargs=kwargs, host=host, priority=priority)
+        with self._condition:
+            session_queues = self._queues.get(session_id)
+            if session_queues is None:
+                raise RuntimeError(f"Scheduler session {session_id} is already closed")
+            if host not in session_queues:
+                session_queues[host] = deque()
+            queue = session_queues[host]
+            position = len(queue)
+            while position > 0 and queue[position - 1].priority > priority:
+                position -= 1
+            queue.insert(position, job)
+            self._submitted_jobs += 1
+            self._pending_jobs += 1
+            self._ensure_worker()
+            self._condition.notify()
+        return future
+
+    def close_session(self, session_id: int):
+        with self._condition:
+            session_queues = self._queues.pop(session_id, None)
+            for queue in (session_queues or {}).values():
+                self._pending_jobs -= len(queue)
+                for job in queue:
+                    if job.future.cancel():
+                        self._cancelled_jobs += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._condition:
+            queue_depth = sum(len(q) for session_queues in self._queues.values() for q in session_queues.values())
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_concurrency_per_host": self.max_concurrency_per_host,
+                "max_requests_per_second_per_host": self.max_requests_per_second_per_host,
+                "workers": len(self._workers),
+                "running_jobs": self._running_jobs,
+                "queue_depth": queue_depth,
+                "active_sessions": len(self._queues),
+                "active_hosts": len(self._hosts),
+                "submitted_jobs": self._submitted_jobs,
+                "started_jobs": self._started_jobs,
+                "cancelled_jobs": self._cancelled_jobs,
+                "host_throttled_times": self._host_throttled_times,
+                "avg_wait_time": self._total_wait_time / self._started_jobs if self._started_jobs else 0.0,
+                "max_wait_time": self._max_wait_time,
+            }
+
+    def try_acquire_host(self, host: str, count: int) -> int:
+        """
+        Take up to the count of slots of the host without waiting, e.g. for the extra requests of a running download,
+        each charged to the request rate budget of the host as a job would be.
+        :return: the number of the slots taken, which should be given back by release_host
+        """
+        with self._condition:
+            state = self._host_state(host)
+            now = time.monotonic()
+            acquired = 0
+            while acquired < count:
+                if 0 < self.max_concurrency_per_host <= state.running or state.wait_time(now) > 0:
+                    break
+                state.running += 1
+                if state.rate_limit > 0:
+                    state.tokens -= 1
+                acquired += 1
+            if acquired <= 0:
+                # forget the host created for the check only
+                state.running += 1
+                self._release_host(host)
+            return acquired
+
+    def release_host(self, host: str, count: int = 1):
+        with self._condition:
+            for _ in range(count):
+                self._release_host(host)
+            # wake up the workers which may be waiting for the host to become available
+            self._condition.notify(count)
+
+    def _ensure_worker(self):
+        # must be called with the lock held,
+        # the idle workers may be already notified of the other pending jobs but not woken up yet
+        if self._idle_workers >= self._pending_jobs or len(self._workers) >= self.max_concurrency:
+            return
+        worker = threading.Thread(
+            target=self._worker_loop,
+            name=f"download-worker-{len(self._workers)}",
+            daemon=True)
+        self._workers.append(worker)
+        worker.start()
+
+    def _host_state(self, host: str) -> _HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            state = _HostState(self.max_requests_per_second_per_host)
+            self._hosts[host] = state
+        return state
+
+    def _next_job(self) -> tuple[Optional[_Job], Optional[float]]:
+        """
+        Pick the next runnable job, must be called with the lock held.
+        :return:
+            _Job: the job to run, or None if no job is runnable now
+            float: seconds to wait until a rate limited host becomes runnable, or None to wait for notification
+        """
+        now = time.monotonic()
+        retry_in = None
+        for session_id, session_queues in self._queues.items():
+            for host, queue in session_queues.items():
+                if not queue:
+                    continue
+                if host is not None:
+                    state = self._host_state(host)
+                    if 0 < self.max_concurrency_per_host <= state.running:
+                        continue
+                    host_wait_time = state.wait_time(now)
+                    if host_wait_time > 0:
+                        retry_in = host_wait_time if retry_in is None else min(retry_in, host_wait_time)
+                        continue
+                    state.running += 1
+                    if state.rate_limit > 0:
+                        state.tokens -= 1
+
+                job = queue.popleft()
+                self._pending_jobs -= 1
+                if not queue:
+                    del session_queues[host]
+                else:
+                    # move the host and the session to the tail for round-robin fairness
+                    session_queues.move_to_end(host)
+                self._queues.move_to_end(session_id)
+                return job, None
+        return None, retry_in
+
+    def _release_host(self, host: Optional[str]):
+        # must be called with the lock held
+        if host is None:
+            return
+        state = self._hosts.get(host)
+        if state is None:
+            return
+        state.running -= 1
+        if state.running <= 0 and state.tokens >= max(1.0, state.rate_limit):
+            # forget idle hosts to keep the host table small
+            del self._hosts[host]
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                job, retry_in = self._next_job()
+                while job is None:
+                    if retry_in is not None:
+                        self._host_throttled_times += 1
+                    self._idle_workers += 1
+                    self._condition.wait(timeout=retry_in)
+                    self._idle_workers -= 1
+                    job, retry_in = self._next_job()
+
+                if not job.future.set_running_or_notify_cancel():
+                    self._cancelled_jobs += 1
+                    self._release_host(job.host)
+                    continue
+                wait_time = time.monotonic() - job.enqueued_at
+                self._started_jobs += 1
+                self._total_wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+                self._running_jobs += 1
+
+            metrics_registry.observe("scheduler_wait_seconds", wait_time)
+            try:
+                result = job.fn(*job.args, **job.kwargs)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                with self._condition:
+                    self._running_jobs -= 1
+                    self._release_host(job.host)
+                    if job.host is not None:
+                        # wake up a worker which may be waiting for the host to become available
+                        self._condition.notify()
+
+
+download_scheduler = DownloadScheduler(
+    max_concurrency=get_env_int("DOWNLOAD_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY),
+    max_concurrency_per_host=get_env_int("DOWNLOAD_MAX_CONCURRENCY_PER_HOST", DEFAULT_MAX_CONCURRENCY_PER_HOST),
+    max_requests_per_second_per_host=get_env_float("DOWNLOAD_MAX_REQUESTS_PER_SECOND_PER_HOST", 0),
+)
+
+metrics_registry.register_collector("scheduler", download_scheduler.stats)
@@ -0,0 +1,252 @@
+import math
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from dataclasses import dataclass
+from typing import Optional, Mapping, BinaryIO, Callable, Iterator
+
+from httpx import Client, Response, RemoteProtocolError, Timeout
+from yarl import URL
+
+from tools.utils.deadline_utils import Deadline
+from tools.utils.env_utils import get_env_int
+from tools.utils.retry_utils import max_retries, is_retryable_error, wait_before_retry, check_response_status, \
+    get_resume_validator
+from tools.utils.scheduler import download_scheduler
+
+DEFAULT_SEGMENT_COUNT = 4
+DEFAULT_SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+DEFAULT_SEGMENT_MAX_WORKERS = 16
+
+segment_count = get_env_int("DOWNLOAD_SEGMENT_COUNT", DEFAULT_SEGMENT_COUNT)
+segment_min_size = get_env_int("DOWNLOAD_SEGMENT_MIN_SIZE", DEFAULT_SEGMENT_MIN_SIZE)
+
+# shared by all segmented downloads, separated from the download scheduler to avoid nested waiting on its workers
+segment_executor = ThreadPoolExecutor(
+    max_workers=get_env_int("DOWNLOAD_SEGMENT_MAX_WORKERS", DEFAULT_SEGMENT_MAX_WORKERS),
+    thread_name_prefix="download-segment")
+
+
+@dataclass
+class SegmentProgress:
+    start: int
+    end: int
+    # offset of the next byte to write
+    offset: int
+
+    @property
+    def is_completed(self) -> bool:
+        return self.offset > self.end
+
+    @property
+    def downloaded_length(self) -> int:
+        return self.offset - self.start
+
+
+class RangeNotSupportedError(Exception):
+    """
+    Raised when the server does not honor a Range request as advertised.
+    """
+    pass
+
+
+def get_segmented_content_length(method: str, response: Response) -> Optional[int]:
+    """
+    Check whether the response can be downloaded in segments with HTTP Range requests.
+    :return: the total content length if segmented download is applicable, otherwise None
+    """
+    if segment_count <= 1 or method.upper() != "GET" or response.status_code != 200:
+        return None
+    if "bytes" not in response.headers.get("accept-ranges", "").lower():
+        return None
+    # byte ranges apply to the encoded representation, so only identity encoded responses are segmented
+    if response.headers.get("content-encoding", "identity").lower() != "identity":
+        return None
+    try:
+        content_length = int(response.headers.get("content-length", ""))
+    except ValueError:
+        return None
+    if content_length < max(segment_min_size, 2):
+        return None
+    return content_length
+
+
+def get_segment_count(content_length: int) -> int:
+    return max(1, min(segment_count, math.ceil(content_length / max(segment_min_size, 1))))
+
+
+def split_segments(content_length: int, count: Optional[int] = None) -> list[tuple[int, int]]:
+    """
+    Split the content into inclusive byte ranges of (start, end).
+    :param count: number of the segments, by default the one for the content length
+    """
+    count = max(1, count or get_segment_count(content_length))
+    segment_size = math.ceil(content_length / count)
+    return [(start, min(start + segment_size, content_length) - 1)
+            for start in range(0, content_length, segment_size)]
+
+
+def download_in_segments(client: Client,
+                         url: str,
+                         request_headers: Mapping[str, str],
+                         timeout: Timeout,
+                         response: Response,
+                         content_length: int,
+                         file: BinaryIO,
+                         cancel_event: threading.Event = None,
+                         deadline: Optional[Deadline] = None,
+                         ) -> bool:
+    """
+    Download the content of the response into the file with concurrent HTTP Range requests.
+    The first segment is read from the already opened response,
+    and the rest segments are fetched concurrently and written at their offsets of the preallocated file.
+    Each Range request takes a slot of the host from the download scheduler, charged to its request rate budget,
+    so the content is split into fewer segments, down to the first one only, if the host has no slot to spare.
+    Each segment is retried on transient errors before the deadline, resuming from its last received byte.
+    :return: False if the download is cancelled, otherwise True
+    :raises RangeNotSupportedError: if the server does not honor the Range requests
+    """
+    # the host of the download jobs of the scheduler
+    host = str(URL(url).origin())
+    extra_slots = download_scheduler.try_acquire_host(host, get_segment_count(content_length) - 1)
+    try:
+        return _download_in_segments(client, url, request_headers, timeout, response, content_length, file,
+                                     cancel_event, deadline, count=1 + extra_slots)
+    finally:
+        if extra_slots:
+            download_scheduler.release_host(host, extra_slots)
+
+
+def _download_in_segments(client: Client,
+                          url: str,
+                          request_headers: Mapping[str, str],
+                          timeout: Timeout,
+                          response: Response,
+                          content_length: int,
+                          file: BinaryIO,
+                          cancel_event: Optional[threading.Event],
+                          deadline: Optional[Deadline],
+                          count: int,
+                          ) -> bool:
+    segments = [SegmentProgress(start=start, end=end, offset=start)
+                for start, end in split_segments(content_length, count)]
+    file.truncate(content_length)
+    file.flush()
+    fd = file.fileno()
+
+    range_headers = dict(request_headers)
+    range_headers["Accept-Encoding"] = "identity"
+    # make sure all segments are from the same version of the resource, where a weak ETag is not usable for If-Range
+    validator = get_resume_validator("GET", response)
+    if validator:
+        range_headers["If-Range"] = validator
+
+    abort_event = threading.Event()
+
+    def is_aborted() -> bool:
+        return abort_event.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+    futures = [segment_executor.submit(
+        download_segment, client, url, range_headers, timeout, fd, segment, is_aborted, cancel_event, deadline)
+        for segment in segments[1:]]
+    try:
+        download_segment(client, url, range_headers, timeout, fd, segments[0], is_aborted, cancel_event, deadline,
+                         first_response=response)
+
+        waited = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in waited.done:
+            if future.exception():
+                raise future.exception()
+    finally:
+        abort_event.set()
+        wait(futures)
+
+    if cancel_event and cancel_event.is_set():
+        return False
+
+    downloaded_length = sum(segment.downloaded_length for segment in segments)
+    if downloaded_length != content_length:
+        raise ValueError(f"Failed to download file from {url}, "
+                         f"expected {content_length} bytes but got {downloaded_length} bytes")
+    return True
+
+
+def download_segment(client: Client,
+                     url: str,
+                     range_headers: Mapping[str, str],
+                     timeout: Timeout,
+                     fd: int,
+                     segment: SegmentProgress,
+                     is_aborted: Callable[[], bool],
+                     cancel_event: threading.Event = None,
+                     deadline: Optional[Deadline] = None,
+                     first_response: Optional[Response] = None,
+                     ):
+    """
+    Download a segment with retries, resuming from the last received byte of the segment.
+    :param deadline: no retry is made once the deadline would pass
+    :param first_response: an already opened response to read the segment from before any Range request
+    """
+    attempt = 0
+    while not segment.is_completed and not is_aborted():
+        try:
+            if first_response is not None:
+                response, first_response = first_response, None
+                write_stream_at(fd, response.iter_raw(), segment, is_aborted)
+            else:
+                fetch_segment(client, url, range_headers, timeout, fd, segment, is_aborted)
+            if not segment.is_completed and not is_aborted():
+                raise RemoteProtocolError(
+                    f"Incomplete segment of bytes {segment.start}-{segment.end}, "
+                    f"only got bytes {segment.start}-{segment.offset - 1}")
+        except Exception as e:
+            attempt += 1
+            if attempt > max_retries or not is_retryable_error(e):
+                raise
+            if not wait_before_retry(attempt, e, cancel_event, deadline):
+                return
+            if deadline:
+                deadline.check(url)
+
+
+def fetch_segment(client: Client,
+                  url: str,
+                  range_headers: Mapping[str, str],
+                  timeout: Timeout,
+                  fd: int,
+                  segment: SegmentProgress,
+                  is_aborted: Callable[[], bool],
+                  ):
+    headers = dict(range_headers)
+    headers["Range"] = f"bytes={segment.offset}-{segment.end}"
+    with client.stream(method="GET", url=url, headers=headers, timeout=timeout) as response:
+        check_response_status(url, response)
+        if response.status_code != 206:
+            raise RangeNotSupportedError(
+                f"Range request of bytes {segment.offset}-{segment.end} to {url} "
+                f"responded with HTTP status code {response.status_code}")
+        content_range = response.headers.get("content-range", "")
+        match = re.match(r"bytes\s+(\d+)-(\d+)/", content_range)
+        if not match or int(match.group(1)) != segment.offset or int(match.group(2)) != segment.end:
+            raise RangeNotSupportedError(
+                f"Range request of bytes {segment.offset}-{segment.end} to {url} "
+                f"responded with mismatched Content-Range: {content_range}")
+        write_stream_at(fd, response.iter_raw(), segment, is_aborted)
+
+
+def write_stream_at(fd: int, chunks: Iterator[bytes], segment: SegmentProgress, is_aborted: Callable[[], bool]):
+    """
+    Write the chunks to the file descriptor from the current offset of the segment up to its end,
+    and keep the offset of the segment updated for resuming.
+    """
+    for chunk in chunks:
+        if is_aborted():
+            return
+        chunk = chunk[:segment.end + 1 - segment.offset]
+        while chunk:
+            written = os.pwrite(fd, chunk, segment.offset)
+            segment.offset += written
+            chunk = chunk[written:]
+        if segment.is_completed:
+            return
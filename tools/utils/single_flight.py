@@ -0,0 +1,206 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import Future, InvalidStateError
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, Mapping
+
+from tools.utils.deadline_utils import DeadlineExceededError
+from tools.utils.download_utils import guess_mime_type_from_filename, release_download_result
+from tools.utils.quota_utils import SizeLimit
+from tools.utils.request_body import get_request_body_key
+
+
+@dataclass
+class _Subscriber:
+    """
+    A caller waiting for the result of a flight.
+    """
+    future: Future
+    arguments: dict[str, Any]
+    # submits the download with the given arguments on behalf of the caller
+    submit_fn: Callable[[dict[str, Any]], Future]
+
+
+@dataclass
+class _Flight:
+    """
+    A single in-flight download shared by all its subscribers.
+    """
+    key: str
+    future: Optional[Future] = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    subscribers: list[_Subscriber] = field(default_factory=list)
+
+
+class SingleFlight:
+    """
+    Coalesces identical downloads in flight, from the same or concurrent tool invocations, into a single transfer.
+    The result is fanned out to every caller with its own index, file name and handle of the shared content.
+    The transfer is only cancelled when all of its callers are cancelled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: dict[str, _Flight] = {}
+        # stats
+        self._started_flights = 0
+        self._coalesced_requests = 0
+        self._restarted_flights = 0
+
+    @staticmethod
+    def get_key(arguments: Mapping[str, Any]) -> str:
+        """
+        Identity of the download request from the arguments of download_to_temp.
+        """
+        size_limit: Optional[SizeLimit] = arguments.get("size_limit")
+        raw_key = json.dumps([
+            str(arguments.get("method", "GET")).upper(),
+            arguments.get("url"),
+            sorted((k.lower(), v) for k, v in (arguments.get("request_headers") or {}).items()),
+            get_request_body_key(arguments.get("request_body")),
+            arguments.get("proxy_url"),
+            arguments.get("ssl_certificate_verify", True),
+            [
+                size_limit.max_file_size,
+                size_limit.is_truncating,
+                # an invocation budget is only shared within the invocation
+                id(size_limit.invocation_quota) if size_limit.invocation_quota else None,
+            ] if size_limit else None,
+            arguments.get("text_options"),
+            sorted(arguments.get("checksum_algorithms") or []),
+            sorted((arguments.get("expected_checksums") or {}).items()),
+        ], ensure_ascii=False, default=str)
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def submit(self, arguments: dict[str, Any], submit_fn: Callable[[dict[str, Any]], Future]) -> Future:
+        """
+        Join the identical download in flight, or submit a new one with the submit function.
+        :param arguments: arguments of download_to_temp
+        :return: the future of the download_to_temp result for the caller
+        """
+        subscriber = _Subscriber(future=Future(), arguments=arguments, submit_fn=submit_fn)
+        key = self.get_key(arguments)
+        self._join(key, subscriber)
+        return subscriber.future
+
+    def _join(self, key: str, subscriber: _Subscriber):
+        with self._lock:
+            flight = self._flights.get(key)
+            is_new_flight = flight is None
+            if is_new_flight:
+                flight = _Flight(key=key)
+                self._flights[key] = flight
+                self._started_flights += 1
+            else:
+                self._coalesced_requests += 1
+            flight.subscribers.append(subscriber)
+        subscriber.future.add_done_callback(lambda f: self._on_subscriber_done(flight, f))
+        if not is_new_flight:
+            return
+
+        # the shared download is neither bound to the index, file name nor cancel event of a single caller
+        shared_arguments = dict(subscriber.arguments, idx=0, custom_filename=None, cancel_event=flight.cancel_event)
+        try:
+            flight.future = subscriber.submit_fn(shared_arguments)
+        except BaseException as e:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                subscribers = list(flight.subscribers)
+            for s in subscribers:
+                _set_future_exception(s.future, e)
+            return
+        if flight.cancel_event.is_set():
+            # all the subscribers are cancelled during submitting
+            flight.future.cancel()
+        flight.future.add_done_callback(lambda f: self._on_flight_done(flight, f))
+
+    def _on_subscriber_done(self, flight: _Flight, future: Future):
+        if not future.cancelled():
+            return
+        with self._lock:
+            if any(not s.future.done() for s in flight.subscribers):
+                return
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        # cancel the download once no subscriber is waiting for it
+        flight.cancel_event.set()
+        if flight.future is not None:
+            flight.future.cancel()
+
+    def _on_flight_done(self, flight: _Flight, future: Future):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            waiting_subscribers = [s for s in flight.subscribers if not s.future.done()]
+
+        if future.cancelled() or flight.cancel_event.is_set():
+            if waiting_subscribers:
+                # cancelled on behalf of another caller, e.g. by closing its scheduler session,
+                # so download again for the subscribers still waiting
+                with self._lock:
+                    self._restarted_flights += 1
+                for s in waiting_subscribers:
+                    self._join(flight.key, s)
+            release_download_result(future)
+            return
+
+        if future.exception():
+            if isinstance(future.exception(), DeadlineExceededError):
+                # the download is bound to the deadline of the caller starting it,
+                # so download again for the subscribers whose own deadline is not expired yet
+                restarting_subscribers = [s for s in waiting_subscribers if not _is_deadline_expired(s)]
+                if restarting_subscribers:
+                    with self._lock:
+                        self._restarted_flights += 1
+                    for s in restarting_subscribers:
+                        self._join(flight.key, s)
+                waiting_subscribers = [s for s in waiting_subscribers if s not in restarting_subscribers]
+            for s in waiting_subscribers:
+                _set_future_exception(s.future, future.exception())
+            return
+
+        _, content, mime_type, filename, encoding = future.result()
+        for s in waiting_subscribers:
+            shared_content = content.share() if content else None
+            custom_filename = s.arguments.get("custom_filename")
+            result = (
+                s.arguments.get("idx", 0),
+                shared_content,
+                guess_mime_type_from_filename(custom_filename, mime_type) if custom_filename else mime_type,
+                custom_filename or filename,
+                encoding,
+            )
+            try:
+                s.future.set_result(result)
+            except InvalidStateError:
+                # cancelled in the meantime
+                if shared_content:
+                    shared_content.release()
+        # each subscriber releases its own handle of the shared content
+        release_download_result(future)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "flights_in_progress": len(self._flights),
+                "started_flights": self._started_flights,
+                "coalesced_requests": self._coalesced_requests,
+                "restarted_flights": self._restarted_flights,
+            }
+
+
+def _is_deadline_expired(subscriber: _Subscriber) -> bool:
+    deadline = subscriber.arguments.get("deadline")
+    return deadline is not None and deadline.is_expired()
+
+
+def _set_future_exception(future: Future, error: BaseException):
+    try:
+        future.set_exception(error)
+    except InvalidStateError:
+        pass
+
+
+download_single_flight = SingleFlight()
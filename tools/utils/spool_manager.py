@@ -0,0 +1,399 @@
+import asyncio
+import hashlib
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Optional
+
+from tools.utils.deadline_utils import Deadline, DeadlineExceededError
+from tools.utils.env_utils import get_env_str, get_env_int, get_env_float
+
+DEFAULT_SPOOL_DIR = os.path.join(tempfile.gettempdir(), "dify-plugin-download")
+DEFAULT_SPOOL_SMALL_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_SPOOL_REAP_INTERVAL = 300.0
+DEFAULT_SPOOL_ORPHAN_AGE = 3600.0
+
+# reservations of the spool files grow by this step instead of on every written chunk
+SPOOL_RESERVE_STEP = 1024 * 1024
+# seconds between checking the budget when waiting on the event loop
+SPOOL_WAIT_INTERVAL = 0.05
+
+SPOOL_FILE_PREFIX = "dl-"
+SPOOL_FILE_SUFFIX = ".spool"
+
+
+@dataclass
+class SpoolFile:
+    path: str
+    file: BinaryIO
+    # bytes accounted in the budget of the spool manager
+    reserved: int = 0
+
+
+class SpoolManager:
+    """
+    Managed temporary storage of the downloaded contents and the bundles spooled to disk.
+    Files of a known small size, e.g. from Content-Length, may be spooled to a separate directory such as a tmpfs,
+    while the others go to the main spool directory, with the disk space preallocated if the size is known.
+    New downloads wait while the total size of the spool files is over the budget instead of failing,
+    and the downloads in progress keep writing to avoid waiting on each other.
+    A download whose results before it in the output order are all completed does not wait,
+    as the completed files over the budget may only be released once it is yielded.
+    A background reaper deletes the files left by dead processes, and the files of this process
+    which are no longer tracked, e.g. failed to be deleted or abandoned by a killed worker.
+    The directory may be shared by other hosts or containers, e.g. a mounted volume, whose processes can not be seen,
+    so the files are named after the host and the process creating them, and only the files of this host are reaped
+    by their processes, while the files of the other hosts are reaped once older than the orphan age.
+    """
+
+    def __init__(self,
+                 spool_dir: str = DEFAULT_SPOOL_DIR,
+                 small_spool_dir: Optional[str] = None,
+                 small_max_size: int = DEFAULT_SPOOL_SMALL_MAX_SIZE,
+                 max_size: int = 0,
+                 reap_interval: float = DEFAULT_SPOOL_REAP_INTERVAL,
+                 orphan_age: float = DEFAULT_SPOOL_ORPHAN_AGE,
+                 ):
+        self.spool_dir = spool_dir
+        self.small_spool_dir = small_spool_dir
+        self.small_max_size = small_max_size
+        # total size budget in bytes of the spool files, 0 for unlimited
+        self.max_size = max(0, max_size)
+        self.reap_interval = reap_interval
+        self.orphan_age = orphan_age
+        self._condition = threading.Condition()
+        # path -> reserved bytes of the alive spool files
+        self._files: dict[str, int] = {}
+        self._reserved_size = 0
+        self._reaper: Optional[threading.Thread] = None
+        # stats
+        self._created_files = 0
+        self._waited_times = 0
+        self._exempted_times = 0
+        self._reaped_files = 0
+
+    @property
+    def directories(self) -> list[str]:
+        return [d for d in [self.spool_dir, self.small_spool_dir] if d]
+
+    def create(self, expected_size: int = -1) -> SpoolFile:
+        """
+        Create a spool file opened for reading and writing, in the directory for the expected size,
+        with the expected size reserved in the budget and preallocated on disk.
+        :param expected_size: expected size in bytes of the content, or -1 if unknown
+        """
+        self._ensure_reaper()
+        directory = self.small_spool_dir \
+            if self.small_spool_dir and 0 <= expected_size <= self.small_max_size else self.spool_dir
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{SPOOL_FILE_PREFIX}{get_process_owner_id()}-{uuid.uuid4().hex}"
+                                       f"{SPOOL_FILE_SUFFIX}")
+        file = open(path, "w+b")
+        spool_file = SpoolFile(path=path, file=file)
+        with self._condition:
+            self._files[path] = 0
+            self._created_files += 1
+        if expected_size > 0:
+            self.reserve(spool_file, expected_size)
+            preallocate(file, expected_size)
+        return spool_file
+
+    def reserve(self, spool_file: SpoolFile, size: int):
+        """
+        Account the size of the spool file in the budget, without waiting as the download is in progress.
+        """
+        if size <= spool_file.reserved:
+            return
+        if spool_file.reserved:
+            size = max(size, spool_file.reserved + SPOOL_RESERVE_STEP)
+        with self._condition:
+            if spool_file.path not in self._files:
+                return
+            self._reserved_size += size - self._files[spool_file.path]
+            self._files[spool_file.path] = size
+        spool_file.reserved = size
+
+    def track(self, path: str, size: int):
+        """
+        Track the spool file with the given size accounted in the budget, e.g. its final size after downloading.
+        """
+        with self._condition:
+            if path not in self._files:
+                return
+            self._reserved_size += size - self._files[path]
+            self._files[path] = size
+            self._condition.notify_all()
+
+    def delete(self, path: str):
+        """
+        Delete the spool file and release its size from the budget.
+        A file failed to be deleted is left to the reaper, as it is no longer tracked.
+        """
+        try:
+            Path(path).unlink(missing_ok=True)
+        except OSError:
+            pass
+        with self._condition:
+            reserved = self._files.pop(path, None)
+            if reserved is not None:
+                self._reserved_size -= reserved
+                self._condition.notify_all()
+
+    def has_space(self) -> bool:
+        with self._condition:
+            return self._has_space()
+
+    def _has_space(self) -> bool:
+        return self.max_size <= 0 or self._reserved_size < self.max_size
+
+    def wait_for_space(self,
+                       cancel_event: threading.Event = None,
+                       deadline: Optional[Deadline] = None,
+                       is_exempt: Optional[Callable[[], bool]] = None,
+                       ) -> bool:
+        """
+        Wait until the spool files are within the budget before starting a new download.
+        :param is_exempt: whether the download may start over the budget, checked again on each wake-up,
+            e.g. OutputOrder.is_unblocked of the download
+        :return: False if cancelled during waiting, otherwise True
+        :raises DeadlineExceededError: if the deadline passes during waiting
+        """
+        with self._condition:
+            if self._has_space():
+                return True
+            self._waited_times += 1
+            while not self._has_space():
+                if is_exempt and is_exempt():
+                    self._exempted_times += 1
+                    return True
+                if cancel_event and cancel_event.is_set():
+                    return False
+                remaining = deadline.remaining() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceededError(f"Deadline of {deadline} exceeded waiting for the spool space")
+                # wake up regularly to check the cancel event
+                self._condition.wait(timeout=min(remaining, 1.0) if remaining is not None else 1.0)
+            return True
+
+    async def async_wait_for_space(self,
+                                   deadline: Optional[Deadline] = None,
+                                   is_exempt: Optional[Callable[[], bool]] = None):
+        """
+        Coroutine version of wait_for_space, polling the budget without blocking the event loop.
+        :raises DeadlineExceededError: if the deadline passes during waiting
+        """
+        if self.has_space():
+            return
+        with self._condition:
+            self._waited_times += 1
+        while not self.has_space():
+            if is_exempt and is_exempt():
+                with self._condition:
+                    self._exempted_times += 1
+                return
+            if deadline and deadline.is_expired():
+                raise DeadlineExceededError(f"Deadline of {deadline} exceeded waiting for the spool space")
+            await asyncio.sleep(SPOOL_WAIT_INTERVAL)
+
+    def notify_waiters(self):
+        """
+        Wake up the downloads waiting for space to check again whether they are exempted.
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+    def reap(self) -> int:
+        """
+        Delete the orphaned spool files, either of dead processes of this host,
+        or of this process but no longer tracked, or of another host, older than the orphan age.
+        :return: the number of the deleted files
+        """
+        now = time.time()
+        pid = os.getpid()
+        host_id = get_host_id()
+        reaped = 0
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                owner = parse_spool_file_owner(entry.name)
+                if owner is None:
+                    continue
+                owner_host_id, owner_pid, owner_start_time = owner
+                with self._condition:
+                    if entry.path in self._files:
+                        continue
+                try:
+                    if owner_host_id != host_id or owner_pid == pid:
+                        # the processes of the other hosts are unknown, and the files of this process are untracked
+                        if now - entry.stat().st_mtime < self.orphan_age:
+                            continue
+                    elif is_process_alive(owner_pid, owner_start_time):
+                        continue
+                    os.unlink(entry.path)
+                    reaped += 1
+                except OSError:
+                    pass
+        with self._condition:
+            self._reaped_files += reaped
+        return reaped
+
+    def _ensure_reaper(self):
+        if self._reaper is not None or self.reap_interval <= 0:
+            return
+        with self._condition:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap_loop, name="download-spool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            # the first round cleans up the files left by the previous processes
+            self.reap()
+            time.sleep(self.reap_interval)
+
+    def stats(self) -> dict[str, Any]:
+        with self._condition:
+            return {
+                "directories": self.directories,
+                "max_size": self.max_size,
+                "files": len(self._files),
+                "reserved_size": self._reserved_size,
+                "created_files": self._created_files,
+                "waited_times": self._waited_times,
+                "exempted_times": self._exempted_times,
+                "reaped_files": self._reaped_files,
+            }
+
+
+class OutputOrder:
+    """
+    Completion of the downloads of an invocation yielding the results in the order of the input,
+    where the completed results are kept, in spool files, until all the results before them are yielded.
+    A download is unblocked once all the downloads before it are completed,
+    i.e. its result is the next to be yielded after them, so it does not wait for the spool space.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures: list[Future] = []
+
+    def next_position(self) -> int:
+        with self._lock:
+            return len(self._futures)
+
+    def add(self, future: Future):
+        """
+        Track the future of the download at the next position.
+        """
+        with self._lock:
+            self._futures.append(future)
+        # the next downloads may be unblocked by the completion
+        future.add_done_callback(lambda _: spool_manager.notify_waiters())
+
+    def is_unblocked(self, position: int) -> bool:
+        with self._lock:
+            return all(future.done() for future in self._futures[:position])
+
+
+def preallocate(file: BinaryIO, size: int):
+    """
+    Allocate the disk space of the file ahead of writing, to fail early and reduce fragmentation,
+    which is skipped if not supported by the platform or the file system.
+    """
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError:
+        pass
+
+
+_host_id: Optional[str] = None
+
+
+def get_host_id() -> str:
+    """
+    :return: the identity of the host, or of the container, and its boot,
+        telling apart the processes sharing the spool directory but not their PID namespace
+    """
+    global _host_id
+    if _host_id is None:
+        try:
+            with open("/proc/sys/kernel/random/boot_id", encoding="utf-8") as f:
+                boot_id = f.read().strip()
+        except OSError:
+            boot_id = ""
+        _host_id = hashlib.sha256(f"{socket.gethostname()}\n{boot_id}".encode("utf-8")).hexdigest()[:12]
+    return _host_id
+
+
+def get_process_start_time(pid: int) -> Optional[int]:
+    """
+    :return: the start time of the process in clock ticks after the boot,
+        telling apart the processes reusing the same PID, or None if not known, e.g. not on Linux
+    """
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+            stat = f.read()
+        # the fields after the parenthesized command name start from the 3rd one, the start time being the 22nd
+        return int(stat[stat.rindex(")") + 2:].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_process_owner_id() -> str:
+    """
+    :return: the owner of the spool files created by this process, in the names of the files
+    """
+    return f"{get_host_id()}-{os.getpid()}-{get_process_start_time(os.getpid()) or 0}"
+
+
+def parse_spool_file_owner(name: str) -> Optional[tuple[str, int, int]]:
+    """
+    :return: the host ID, PID and process start time (0 if unknown) of the process creating the spool file,
+        or None if not a spool file
+    """
+    if not name.startswith(SPOOL_FILE_PREFIX) or not name.endswith(SPOOL_FILE_SUFFIX):
+        return None
+    parts = name[len(SPOOL_FILE_PREFIX):-len(SPOOL_FILE_SUFFIX)].split("-")
+    if len(parts) != 4 or not parts[1].isdigit() or not parts[2].isdigit():
+        # e.g. named by a former version without the host, whose processes are unknown
+        return ("", 0, 0) if parts[0].isdigit() else None
+    return parts[0], int(parts[1]), int(parts[2])
+
+
+def is_process_alive(pid: int, start_time: int = 0) -> bool:
+    """
+    :param start_time: the start time of the process if known, as a process reusing the PID is not the same one
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. no permission to signal the process of another user
+        pass
+    if start_time:
+        current_start_time = get_process_start_time(pid)
+        return current_start_time is None or current_start_time == start_time
+    return True
+
+
+spool_manager = SpoolManager(
+    spool_dir=get_env_str("DOWNLOAD_SPOOL_DIR", DEFAULT_SPOOL_DIR),
+    small_spool_dir=get_env_str("DOWNLOAD_SPOOL_SMALL_DIR"),
+    small_max_size=get_env_int("DOWNLOAD_SPOOL_SMALL_MAX_SIZE", DEFAULT_SPOOL_SMALL_MAX_SIZE),
+    max_size=get_env_int("DOWNLOAD_SPOOL_MAX_SIZE", 0),
+    reap_interval=get_env_float("DOWNLOAD_SPOOL_REAP_INTERVAL", DEFAULT_SPOOL_REAP_INTERVAL),
+    orphan_age=get_env_float("DOWNLOAD_SPOOL_ORPHAN_AGE", DEFAULT_SPOOL_ORPHAN_AGE),
+)
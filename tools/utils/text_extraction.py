@@ -0,0 +1,326 @@
+import codecs
+import json
+import re
+from collections.abc import Generator, Iterable
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from typing import Optional, Any
+
+# number of leading bytes buffered for detecting the charset before decoding
+CHARSET_SNIFF_SIZE = 4096
+
+TEXT_EXTRACTION_MODES = ["auto", "raw"]
+
+_BOMS = (
+    # the UTF-32 BOMs go first as the UTF-32 LE BOM starts with the UTF-16 LE BOM
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+
+_META_CHARSET_PATTERN = re.compile(
+    rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9._:\-]+)""", re.IGNORECASE)
+_XML_ENCODING_PATTERN = re.compile(
+    rb"""^\s*<\?xml[^>]+encoding\s*=\s*["']([A-Za-z0-9._\-]+)["']""", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class TextExtractOptions:
+    # "auto" to extract the readable text by the MIME type, "raw" to keep the decoded text as is
+    mode: str = "auto"
+    # max number of characters of the extracted text, 0 for unlimited
+    max_chars: int = 0
+
+    @staticmethod
+    def create(mode: Optional[str], max_chars: int) -> "TextExtractOptions":
+        mode = mode or "auto"
+        if mode not in TEXT_EXTRACTION_MODES:
+            raise ValueError(f"Invalid text extraction mode: {mode}, expected one of {TEXT_EXTRACTION_MODES}")
+        return TextExtractOptions(mode=mode, max_chars=max(0, max_chars))
+
+
+def detect_charset(head: bytes,
+                   declared_charset: Optional[str] = None,
+                   mime_type: Optional[str] = None,
+                   ) -> tuple[str, int]:
+    """
+    Detect the charset of the content from its BOM, the charset declared in the Content-Type header,
+    the charset declared in the HTML or XML markup, or by sniffing the leading bytes.
+    :return: the charset, and the length of the BOM to skip
+    """
+    for bom, charset in _BOMS:
+        if head.startswith(bom):
+            return charset, len(bom)
+
+    for charset in (declared_charset, _find_markup_charset(head, mime_type)):
+        if charset and _is_known_charset(charset):
+            return charset, 0
+
+    try:
+        # a multibyte character may be cut at the end of the head
+        codecs.getincrementaldecoder("utf-8")().decode(head)
+        return "utf-8", 0
+    except UnicodeDecodeError:
+        pass
+    sniffed_charset = _sniff_charset(head)
+    return sniffed_charset or "utf-8", 0
+
+
+def _find_markup_charset(head: bytes, mime_type: Optional[str]) -> Optional[str]:
+    if not _is_html(mime_type) and not (mime_type or "").endswith("xml"):
+        return None
+    match = _XML_ENCODING_PATTERN.search(head) or _META_CHARSET_PATTERN.search(head)
+    return match.group(1).decode("ascii") if match else None
+
+
+def _is_known_charset(charset: str) -> bool:
+    try:
+        codecs.lookup(charset)
+        return True
+    except LookupError:
+        return False
+
+
+def _sniff_charset(head: bytes) -> Optional[str]:
+    try:
+        from charset_normalizer import from_bytes
+    except ImportError:
+        return None
+    best_match = from_bytes(head).best()
+    return best_match.encoding if best_match else None
+
+
+def _is_html(mime_type: Optional[str]) -> bool:
+    return mime_type in ("text/html", "application/xhtml+xml")
+
+
+def _is_json(mime_type: Optional[str]) -> bool:
+    return mime_type in ("application/json", "text/json") or (mime_type or "").endswith("+json")
+
+
+class _PlainTextSink:
+    """
+    Keeps the decoded text as is, e.g. for plain text and CSV.
+    """
+
+    def __init__(self):
+        self._parts: list[str] = []
+        # number of characters produced so far
+        self.chars = 0
+
+    def feed(self, text: str):
+        if text:
+            self._parts.append(text)
+            self.chars += len(text)
+
+    def finish(self) -> str:
+        return "".join(self._parts)
+
+
+class _JsonTextSink(_PlainTextSink):
+    """
+    Flattens the JSON document into a line of `path: value` per leaf value,
+    or keeps the text as is if it is not a complete JSON document.
+    """
+
+    def finish(self) -> str:
+        text = super().finish()
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return text
+        return "\n".join(flatten_json(data))
+
+
+def flatten_json(value: Any, path: str = "") -> Generator[str, None, None]:
+    """
+    Flatten the JSON value into lines of `path: value`, e.g. `items[0].name: foo`.
+    """
+    if isinstance(value, dict) and value:
+        for key, item in value.items():
+            yield from flatten_json(item, f"{path}.{key}" if path else str(key))
+    elif isinstance(value, list) and value:
+        for index, item in enumerate(value):
+            yield from flatten_json(item, f"{path}[{index}]")
+    else:
+        text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        yield f"{path}: {text}" if path else text
+
+
+class _HtmlTextSink(HTMLParser):
+    """
+    Extracts the readable text of the HTML document,
+    skipping the head, scripts, styles and boilerplate such as navigation and footers.
+    """
+    skipped_tags = {
+        "script", "style", "noscript", "template", "svg", "canvas", "iframe", "object",
+        "nav", "footer", "aside", "button", "select", "dialog",
+    }
+    # elements allowed in the head, any other start tag implies the end of the head as </head> is optional
+    head_tags = {"base", "basefont", "bgsound", "link", "meta", "noscript", "script", "style", "template", "title"}
+    block_tags = {
+        "address", "article", "blockquote", "br", "dd", "div", "dl", "dt", "figcaption", "figure",
+        "h1", "h2", "h3", "h4", "h5", "h6", "hr", "li", "main", "ol", "p", "pre", "section",
+        "table", "tbody", "thead", "tfoot", "tr", "ul", "title",
+    }
+    void_tags = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._parts: list[str] = []
+        self.chars = 0
+        # depth of the skipped elements enclosing the current position
+        self._skipped_depth = 0
+        self._pre_depth = 0
+        self._is_in_title = False
+        self._is_in_head = False
+
+    def handle_starttag(self, tag: str, attrs):
+        if tag == "head":
+            self._is_in_head = True
+        elif tag not in self.head_tags:
+            self._is_in_head = False
+        if tag == "title":
+            # keep the title even though inside the head
+            self._is_in_title = True
+        elif tag in self.skipped_tags:
+            self._skipped_depth += 1
+        elif tag == "pre":
+            self._pre_depth += 1
+        if tag in ("td", "th"):
+            self._append("\t")
+        elif tag in self.block_tags:
+            self._append("\n")
+
+    def handle_startendtag(self, tag: str, attrs):
+        if tag not in self.head_tags:
+            self._is_in_head = False
+        if tag in self.block_tags:
+            self._append("\n")
+
+    def handle_endtag(self, tag: str):
+        if tag == "head":
+            self._is_in_head = False
+        elif tag == "title":
+            self._is_in_title = False
+        elif tag in self.skipped_tags and tag not in self.void_tags:
+            self._skipped_depth = max(0, self._skipped_depth - 1)
+        elif tag == "pre":
+            self._pre_depth = max(0, self._pre_depth - 1)
+        if tag in self.block_tags:
+            self._append("\n")
+
+    def handle_data(self, data: str):
+        if self._is_in_head and not self._skipped_depth and not self._is_in_title and data.strip():
+            # the text outside of the elements of the head implies the start of the body
+            self._is_in_head = False
+        if self._is_skipping:
+            return
+        if self._pre_depth <= 0:
+            data = re.sub(r"\s+", " ", data)
+        self._append(data)
+
+    @property
+    def _is_skipping(self) -> bool:
+        return (self._skipped_depth > 0 or self._is_in_head) and not self._is_in_title
+
+    def _append(self, text: str):
+        if self._is_skipping:
+            return
+        self._parts.append(text)
+        self.chars += len(text)
+
+    def finish(self) -> str:
+        self.close()
+        lines = [line.strip() for line in "".join(self._parts).splitlines()]
+        # collapse the consecutive blank lines
+        text = re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+        return text.strip()
+
+
+class TextExtractor:
+    """
+    Incremental decode-and-extract stage fed with the byte stream of a download.
+    The charset is detected from the leading bytes, then the bytes are decoded incrementally
+    and the text is extracted by the MIME type: the readable text of HTML, the flattened JSON,
+    and CSV or any other text as is.
+    """
+
+    def __init__(self,
+                 options: TextExtractOptions,
+                 mime_type: Optional[str] = None,
+                 declared_charset: Optional[str] = None):
+        self.options = options
+        self.mime_type = mime_type
+        self.declared_charset = declared_charset
+        # detected charset, None until enough bytes are buffered
+        self.charset: Optional[str] = None
+        # whether the text is cut off at the max number of characters
+        self.is_cut_off = False
+        self._head: Optional[bytearray] = bytearray()
+        self._decoder: Optional[codecs.IncrementalDecoder] = None
+        if options.mode == "raw":
+            self._sink = _PlainTextSink()
+        elif _is_html(mime_type):
+            self._sink = _HtmlTextSink()
+        elif _is_json(mime_type):
+            self._sink = _JsonTextSink()
+        else:
+            self._sink = _PlainTextSink()
+
+    @property
+    def is_complete(self) -> bool:
+        """
+        Whether more than the max number of characters are produced, so the rest of the content is not needed.
+        """
+        return 0 < self.options.max_chars < self._sink.chars
+
+    def feed(self, data: bytes):
+        if self._decoder is not None:
+            self._sink.feed(self._decoder.decode(data))
+            return
+        self._head += data
+        if len(self._head) >= CHARSET_SNIFF_SIZE:
+            self._start_decoding()
+
+    def _start_decoding(self):
+        head = bytes(self._head)
+        self._head = None
+        self.charset, bom_length = detect_charset(head, self.declared_charset, self.mime_type)
+        self._decoder = codecs.getincrementaldecoder(self.charset)(errors="replace")
+        self._sink.feed(self._decoder.decode(head[bom_length:]))
+
+    def finish(self) -> str:
+        """
+        :return: the extracted text, cut off at the max number of characters
+        """
+        if self._decoder is None:
+            self._start_decoding()
+        # the rest of the content may be left unread once complete
+        self.is_cut_off = self.is_complete
+        self._sink.feed(self._decoder.decode(b"", final=True))
+        text = self._sink.finish()
+        if 0 < self.options.max_chars < len(text):
+            self.is_cut_off = True
+            text = text[:self.options.max_chars]
+        return text
+
+
+def extract_text(chunks: Iterable[bytes],
+                 options: TextExtractOptions,
+                 mime_type: Optional[str] = None,
+                 declared_charset: Optional[str] = None,
+                 ) -> tuple[str, bool]:
+    """
+    Extract the text from the chunks of a complete content, stopping once enough text is produced.
+    :return: the extracted text, and whether it is cut off at the max number of characters
+    """
+    extractor = TextExtractor(options, mime_type, declared_charset)
+    for chunk in chunks:
+        extractor.feed(chunk)
+        if extractor.is_complete:
+            break
+    text = extractor.finish()
+    return text, extractor.is_cut_off